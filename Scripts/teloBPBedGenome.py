@@ -1,22 +1,24 @@
-from Bio import SeqIO
-import sys
+import argparse
+import contextlib
+import multiprocessing as mp
 
-from TeloBP import refRecordTeloLengths
-from TeloBP.teloBoundaryHelpers import write_bed_file, recordBedData
+from TeloBP import writeTeloReferenceBed
+from TeloBP.seqReader import parsers
+from TeloBP.resultCache import ResultCache
+from TeloBP.constants import resultCacheMaxEntries
 
-# Check if the correct number of arguments were passed
-if len(sys.argv) != 3:
-    print("Usage: python teloBPBedGenome.py <reference genome> <output bed file>")
-    sys.exit()
-filename = sys.argv[1]
-outputFile = sys.argv[2]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Writes the telomere boundaries of a reference genome to a bed file')
+    parser.add_argument('referenceGenome', type=str, help='Path to the reference genome fasta')
+    parser.add_argument('outputBedFile', type=str, help='Path to the output bed file')
+    parser.add_argument('--noIndex', action='store_true', help='Parse the whole reference, rather than reading the chromosome ends through its .fai/.gzi index')
+    parser.add_argument('--parser', type=str, choices=parsers, default="fast", help='fasta reader used with --noIndex: "fast" or "biopython" (Bio.SeqIO)')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), help='Number of chromosomes analyzed in parallel (default: the number of CPUs)')
+    parser.add_argument('--cacheDir', '--cache-dir', dest='cacheDir', type=str, default=None, help='Directory of a result cache, chromosomes whose ends were analyzed before with the same parameters are not analyzed again')
+    parser.add_argument('--cacheMaxEntries', type=int, default=resultCacheMaxEntries, help='Number of results kept in the result cache (2 per chromosome)')
+    args = parser.parse_args()
 
-bed_data = []
-
-for record in SeqIO.parse(filename, "fasta"):
-    print(record.id)
-    startTeloLength, endTeloLength = refRecordTeloLengths(record)
-    
-    recordBedData(bed_data, record, startTeloLength, endTeloLength)
-
-write_bed_file(outputFile, bed_data)
\ No newline at end of file
+    with (ResultCache(args.cacheDir, args.cacheMaxEntries) if args.cacheDir is not None else contextlib.nullcontext()) as cache:
+        writeTeloReferenceBed(args.referenceGenome, args.outputBedFile, indexed=not args.noIndex, parser=args.parser, workers=args.workers, cache=cache)
+        if cache is not None:
+            print(f"Result cache: {cache.hits} hits, {cache.misses} misses (chromosome ends)")
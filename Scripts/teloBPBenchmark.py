@@ -0,0 +1,262 @@
+# Benchmarks TeloBP on synthetic telomeric reads, so that its performance can be compared between commits.
+# The script can be run from the command line using the following command:
+# python3 teloBPBenchmark.py [--functions <names>] [--readLengths <bases>] [--batchSizes <reads>] [--output <json file>] [--compare <json file>]
+# The script takes the following arguments:
+# --functions: Comma separated functions to benchmark (default: all of them). getTeloBoundary, getTeloNPBoundary,
+#              getIsGStrandFromSeq and getGraphArea are run on one read at a time, getTeloBoundaryBatch,
+#              getTeloNPBoundaryBatch and run_analysis (teloBPCmd.py, end to end on a fastq file) on batches of reads.
+# --readLengths: Comma separated read lengths (default 1000,10000,50000,200000).
+# --batchSizes: Comma separated batch sizes of the batch functions, and chunk sizes of run_analysis (default 100,1000).
+# --basesPerCase: The number of bases analyzed by each case (default 20000000), split into reads of each length.
+# --minReads: The minimum number of reads per case (default 20).
+# --repeats: The number of times each case is timed, the fastest time is reported (default 3).
+# --workers: The number of worker processes of run_analysis (default 1).
+# --substitutionRate, --insertionRate, --deletionRate: ONT-like sequencing error rates of the reads (default 0.03, 0.02, 0.02).
+# --minTelomereLength, --maxTelomereLength: The range of the telomere lengths (default 2000 to 10000), at most half of the read length.
+# --variantRepeatLength: The length of variant telomere repeats before the telomere (default 0).
+# --seed: Seed of the synthetic reads (default 1), so every run analyzes the same reads.
+# --output: Path of the json results (default: printed to stdout).
+# --compare: Path of the json results of a previous run, e.g. on another commit. The speedup of every case is printed.
+#
+# Each case runs in a new process, so the peak RSS it reports is its own: peakRssMB is the peak of the
+# process, and peakChildRssMB the peak of its largest child process (the run_analysis workers).
+# Times don't include generating the reads, and every function is run once on a single read before it is
+# timed, so that pattern compilation isn't counted. The boundary functions also report their median absolute
+# error from the synthetic telomere lengths, and the fraction of reads given the right strand.
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from TeloBP import getTeloBoundary, getTeloNPBoundary, getIsGStrandFromSeq, getTeloBoundaryBatch, getTeloNPBoundaryBatch
+from TeloBP.constants import expectedTeloCompositionQ, expectedTeloCompositionP
+from TeloBP.offsetScoring import getNtOffsets
+from TeloBP.syntheticReads import syntheticReads, writeSyntheticFastq
+from TeloBP.teloBoundaryHelpers import getGraphArea, asUpperSeqBytes
+
+benchmarkVersion = 1
+singleReadFunctions = ("getTeloBoundary", "getTeloNPBoundary", "getIsGStrandFromSeq", "getGraphArea")
+batchFunctions = ("getTeloBoundaryBatch", "getTeloNPBoundaryBatch", "run_analysis")
+defaultReadLengths = "1000,10000,50000,200000"
+defaultBatchSizes = "100,1000"
+
+
+def peakRssMB(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxRss = resource.getrusage(who).ru_maxrss
+    return maxRss / (1024 * 1024) if sys.platform == "darwin" else maxRss / 1024
+
+
+def boundaryAccuracy(results, reads):
+    # Median absolute error of the telomere lengths, and fraction of the reads given the right strand
+    errors = [abs(teloLength - trueLength) for (teloLength, readIsGStrand), (_, _, trueIsGStrand, trueLength) in zip(results, reads)
+              if readIsGStrand is not None and teloLength >= 0]
+    rightStrand = sum(readIsGStrand == trueIsGStrand for (_, readIsGStrand), (_, _, trueIsGStrand, _) in zip(results, reads))
+    return {"medianAbsError": float(np.median(errors)) if errors else None, "rightStrandFraction": rightStrand / len(reads)}
+
+
+def batchResults(telomereLengths, isGStrand):
+    return [(int(teloLength), None if readIsGStrand < 0 else bool(readIsGStrand)) for teloLength, readIsGStrand in zip(telomereLengths, isGStrand)]
+
+
+def runAnalysisOnce(fastqFilename, outputDir, batchSize, workers):
+    # teloBPCmd.py is a script in this directory, so it's imported when it's needed
+    import teloBPCmd
+    # run_analysis prints every read, which would dominate the time of short reads
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        teloBPCmd.run_analysis(fastqFilename, True, False, outputDir, chunkSize=batchSize, workers=workers)
+
+
+def caseRunner(case, reads, workDir):
+    # Returns (warmUp, run) functions for a case, where run returns the per-read results if they can be scored
+    function, batchSize = case["function"], case["batchSize"]
+    seqs = [seq for _, seq, _, _ in reads]
+
+    if function == "getTeloBoundary":
+        return lambda: getTeloBoundary(seqs[0]), lambda: [getTeloBoundary(seq) for seq in seqs]
+    if function == "getTeloNPBoundary":
+        return lambda: getTeloNPBoundary(seqs[0]), lambda: [getTeloNPBoundary(seq) for seq in seqs]
+    if function == "getIsGStrandFromSeq":
+        def run():
+            for seq in seqs:
+                getIsGStrandFromSeq(seq, expectedTeloCompositionQ[-1], expectedTeloCompositionP[-1])
+        return run, run
+    if function == "getGraphArea":
+        # The offsets are scored beforehand, only the area computation is timed
+        offsets = [getNtOffsets(asUpperSeqBytes(seq), expectedTeloCompositionQ if isGStrand else expectedTeloCompositionP, isGStrand)
+                   for _, seq, isGStrand, _ in reads]
+        def run():
+            for readOffsets in offsets:
+                getGraphArea(readOffsets, -1, int(500 / 6))
+        return run, run
+    if function in ("getTeloBoundaryBatch", "getTeloNPBoundaryBatch"):
+        batchFunction = getTeloBoundaryBatch if function == "getTeloBoundaryBatch" else getTeloNPBoundaryBatch
+        def run():
+            results = []
+            for start in range(0, len(seqs), batchSize):
+                telomereLengths, isGStrand, _ = batchFunction(seqs[start:start + batchSize])
+                results.extend(batchResults(telomereLengths, isGStrand))
+            return results
+        return lambda: batchFunction(seqs[:1]), run
+    if function == "run_analysis":
+        fastqFilename = os.path.join(workDir, "reads.fastq")
+        writeSyntheticFastq(fastqFilename, reads, seed=0)
+        warmUpFilename = os.path.join(workDir, "warmUp.fastq")
+        writeSyntheticFastq(warmUpFilename, reads[:1], seed=0)
+        outputDir = os.path.join(workDir, "output")
+        workers = case["workers"]
+        return (lambda: runAnalysisOnce(warmUpFilename, outputDir, batchSize, workers),
+                lambda: runAnalysisOnce(fastqFilename, outputDir, batchSize, workers))
+    raise ValueError(f"Unknown function {function}")
+
+
+def runCase(case, settings, connection):
+    # Runs in a new process: generates the reads of a case, times it, and sends back its results
+    try:
+        # A spawned process defaults to spawning its own children, the run_analysis workers are started as they
+        # are from the command line
+        mp.set_start_method(settings["startMethod"], force=True)
+        # Short reads keep some subtelomere, so that their boundary can be found
+        maxTelomereLength = min(settings["maxTelomereLength"], case["readLength"] // 2)
+        minTelomereLength = min(settings["minTelomereLength"], maxTelomereLength // 2)
+        reads = list(syntheticReads(case["reads"], case["readLength"], minTelomereLength, maxTelomereLength, substitutionRate=settings["substitutionRate"],
+                                    insertionRate=settings["insertionRate"], deletionRate=settings["deletionRate"],
+                                    variantRepeatLength=settings["variantRepeatLength"], seed=settings["seed"]))
+        numBases = sum(len(seq) for _, seq, _, _ in reads)
+        with tempfile.TemporaryDirectory() as workDir:
+            warmUp, run = caseRunner(case, reads, workDir)
+            warmUp()
+            seconds = float("inf")
+            results = None
+            for _ in range(settings["repeats"]):
+                start = time.perf_counter()
+                results = run()
+                seconds = min(seconds, time.perf_counter() - start)
+        result = dict(case, bases=numBases, seconds=seconds, readsPerSecond=len(reads) / seconds,
+                      basesPerSecond=numBases / seconds, peakRssMB=peakRssMB(resource.RUSAGE_SELF),
+                      peakChildRssMB=peakRssMB(resource.RUSAGE_CHILDREN))
+        if results is not None:
+            result.update(boundaryAccuracy(results, reads))
+        connection.send(result)
+    except Exception as e:
+        connection.send(dict(case, error=repr(e)))
+    finally:
+        connection.close()
+
+
+def benchmarkCases(functions, readLengths, batchSizes, basesPerCase, minReads, workers):
+    cases = []
+    for function in functions:
+        for readLength in readLengths:
+            numReads = max(minReads, basesPerCase // readLength)
+            for batchSize in (batchSizes if function in batchFunctions else [None]):
+                case = {"function": function, "readLength": readLength, "batchSize": batchSize, "reads": numReads}
+                if function == "run_analysis":
+                    case["workers"] = workers
+                cases.append(case)
+    return cases
+
+
+def caseKey(result):
+    return (result["function"], result["readLength"], result["batchSize"], result.get("workers"))
+
+
+def gitCommit():
+    # The commit of the benchmarked code, if it's in a git repository
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def printComparison(results, baselineFilename):
+    # Prints the speedup (baseline time / time) and peak RSS change of every case also in the baseline
+    with open(baselineFilename) as baselineFile:
+        baseline = json.load(baselineFile)
+    baselineResults = {caseKey(result): result for result in baseline["results"] if "error" not in result}
+    print(f"Compared to {baseline.get('commit')} ({baselineFilename}):", file=sys.stderr)
+    for result in results:
+        previous = baselineResults.get(caseKey(result))
+        if previous is None or "error" in result:
+            continue
+        batch = f", batch {result['batchSize']}" if result["batchSize"] is not None else ""
+        print(f"{result['function']} ({result['readLength']} bases{batch}): {previous['seconds'] / result['seconds']:.2f}x speed, "
+              f"{result['basesPerSecond']:.0f} bases/s, peak RSS {result['peakRssMB']:.0f} MB (was {previous['peakRssMB']:.0f} MB)", file=sys.stderr)
+
+
+def parseList(value, convert=str):
+    return [convert(item) for item in value.split(",") if item]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks TeloBP on synthetic telomeric reads')
+    parser.add_argument('--functions', type=str, default=",".join(singleReadFunctions + batchFunctions), help='Comma separated functions to benchmark')
+    parser.add_argument('--readLengths', type=str, default=defaultReadLengths, help='Comma separated read lengths')
+    parser.add_argument('--batchSizes', type=str, default=defaultBatchSizes, help='Comma separated batch sizes of the batch functions and run_analysis')
+    parser.add_argument('--basesPerCase', type=int, default=20000000, help='Number of bases analyzed by each case')
+    parser.add_argument('--minReads', type=int, default=20, help='Minimum number of reads per case')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times each case is timed, the fastest time is reported')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes of run_analysis')
+    parser.add_argument('--substitutionRate', type=float, default=0.03, help='Per-base substitution rate of the reads')
+    parser.add_argument('--insertionRate', type=float, default=0.02, help='Per-base insertion rate of the reads')
+    parser.add_argument('--deletionRate', type=float, default=0.02, help='Per-base deletion rate of the reads')
+    parser.add_argument('--minTelomereLength', type=int, default=2000, help='Minimum telomere length of the reads')
+    parser.add_argument('--maxTelomereLength', type=int, default=10000, help='Maximum telomere length of the reads, at most half of the read length')
+    parser.add_argument('--variantRepeatLength', type=int, default=0, help='Length of variant telomere repeats before the telomere')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic reads')
+    parser.add_argument('--output', type=str, default=None, help='Path of the json results (default: stdout)')
+    parser.add_argument('--compare', type=str, default=None, help='Path of the json results of a previous run to compare to')
+    args = parser.parse_args()
+
+    functions = parseList(args.functions)
+    for function in functions:
+        if function not in singleReadFunctions + batchFunctions:
+            parser.error(f"Unknown function {function}, choose from {', '.join(singleReadFunctions + batchFunctions)}")
+    settings = {"startMethod": mp.get_start_method(), "repeats": args.repeats, "substitutionRate": args.substitutionRate, "insertionRate": args.insertionRate,
+                "deletionRate": args.deletionRate, "minTelomereLength": args.minTelomereLength, "maxTelomereLength": args.maxTelomereLength, "variantRepeatLength": args.variantRepeatLength, "seed": args.seed}
+    cases = benchmarkCases(functions, parseList(args.readLengths, int), parseList(args.batchSizes, int),
+                           args.basesPerCase, args.minReads, args.workers)
+
+    # Each case runs in a new process, so peak RSS isn't carried over from the previous cases
+    context = mp.get_context("spawn")
+    results = []
+    for case in cases:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=runCase, args=(case, settings, sender))
+        process.start()
+        sender.close()
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = dict(case, error=f"the benchmark process exited with code {process.exitcode}")
+        process.join()
+        results.append(result)
+        if "error" in result:
+            print(f"{case['function']} ({case['readLength']} bases): {result['error']}", file=sys.stderr)
+        else:
+            print(f"{case['function']} ({case['readLength']} bases, batch {case['batchSize']}): {result['readsPerSecond']:.1f} reads/s, "
+                  f"{result['basesPerSecond']:.0f} bases/s, peak RSS {result['peakRssMB']:.0f} MB", file=sys.stderr)
+
+    report = {"version": benchmarkVersion, "commit": gitCommit(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+              "cpus": mp.cpu_count(), "settings": settings, "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.compare is not None:
+        printComparison(results, args.compare)
@@ -2,37 +2,127 @@
 # The script can be run from the command line using the following command:
 # python3 teloBPCmd.py <dataDir> <outputDir> [--fileMode] [--teloNP] [-v]
 # The script takes the following arguments:
-# dataDir: The path to the data directory containing the fastq files to be analyzed. 
-#          OR the path to a single fastq file to be analyzed. set the --fileMode flag to indicate this.
+# dataDir: The path to the data directory containing the fastq (or aligned BAM/CRAM) files to be analyzed.
+#          OR the path to a single file to be analyzed. set the --fileMode flag to indicate this.
 # outputDir: The path to the output directory where the results will be saved.
 # --fileMode: Flag indicating that a single file is being analyzed.
 # --teloNP: Flag indicating that the teloNP analysis should be run instead of the teloBP analysis.
 # --targetQnamesCSV: Path to a csv file containing the qnames of the reads to be analyzed. The analysis will only be run on these reads.
+#                    Fastq records are filtered on their header line, and reading a file stops once every target has been found in it.
+#                    With --cacheDir, a qname index of each plain or bgzip compressed fastq is saved in cacheDir/qnameIndexes,
+#                    so later targeted runs seek directly to their reads (see TeloBP.qnameIndex).
+# --noQnameIndex: Don't read or write qname indexes with --targetQnamesCSV and --cacheDir.
 # --save_graphs: Flag indicating to generate graphs during analysis and save them to a pdf file. They will be saved in the main directory.
 # The program will run in single threaded mode when --save_graphs is set to True.
+# --chunkSize: The number of reads sent to a worker at a time. Memory use is proportional to chunkSize x the number of workers.
+# --workers: The number of worker processes (default: the number of CPUs).
+# --prefilter: Reject reads without telomere repeats in their first or last --prefilterEndLength bases before the boundary search,
+#              and count them as "no telomere" errors. Off by default, as it also rejects reads that the boundary search would
+#              otherwise report with another error code, or a telomere length.
+# --prefilterEndLength: The number of bases at each read end checked by the prefilter (default 30000).
+# --parser: "fast" (default) to use the lightweight fastq reader in TeloBP.seqReader, or "biopython" to use Bio.SeqIO.
+# --cacheDir (or --cache-dir): Directory of an on-disk result cache. Reads analyzed before with the same parameters are taken
+#                from the cache rather than analyzed again, e.g. when rerunning a cohort after adding samples.
+# --cacheMaxEntries: The number of reads kept in the cache, the least recently used are evicted (default 10000000).
+# --readTable: "parquet" or "arrow" to also write a table of every analyzed read, including the failed reads, to
+#              outputDir/sampleKey.parquet (or .arrow), with the qname, sample key, read length, telomere length,
+#              strand and error code of each read. Requires pyarrow.
+# --checkpoint: Save the progress of the run in outputDir, so that it can be continued with --resume if it is interrupted.
+# --resume: Continue an interrupted run in the same outputDir, skipping the files and reads it already analyzed.
+#           The progress of the resumed run is also checkpointed.
+# --checkpointInterval: Seconds between checkpoints of the progress of the run (default 60).
+# --alignmentEndDistance: For BAM/CRAM files, the reads whose unclipped alignment is within this many bases of a chromosome
+#                         end are analyzed, with the strand given by their chromosome arm and alignment (default 20000).
+# --alignmentBackend: "auto" (default) to read BAM/CRAM files with pysam if it is installed, "python" for the pure Python
+#                     BAM reader in TeloBP.alignmentReader, or "pysam". CRAM files need pysam.
+# --reference: The reference fasta of CRAM files, if it isn't found from their header.
+# --logLevel: The level of the log messages shown (default WARNING). Failed reads are logged at the DEBUG level, and
+#             counted by error code in the summary printed at the end.
+# --coarseWindowStep: Search for the boundary on windows this many bases apart first (e.g. 60), then score windows every 6 bases only
+#                     around it. Only used for reads of at least 40 kb with --teloNP (which finds the last discontinuity, scoring
+#                     the whole read), and makes these 1.1-1.4x faster. Off by default, see the coarseWindowStep parameter of getTeloBoundary.
+# --profile: Path of a json report of where the time of the boundary search goes: the time of each stage (prefilter,
+#            strand inference, window scoring, area curve, threshold search, secondary search), the windows scored and
+#            bases scanned, and histograms of the read times, for each sample and in total (see TeloBP.profiling).
 # -v: Flag to enable verbose output.
+#
+# Files are streamed: reads are parsed in batches of chunkSize, the batches are analyzed by a pool of
+# worker processes, and the results are appended to the output csvs as they come back, in input order.
+# The pool is created once per run, batches can hold reads from several files, and the sequences of
+# a batch are sent to the workers packed into a single buffer. The input is read in a background thread,
+# so that reading, analysis and writing overlap. A progress bar is shown when stderr is a terminal, and
+# the reads/s and bases/s of each file are printed at the end.
+# With a result cache, the reads of each batch are looked up in the main process, and only the reads
+# that aren't cached are sent to the workers.
+#
+# Aligned reads are streamed from BAM/CRAM files by TeloBP.alignmentReader, which only decodes the sequences
+# of the primary alignments at the chromosome ends. Their strand is known from the alignment, so it's sent to
+# the workers with the sequences, and the strand inference is skipped.
+#
+# With --checkpoint or --resume, each output csv is written to sampleKey.csv.partial, and renamed to sampleKey.csv
+# once its file is complete, so a csv is never left half written. The progress of the run (the number of reads of
+# each file already written, and the size of its partial csv) is saved in outputDir/teloBPCheckpoint.json
+# every --checkpointInterval seconds and whenever a file is completed. Reads are analyzed in input order,
+# so with --resume the partial csvs are truncated to their checkpointed size, and the reads before that
+# point are skipped without being analyzed. Read tables are streamed in the same way (see TeloBP.readTable).
+# With --profile, the workers return the profile of each read of a batch along with its results, and the
+# profiles are accumulated per sample in the main process. Only the reads analyzed by this run are profiled,
+# i.e. not the reads taken from the cache, skipped by --resume, or analyzed with --save_graphs.
 
 
 import os
-from Bio import SeqIO
-import gzip
+import csv
 import numpy as np
 import pandas as pd
 import multiprocessing as mp
-from pandarallel import pandarallel
+from collections import deque
+import queue
+import threading
+import time
 import sys
 import argparse
-from matplotlib.backends.backend_pdf import PdfPages
+import json
+import logging
 
 # sys.path.insert(0, '../TeloBP')
 from TeloBP import *
-# from constants import errorReturns
-errorReturns = {"init": -1, "fusedRead": -10,"strandType": -20, "seqNotFound": -1000}
+from TeloBP.seqReader import readSeqs, packSeqs, unpackSeqs, parsers
+from TeloBP.constants import errorReturns, prefilterEndLength as defaultPrefilterEndLength, resultCacheMaxEntries, \
+    alignmentEndDistance as defaultAlignmentEndDistance, defaultCoarseWindowStep
+from TeloBP.resultCache import ResultCache, parameterDigest, functionParameters, sequenceKey
+from TeloBP.readTable import ReadTableWriter, readTableFormats, readTableExtensions
+from TeloBP import profiling
+from TeloBP.qnameIndex import readTargetFastq
+from TeloBP.alignmentReader import readChromosomeEndReads, isAlignmentFile, alignmentExtensions, alignmentBackends
 
 teloNP = False
-pdf = PdfPages('teloGraphs.pdf')
+pdf = None
 showGraphsGlobal = False
 outputColNames = ["telomereLength", "isGStrand"]
+defaultChunkSize = 500
+defaultCheckpointInterval = 60
+checkpointFilename = "teloBPCheckpoint.json"
+checkpointVersion = 1
+seqParser = "fast"
+# prefilterEndLength, or None to analyze every read
+prefilterEndLength = None
+# Step of the coarse pass of the boundary search, or None to search at full resolution only
+coarseWindowStep = None
+# ResultCache of the run, or None
+resultCache = None
+# Format of the per-read tables ("parquet" or "arrow"), or None to only write the csvs
+readTableFormat = None
+# Reading of BAM/CRAM files, see TeloBP.alignmentReader
+alignmentEndDistance = defaultAlignmentEndDistance
+alignmentBackend = "auto"
+referenceFilename = None
+# Directory of the qname indexes of the fastqs used by targeted runs, or None to scan the fastqs without them,
+# see TeloBP.qnameIndex
+qnameIndexDir = None
+# sampleKey: ProfileAccumulator of the reads profiled in each sample, or None if the run isn't profiled
+sampleProfiles = None
+profileReportVersion = 1
+logFormat = "%(asctime)s %(levelname)s %(name)s: %(message)s"
 
 verbose = False
 
@@ -40,97 +130,517 @@ def vprint(*args, **kwargs):
     if verbose:
         print(*args, **kwargs)
 
-def rowToTeloBP(row, sampleKey, showGraphsGlobal):
-    import sys
-    sys.path.insert(0, '../TeloBP')
-    import numpy as np
+def readToTeloBoundary(qname, seq, sampleKey, readIsGStrand=None):
+    # Runs a single read in the main process, saving its graphs to the pdf
     import matplotlib.pyplot as plt
-    from TeloBP import getTeloBoundary
-    if row["seq"] is np.nan:
-        return errorReturns["seqNotFound"]
-    teloLength = -1
-    
-    pdfLocal = None
-    if showGraphsGlobal:
-        global pdf
-        plt.figure()
-        plt.text(0.5, 0.5, f'Sample Key: {sampleKey}, Qname: {row["qname"]}', ha='center', va='center', fontsize=12)
-        plt.axis('off')
-        pdf.savefig()  # Save the text figure
-        pdfLocal = pdf
-    teloLength = getTeloBoundary(row["seq"], showGraphs = showGraphsGlobal, pdf = pdfLocal)
-    return teloLength
-
-def rowToTeloNP(row, sampleKey, showGraphsGlobal):
-    import sys
-    sys.path.insert(0, '../TeloBP')
-    import numpy as np
-    import matplotlib.pyplot as plt
-    from TeloBP import getTeloNPBoundary
-    if row["seq"] is np.nan:
-        return errorReturns["seqNotFound"]
-    teloLength = -1
-
-    pdfLocal = None
-    if showGraphsGlobal:
-        plt.figure()
-        plt.text(0.5, 0.5, f'Sample Key: {sampleKey}, Qname: {row["qname"]}', ha='center', va='center', fontsize=9)
-        plt.axis('off')
-        pdf.savefig()  # Save the text figure
-        pdfLocal = pdf
-    teloLength, isGStrand = getTeloNPBoundary(row["seq"],showGraphs=showGraphsGlobal, pdf=pdfLocal)
-    return teloLength, isGStrand
-
-def process_sampleDf(sampleQnames, sampleKey, outputDir):
-    sampleDf = sampleQnames[sampleKey]
-    inputLen = len(sampleDf)
-    
-    # get current path
-    currentPath = os.path.dirname(os.path.realpath(__file__))
-    vprint(f"Current path: {currentPath}")
-
-    
-    if not showGraphsGlobal:
-        pandarallel.initialize(progress_bar=True)
+    plt.figure()
+    plt.text(0.5, 0.5, f'Sample Key: {sampleKey}, Qname: {qname}', ha='center', va='center', fontsize=9)
+    plt.axis('off')
+    pdf.savefig()  # Save the text figure
     if teloNP:
-        if showGraphsGlobal:
-            sampleDf['res'] = sampleDf.apply(rowToTeloNP, axis=1, args=(sampleKey, showGraphsGlobal))
-        else:
-            sampleDf['res'] = sampleDf.parallel_apply(rowToTeloNP, axis=1, args=(sampleKey, showGraphsGlobal))
+        return getTeloNPBoundary(seq, readIsGStrand, showGraphs=True, pdf=pdf)
+    return getTeloBoundary(seq, readIsGStrand, showGraphs=True, pdf=pdf)
+
+def processPackedSeqs(buffer, offsets, readStrands, useTeloNP, endLength=None, profile=False, coarseStep=None):
+    # Worker function: returns the telomere lengths and strands of a batch of reads packed by packSeqs, and
+    # if profile is set, the profile of each read (see BoundaryProfiler.readArrays), otherwise None.
+    # readStrands holds the known strand of each read (1 for the G strand, 0 for the C strand, -1 if unknown),
+    # or is None if no strand is known.
+    # If endLength is set, reads are prefiltered on the telomere repeats in their first and last endLength bases.
+    # coarseStep is the coarseWindowStep of the boundary search.
+    seqs = unpackSeqs(buffer, offsets)
+    batchFunction, batchArgs = batchParameters(useTeloNP, endLength, coarseStep)
+    if readStrands is not None:
+        batchArgs["isGStrand"] = [None if strand < 0 else bool(strand) for strand in readStrands.tolist()]
+    if not profile:
+        telomereLengths, isGStrand, _ = batchFunction(seqs, **batchArgs)
+        return telomereLengths, isGStrand, None
+    with profiling.profiled() as profiler:
+        telomereLengths, isGStrand, _ = batchFunction(seqs, **batchArgs)
+    return telomereLengths, isGStrand, profiler.readArrays()
+
+def batchParameters(useTeloNP, endLength, coarseStep=None):
+    # Returns the batch function run on the reads, and its arguments
+    batchArgs = {"prefilter": endLength is not None}
+    if endLength is not None:
+        batchArgs["prefilterEndLength"] = endLength
+    if coarseStep is not None:
+        batchArgs["coarseWindowStep"] = coarseStep
+    return (getTeloNPBoundaryBatch if useTeloNP else getTeloBoundaryBatch), batchArgs
+
+def processBatchWithGraphs(segments, seqs, readStrands, files):
+    telomereLengths = []
+    isGStrand = []
+    readIndex = 0
+    for fileIndex, qnames in segments:
+        for qname in qnames:
+            teloLength, readIsGStrand = readToTeloBoundary(qname, seqs[readIndex], files[fileIndex][1], readStrands[readIndex])
+            telomereLengths.append(teloLength)
+            isGStrand.append(-1 if readIsGStrand is None else int(readIsGStrand))
+            readIndex += 1
+    return telomereLengths, isGStrand, None
+
+def readFileSeqs(filename, parser="fast", remainingQnames=None):
+    # Yields (qname, sequence bytes, isGStrand) for the reads of a fastq file, whose strand isn't known (None),
+    # or for the chromosome end reads of a BAM/CRAM file.
+    # If remainingQnames is given, only the reads with these qnames are yielded, and they are removed from it as they
+    # are found, so the file is not read further once every target has been found in it.
+    if remainingQnames is not None and not isAlignmentFile(filename) and parser == "fast":
+        for qname, seq in readTargetFastq(filename, remainingQnames, qnameIndexDir):
+            yield qname, seq, None
+        return
+    if isAlignmentFile(filename):
+        reads = readChromosomeEndReads(filename, alignmentEndDistance, alignmentBackend, referenceFilename)
+    else:
+        reads = ((qname, seq, None) for qname, seq in readSeqs(filename, "fastq", parser))
+    for qname, seq, readIsGStrand in reads:
+        if remainingQnames is not None:
+            if not remainingQnames:
+                return
+            if qname not in remainingQnames:
+                continue
+            remainingQnames.discard(qname)
+        yield qname, seq, readIsGStrand
+
+def readBatches(files, chunkSize, targetQnames=None, parser="fast", fileStartTimes=None, skipReads=None):
+    # Yields batches of up to chunkSize reads from a list of (filename, sampleKey) fastq or BAM/CRAM files. Reads from
+    # consecutive files share a batch, so that small files don't leave workers idle. Each batch is
+    # (segments, seqs, readStrands, finishedFiles), where segments is a list of (fileIndex, qnames) in read order, seqs
+    # the sequence bytes of the reads, readStrands their known isGStrand (or None), and finishedFiles the indices of
+    # the files that end in this batch.
+    # If fileStartTimes is given, the time each file is opened is saved in it. skipReads maps file indices
+    # to the number of their first reads to skip, which were analyzed by a previous run.
+    # Each qname of targetQnames is read once per file, from the first record with it in the file.
+    segments = []
+    seqs = []
+    readStrands = []
+    finishedFiles = []
+    for fileIndex, (filename, _) in enumerate(files):
+        if fileStartTimes is not None:
+            fileStartTimes[fileIndex] = time.time()
+        qnames = []
+        segments.append((fileIndex, qnames))
+        toSkip = skipReads.get(fileIndex, 0) if skipReads is not None else 0
+        try:
+            remainingQnames = None if targetQnames is None else set(targetQnames)
+            for qname, seq, readIsGStrand in readFileSeqs(filename, parser, remainingQnames):
+                if toSkip > 0:
+                    toSkip -= 1
+                    continue
+                qnames.append(qname)
+                seqs.append(seq)
+                readStrands.append(readIsGStrand)
+                if len(seqs) >= chunkSize:
+                    yield segments, seqs, readStrands, finishedFiles
+                    qnames = []
+                    segments = [(fileIndex, qnames)]
+                    seqs = []
+                    readStrands = []
+                    finishedFiles = []
+        except Exception as e:
+            # The records read before the error are still analyzed
+            print(f"Error while reading file: {filename}")
+            print(e)
+        finishedFiles.append(fileIndex)
+    if len(seqs) > 0 or len(finishedFiles) > 0:
+        yield segments, seqs, readStrands, finishedFiles
+
+def prefetch(iterable, maxItems):
+    # Iterates over iterable in a background thread, keeping up to maxItems items ready. This lets the
+    # decompression and parsing of the input overlap with the main thread waiting on workers and writing output.
+    items = queue.Queue(maxItems)
+    stop = threading.Event()
+    end = object()
+
+    def fill():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((end, None))
+        except BaseException as e:
+            items.put((end, e))
+
+    thread = threading.Thread(target=fill, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+def imapBounded(pool, func, tasks, maxPending):
+    # Like pool.imap, but only reads ahead maxPending (key, args) tasks, so that memory stays bounded.
+    # Yields (key, result) pairs in task order.
+    pending = deque()
+    for key, args in tasks:
+        pending.append((key, pool.apply_async(func, args)))
+        if len(pending) >= maxPending:
+            key, result = pending.popleft()
+            yield key, result.get()
+    while pending:
+        key, result = pending.popleft()
+        yield key, result.get()
+
+def newSampleStats():
+    return {"totalReads": 0, "nonNegativeReads": 0, "totalReadLengths": 0, "initErrors": 0,
+            "fusedReadErrors": 0, "strandTypeErrors": 0, "noTelomereErrors": 0, "seqNotFound": 0,
+            "totalBases": 0, "seconds": 0.0}
+
+def updateSampleStats(stats, telomereLengths):
+    for teloLength in telomereLengths:
+        stats["totalReads"] += 1
+        if teloLength >= 0:
+            stats["nonNegativeReads"] += 1
+            stats["totalReadLengths"] += int(teloLength)
+        elif teloLength == errorReturns["init"]:
+            stats["initErrors"] += 1
+        elif teloLength == errorReturns["fusedRead"]:
+            stats["fusedReadErrors"] += 1
+        elif teloLength == errorReturns["strandType"]:
+            stats["strandTypeErrors"] += 1
+        elif teloLength == errorReturns["noTelomere"]:
+            stats["noTelomereErrors"] += 1
+        elif teloLength == errorReturns["seqNotFound"]:
+            stats["seqNotFound"] += 1
+
+class ProgressBar:
+    # Single line progress bar over all the input files, written to stderr when it is a terminal
+    def __init__(self, totalFiles, minInterval=0.5, width=30):
+        self.totalFiles = totalFiles
+        self.minInterval = minInterval
+        self.width = width
+        self.enabled = sys.stderr.isatty()
+        self.startTime = time.time()
+        self.lastDraw = 0
+        self.files = 0
+        self.reads = 0
+        self.bases = 0
+
+    def update(self, reads=0, bases=0, files=0):
+        self.reads += reads
+        self.bases += bases
+        self.files += files
+        now = time.time()
+        if self.enabled and now - self.lastDraw >= self.minInterval:
+            self.lastDraw = now
+            self.draw(now)
+
+    def draw(self, now):
+        fraction = self.files / self.totalFiles if self.totalFiles > 0 else 1
+        filled = int(fraction * self.width)
+        elapsed = max(now - self.startTime, 1e-9)
+        sys.stderr.write(f"\r[{'#' * filled}{'.' * (self.width - filled)}] files {self.files}/{self.totalFiles}, "
+                         f"{self.reads} reads, {self.reads / elapsed:.0f} reads/s, {self.bases / elapsed:.0f} bases/s")
+        sys.stderr.flush()
+
+    def close(self):
+        if self.enabled:
+            self.draw(time.time())
+            sys.stderr.write("\n")
+            sys.stderr.flush()
+
+def writeResultRows(csvWriter, qnames, telomereLengths, isGStrand):
+    # Only rows with a positive telomere length are saved, negative values are errors
+    for qname, teloLength, readIsGStrand in zip(qnames, telomereLengths, isGStrand):
+        if teloLength > 0:
+            csvWriter.writerow([qname, int(teloLength), bool(readIsGStrand)])
+
+def packedBatchTasks(batches, useTeloNP, endLength, cache=None, profile=False, coarseStep=None):
+    # Pairs the read metadata of each batch with the packed sequences sent to the workers. With a cache, only
+    # the reads that aren't cached are sent, and the metadata holds the (keys, cached results) of the batch.
+    # The known strands of the reads are sent as an int8 array, or None if no strand is known.
+    digests = {}
+    if cache is not None:
+        batchFunction, batchArgs = batchParameters(useTeloNP, endLength, coarseStep)
+        params = functionParameters(batchFunction, **batchArgs)
+        # The strand of a read is part of its key, as in cachedBatch
+        digests = {strand: parameterDigest(batchFunction.__name__, dict(params, isGStrand=strand)) for strand in (None, True, False)}
+    for segments, seqs, readStrands, finishedFiles in batches:
+        readLengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        cacheEntry = None
+        if cache is not None:
+            keys = [sequenceKey(seq, digests[readIsGStrand]) for seq, readIsGStrand in zip(seqs, readStrands)]
+            cached = cache.get(keys)
+            seqs = [seq for seq, result in zip(seqs, cached) if result is None]
+            readStrands = [readIsGStrand for readIsGStrand, result in zip(readStrands, cached) if result is None]
+            cacheEntry = (keys, cached)
+        strandArray = None
+        if any(readIsGStrand is not None for readIsGStrand in readStrands):
+            strandArray = np.array([-1 if readIsGStrand is None else int(readIsGStrand) for readIsGStrand in readStrands], dtype=np.int8)
+        buffer, offsets = packSeqs(seqs)
+        yield (segments, finishedFiles, readLengths, cacheEntry), (buffer, offsets, strandArray, useTeloNP, endLength, profile, coarseStep)
+
+def mergeCachedResults(cache, cacheEntry, telomereLengths, isGStrand):
+    # Returns the results of a whole batch from its cached results and the worker results of the other reads,
+    # which are added to the cache
+    keys, cached = cacheEntry
+    missing = [i for i, result in enumerate(cached) if result is None]
+    cache.put([keys[i] for i in missing], telomereLengths, isGStrand)
+    allLengths = np.empty(len(keys), dtype=np.int64)
+    allStrands = np.empty(len(keys), dtype=np.int8)
+    allLengths[missing] = telomereLengths
+    allStrands[missing] = isGStrand
+    for i, result in enumerate(cached):
+        if result is not None:
+            allLengths[i], allStrands[i] = result
+    return allLengths, allStrands
+
+def addSegmentProfile(accumulator, readProfile, cacheEntry, start, end):
+    # Adds the profiles of the reads start to end of a batch. The profiles only cover the reads sent to the
+    # workers, so with a cache, the profile rows of the segment are found from the positions of the cache misses.
+    if cacheEntry is None:
+        accumulator.add(profiling.selectReads(readProfile, slice(start, end)))
+        return
+    missing = np.array([i for i, result in enumerate(cacheEntry[1]) if result is None], dtype=np.int64)
+    firstRow, lastRow = np.searchsorted(missing, [start, end])
+    accumulator.add(profiling.selectReads(readProfile, slice(firstRow, lastRow)), cachedReads=int((end - start) - (lastRow - firstRow)))
+
+def fileSignature(filename):
+    # Size and modification time of an input file, so a checkpoint isn't resumed on a file that changed
+    fileStat = os.stat(filename)
+    return [fileStat.st_size, fileStat.st_mtime_ns]
+
+def newCheckpoint(parameters):
+    # parameters are the run settings that change the output, which must be the same to resume the run
+    return {"version": checkpointVersion, "parameters": parameters, "files": {}}
+
+def loadCheckpoint(outputDir, parameters):
+    # Returns the checkpoint of a previous run in outputDir, or a new checkpoint if there is none
+    checkpointPath = os.path.join(outputDir, checkpointFilename)
+    if not os.path.exists(checkpointPath):
+        print(f"No checkpoint found in {outputDir}, starting a new run")
+        return newCheckpoint(parameters)
+    with open(checkpointPath) as checkpointFile:
+        checkpoint = json.load(checkpointFile)
+    if checkpoint.get("version") != checkpointVersion:
+        raise ValueError(f"The checkpoint in {outputDir} was written by another version of teloBPCmd.py, run without --resume to start over")
+    if checkpoint["parameters"] != parameters:
+        raise ValueError(f"The checkpoint in {outputDir} is for a run with different settings ({checkpoint['parameters']}), "
+                         f"run with the same settings or without --resume to start over")
+    return checkpoint
+
+def writeCheckpoint(outputDir, checkpoint):
+    # The checkpoint is written to a temporary file which replaces the previous one, so it's never left half written
+    os.makedirs(outputDir, exist_ok=True)
+    checkpointPath = os.path.join(outputDir, checkpointFilename)
+    with open(checkpointPath + ".tmp", "w") as checkpointFile:
+        json.dump(checkpoint, checkpointFile)
+        checkpointFile.flush()
+        os.fsync(checkpointFile.fileno())
+    os.replace(checkpointPath + ".tmp", checkpointPath)
+
+def resumeFiles(files, outputDir, checkpoint):
+    # Splits the (filename, sampleKey) files into those completed by the checkpointed run, returning the stats of
+    # their samples, and those still to analyze, with the checkpoint entry of the ones to continue (or None)
+    outputExtensions = [".csv"] + ([readTableExtensions[readTableFormat]] if readTableFormat is not None else [])
+    completedStats = {}
+    pendingFiles = []
+    resumeEntries = []
+    for filename, sampleKey in files:
+        entry = checkpoint["files"].get(filename)
+        if entry is not None and (entry["signature"] != fileSignature(filename) or entry["sampleKey"] != sampleKey):
+            vprint(f"{filename} changed since it was checkpointed, analyzing it again")
+            entry = None
+        if entry is not None and entry["complete"]:
+            if entry["stats"] is None:
+                continue
+            if all(os.path.exists(os.path.join(outputDir, sampleKey + extension)) for extension in outputExtensions):
+                completedStats[sampleKey] = entry["stats"]
+                continue
+            entry = None
+        if entry is not None and not all(os.path.exists(os.path.join(outputDir, sampleKey + extension + ".partial")) for extension in outputExtensions):
+            entry = None
+        pendingFiles.append((filename, sampleKey))
+        resumeEntries.append(entry)
+    return completedStats, pendingFiles, resumeEntries
+
+def process_sampleFiles(files, outputDir, pool, numWorkers, chunkSize, targetQnames=None, checkpoint=None,
+                        resumeEntries=None, checkpointInterval=defaultCheckpointInterval):
+    # Streams the reads of a list of (filename, sampleKey) fastq files through the workers, writing the results
+    # of each file to outputDir/sampleKey.csv. At most 2 batches per worker are in memory at a time.
+    # The files are read in a background thread, so reading the next batches overlaps with the workers
+    # analyzing the current ones and the main thread writing the results of the previous ones.
+    # If checkpoint is given, the csvs are written as partial files, the progress is saved in it every
+    # checkpointInterval seconds, and resumeEntries holds the checkpoint entry of each file to continue from (or None).
+    # Otherwise the csvs are written directly and no checkpoint is saved.
+    # Returns the stats of every sample with records.
+    partialExtension = "" if checkpoint is None else ".partial"
+    if resumeEntries is None:
+        resumeEntries = [None] * len(files)
+    skipReads = {fileIndex: entry["stats"]["totalReads"] for fileIndex, entry in enumerate(resumeEntries) if entry is not None}
+    fileStartTimes = [None] * len(files)
+    batches = readBatches(files, chunkSize, targetQnames, seqParser, fileStartTimes, skipReads)
+    if showGraphsGlobal:
+        results = (((segments, finishedFiles, [len(seq) for seq in seqs], None), processBatchWithGraphs(segments, seqs, readStrands, files)) for segments, seqs, readStrands, finishedFiles in batches)
     else:
-        sampleDf['res'] = sampleDf.parallel_apply(rowToTeloBP,axis=1, args=(sampleKey, showGraphsGlobal))
-
-    vprint(f"inputLen: {inputLen}")
-    vprint(f"outputLen: {len(sampleDf)}")
-    if inputLen != len(sampleDf):
-        print(f"Error: starting length of {inputLen} does not match output table length {len(sampleDf)}")
-
-    sampleDf[outputColNames] = pd.DataFrame(sampleDf['res'].tolist(), index=sampleDf.index)
-    sampleDf = sampleDf.drop('res', axis=1)
-    # save the output to a csv file. 
-    # Note that the seq column is removed from the table before saving 
-    sampleDf = sampleDf.drop(columns=["seq"])
-    
-    saveDfNoNeg(sampleDf, outputColNames[0], outputDir, sampleKey)
-    return sampleDf
-
-def process_data(df):
-    global teloNP
-    df[outputColNames[0]] = df.apply(lambda row: rowToTeloBP(row, teloNP), axis=1)
-    return df
-
-def saveDfNoNeg(df, outputColName, outputDir, sampleKey):
-    dfNoNeg = df[df[outputColName] > 0] # drops row with negative vals (i.e., errors)
-    dfNoNeg.reset_index(drop=True, inplace=True)
-    # create outdir if it doesn't exist
-    if not os.path.exists(outputDir):
-        os.makedirs(outputDir)
-    dfNoNeg.to_csv(f"{outputDir}/{sampleKey}.csv", index=False)
+        tasks = packedBatchTasks(prefetch(batches, 2 * numWorkers), teloNP, prefilterEndLength, resultCache, sampleProfiles is not None, coarseWindowStep)
+        results = imapBounded(pool, processPackedSeqs, tasks, 2 * numWorkers)
+    progress = ProgressBar(len(files))
+
+    sampleStats = {}
+    # fileIndex: (outputFile, csvWriter, stats, tableWriter) for the files being written
+    outputs = {}
+
+    def openOutput(fileIndex):
+        # Opens the partial csv (and read table) of a file, truncated to its checkpointed size when it's resumed
+        os.makedirs(outputDir, exist_ok=True)
+        partialPath = f"{outputDir}/{files[fileIndex][1]}.csv{partialExtension}"
+        entry = resumeEntries[fileIndex]
+        tableWriter = None
+        if readTableFormat is not None:
+            tablePath = f"{outputDir}/{files[fileIndex][1]}{readTableExtensions[readTableFormat]}"
+            tableWriter = ReadTableWriter(tablePath, readTableFormat, None if entry is None else entry["tableBytes"])
+        if entry is not None:
+            os.truncate(partialPath, entry["csvBytes"])
+            outputFile = open(partialPath, "a", newline="")
+            csvWriter = csv.writer(outputFile, lineterminator="\n")
+            stats = dict(entry["stats"])
+        else:
+            outputFile = open(partialPath, "w", newline="")
+            csvWriter = csv.writer(outputFile, lineterminator="\n")
+            csvWriter.writerow(["qname"] + outputColNames)
+            stats = newSampleStats()
+        outputs[fileIndex] = (outputFile, csvWriter, stats, tableWriter)
+
+    def recordFile(filename, entry, save=True):
+        # Sets the checkpoint entry of a file, and saves the checkpoint if save is set
+        if checkpoint is None:
+            return
+        checkpoint["files"][filename] = entry
+        if save:
+            writeCheckpoint(outputDir, checkpoint)
+
+    def saveCheckpoint():
+        # Records the reads written so far for every open file. The csvs are synced first, so the checkpoint
+        # never counts rows that aren't on disk.
+        if checkpoint is None:
+            return
+        now = time.time()
+        for fileIndex, (outputFile, _, stats, tableWriter) in outputs.items():
+            outputFile.flush()
+            os.fsync(outputFile.fileno())
+            filename, sampleKey = files[fileIndex]
+            entryStats = dict(stats, seconds=stats["seconds"] + now - fileStartTimes[fileIndex])
+            checkpoint["files"][filename] = {"sampleKey": sampleKey, "signature": fileSignature(filename), "complete": False,
+                                             "csvBytes": os.fstat(outputFile.fileno()).st_size, "stats": entryStats,
+                                             "tableBytes": None if tableWriter is None else tableWriter.checkpoint()}
+        writeCheckpoint(outputDir, checkpoint)
+
+    lastCheckpoint = time.time()
+    try:
+        for (segments, finishedFiles, readLengths, cacheEntry), (telomereLengths, isGStrand, readProfile) in results:
+            if cacheEntry is not None:
+                telomereLengths, isGStrand = mergeCachedResults(resultCache, cacheEntry, telomereLengths, isGStrand)
+            start = 0
+            for fileIndex, qnames in segments:
+                end = start + len(qnames)
+                numBases = int(np.sum(readLengths[start:end]))
+                if len(qnames) > 0:
+                    if fileIndex not in outputs:
+                        openOutput(fileIndex)
+                    _, csvWriter, stats, tableWriter = outputs[fileIndex]
+                    writeResultRows(csvWriter, qnames, telomereLengths[start:end], isGStrand[start:end])
+                    if tableWriter is not None:
+                        tableWriter.write(qnames, files[fileIndex][1], readLengths[start:end], telomereLengths[start:end], isGStrand[start:end])
+                    updateSampleStats(stats, telomereLengths[start:end])
+                    stats["totalBases"] += numBases
+                    if readProfile is not None:
+                        sampleKey = files[fileIndex][1]
+                        if sampleKey not in sampleProfiles:
+                            sampleProfiles[sampleKey] = profiling.ProfileAccumulator()
+                        addSegmentProfile(sampleProfiles[sampleKey], readProfile, cacheEntry, start, end)
+                progress.update(reads=len(qnames), bases=numBases)
+                start = end
+
+                # Every file has a segment in the batch it ends in, so it's closed before the next file is written
+                if fileIndex in finishedFiles:
+                    filename, sampleKey = files[fileIndex]
+                    progress.update(files=1)
+                    if fileIndex not in outputs and resumeEntries[fileIndex] is not None:
+                        # All the reads of a resumed file were analyzed before the run was interrupted
+                        openOutput(fileIndex)
+                    if fileIndex not in outputs:
+                        vprint(f"No records in file: {filename}")
+                        recordFile(filename, {"sampleKey": sampleKey, "signature": fileSignature(filename),
+                                              "complete": True, "csvBytes": 0, "stats": None, "tableBytes": None})
+                        continue
+                    outputFile, _, stats, tableWriter = outputs.pop(fileIndex)
+                    outputFile.flush()
+                    os.fsync(outputFile.fileno())
+                    outputFile.close()
+                    if tableWriter is not None:
+                        tableWriter.close()
+                    if checkpoint is not None:
+                        # The complete csv replaces any previous output in one step
+                        os.replace(f"{outputDir}/{sampleKey}.csv.partial", f"{outputDir}/{sampleKey}.csv")
+                    stats["seconds"] += time.time() - fileStartTimes[fileIndex]
+                    sampleStats[sampleKey] = stats
+                    recordFile(filename, {"sampleKey": sampleKey, "signature": fileSignature(filename),
+                                          "complete": True, "csvBytes": 0, "stats": stats, "tableBytes": None}, save=False)
+                    saveCheckpoint()
+                    lastCheckpoint = time.time()
+
+            if time.time() - lastCheckpoint >= checkpointInterval:
+                saveCheckpoint()
+                lastCheckpoint = time.time()
+    finally:
+        for outputFile, _, _, tableWriter in outputs.values():
+            outputFile.close()
+            if tableWriter is not None:
+                tableWriter.abort()
+        progress.close()
+    return sampleStats
+
+def writeProfileReport(profilePath, sampleProfiles):
+    # Saves the profile of each sample, and of all of them, as json
+    total = profiling.ProfileAccumulator()
+    for accumulator in sampleProfiles.values():
+        total.merge(accumulator)
+    report = {"version": profileReportVersion, "stages": list(profiling.profileStages), "total": total.report(),
+              "samples": {sampleKey: accumulator.report() for sampleKey, accumulator in sampleProfiles.items()}}
+    with open(profilePath, "w") as profileFile:
+        json.dump(report, profileFile, indent=1)
+    stageSeconds = report["total"]["stageSeconds"]
+    print(f"Profile: {total.reads} reads in {total.seconds:.2f}s of worker time (" +
+          ", ".join(f"{name} {seconds:.2f}s" for name, seconds in stageSeconds.items()) + f"), saved to {profilePath}")
+
+def configureWorkerLogging(level):
+    # Pool initializer: workers started with the spawn method don't inherit the logging configuration of the main process
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=level, format=logFormat)
+
+def printThroughput(sampleStats):
+    # Prints the reads/s and bases/s of each file, from the time it was opened to the time its output was closed
+    print("Throughput:")
+    for sampleKey, stats in sampleStats.items():
+        seconds = max(stats["seconds"], 1e-9)
+        print(f"{sampleKey}: {stats['totalReads']} reads, {stats['totalBases']} bases in {stats['seconds']:.2f}s "
+              f"({stats['totalReads'] / seconds:.1f} reads/s, {stats['totalBases'] / seconds:.0f} bases/s)")
 
 # def run_analysis(dataDir, fileMode, teloNP, outputDir, progressLabel, output_frame):
-def run_analysis(dataDir, fileMode, teloNPIn, outputDir, save_graphs=False, targetQnamesCSV=None):
-    global teloNP 
+def run_analysis(dataDir, fileMode, teloNPIn, outputDir, save_graphs=False, targetQnamesCSV=None, chunkSize=defaultChunkSize, parser="fast", prefilterEndLengthIn=None, workers=None, cacheDir=None, cacheMaxEntries=resultCacheMaxEntries, resume=False, checkpointing=False, checkpointInterval=defaultCheckpointInterval, readTable=None, profile=None, alignmentEndDistanceIn=defaultAlignmentEndDistance, alignmentBackendIn="auto", reference=None, qnameIndex=True, coarseWindowStepIn=None):
+    global teloNP, seqParser, prefilterEndLength, resultCache, readTableFormat, sampleProfiles, alignmentEndDistance, alignmentBackend, referenceFilename, qnameIndexDir, coarseWindowStep
+    qnameIndexDir = os.path.join(cacheDir, "qnameIndexes") if qnameIndex and cacheDir is not None else None
+    coarseWindowStep = coarseWindowStepIn
     teloNP = teloNPIn
+    alignmentEndDistance = alignmentEndDistanceIn
+    alignmentBackend = alignmentBackendIn
+    referenceFilename = reference
+    seqParser = parser
+    prefilterEndLength = prefilterEndLengthIn
+    readTableFormat = readTable
     # commented out
     # if teloNP:
     #     global outputColName
@@ -146,161 +656,135 @@ def run_analysis(dataDir, fileMode, teloNPIn, outputDir, save_graphs=False, targ
         print("WARNING: save_graphs flag is set but no targetQnamesCSV file is provided. This configuration would likely crash the program, so the save_graphs flag will be set to False. If this was your intention, please modify the code.")
         save_graphs = False
     elif targetQnamesCSV is not None and save_graphs:
-        global showGraphsGlobal
+        global showGraphsGlobal, pdf
+        from matplotlib.backends.backend_pdf import PdfPages
         showGraphsGlobal = True
-    
+        pdf = PdfPages('teloGraphs.pdf')
+
     targetQnames = None
     if targetQnamesCSV is not None:
         targetQnames = pd.read_csv(targetQnamesCSV, header=None)
-        targetQnames = set(targetQnames[0].to_list())
-    
+        targetQnames = set(str(qname) for qname in targetQnames[0].to_list())
+
     filenames = []
-    sampleQnames = {}
 
     if not fileMode:
         for root, dirs, files in os.walk(dataDir):
             for filename in files:
-                if filename.endswith(".gz") or filename.endswith(".fastq"):
+                if filename.endswith(".gz") or filename.endswith(".fastq") or isAlignmentFile(filename):
                     filenames.append(os.path.join(root, filename))
     else:
         filenames.append(dataDir)
 
     # progressLabel.config(text=f"Loading fastq files...")
     vprint(f"filenames: {filenames}")
-    
-    totalFiles = len(filenames)
-    count = 0
+
+    files = []
     for filename in filenames:
-        if not filename.endswith(".gz") and not filename.endswith(".fastq"):
+        if not filename.endswith("fastq.gz") and not filename.endswith(".fastq") and not isAlignmentFile(filename):
             continue
 
         sampleKey = "_".join(filename.split("/")[-1].split("\\")[-1].split(".")[:-1]).replace(" ", "_")
         vprint(f"sampling key: {sampleKey}")
-
-        qnameTeloValues = []
-        #file = os.path.join(root, filename)
-        file = filename
-        # vprint(file)
-        if filename.endswith("fastq.gz"):
-            with gzip.open(file,"rt") as handle:
-                records = SeqIO.parse(handle,"fastq")
-                for record in records:
-                    if targetQnames is not None and record.id not in targetQnames:
-                        continue
-                    print(record.id)
-                    qnameTeloValues.append([record.id, record.seq])
-        elif filename.endswith("fastq"):
-            try:
-                for record in SeqIO.parse(file,"fastq"):
-                    if targetQnames is not None and record.id not in targetQnames:
-                        continue
-                    print(record.id)
-                    qnameTeloValues.append([record.id, record.seq])
-            except Exception as e:
-                print(f"Error while reading file: {file}")
-                print(e)
-        else: 
-            continue
-
-        qnameTeloValuesDf = pd.DataFrame(qnameTeloValues, columns = ["qname", "seq"])
-        print(qnameTeloValuesDf)
-
-        if len(qnameTeloValuesDf) == 0:
-            vprint(f"No records in file: {file}")
-            continue
-
-        #sampleQnames[sampleKey] = pd.merge(sampleDf, qnameTeloValuesDf, on='qname', how='left')
-        sampleQnames[sampleKey] = qnameTeloValuesDf
-
-        sampleQnames[sampleKey] = process_sampleDf(sampleQnames, sampleKey, outputDir)
-
-        count += 1
-        
-        # progressLabel.config(text=f"Loading fastq files... ({count}/{totalFiles})")
-
-    # The following code does not work at the moment. 
-    # else:
-    #     vprint("RUNNING MULTI-PROCESSING")
-    #     count = 0
-    #     def process_table(sampleKey):
-    #         sampleDf = sampleQnames[sampleKey]
-            
-    #         # Apply the function to each row
-    #         sampleDf[outputColNames[0]] = sampleDf.apply(lambda row: rowToTeloBP(row, teloNP), axis=1)
-
-    #         # Note that the seq column is removed from the table before saving 
-    #         sampleDf = sampleDf.drop(columns=["seq"])
-    #         sampleQnames[sampleKey] = sampleDf
-
-    #         # Save the output to a csv file. 
-    #         saveDfNoNeg(sampleDf, outputColNames[0], outputDir, sampleKey)
-    #         nonlocal count
-    #         count += 1
-    #         # progressLabel.config(text=f"Processing tables... ({count}/{totalFiles})")
-
-    #     vprint(f"******************** Multiprocessing {len(sampleQnames.keys())} tables ********************")
-    #     vprint(f"Number of CPUs: {mp.cpu_count()}")
-
-    #     # Create a pool of processes
-    #     with mp.Pool(mp.cpu_count()) as pool:
-    #         pool.map(process_table, sampleQnames.keys())
+        files.append((filename, sampleKey))
+
+    # Only the settings that change the output csvs have to match to resume a run
+    checkpointParameters = {"teloNP": bool(teloNP), "prefilterEndLength": prefilterEndLength, "targetQnamesCSV": targetQnamesCSV,
+                            "readTable": readTableFormat, "alignmentEndDistance": alignmentEndDistance, "coarseWindowStep": coarseWindowStep}
+    checkpoint = None
+    completedStats, resumeEntries = {}, None
+    if resume:
+        checkpoint = loadCheckpoint(outputDir, checkpointParameters)
+        completedStats, files, resumeEntries = resumeFiles(files, outputDir, checkpoint)
+        print(f"Resuming: {len(completedStats)} files already complete, {sum(entry is not None for entry in resumeEntries)} files partly analyzed")
+    elif checkpointing:
+        checkpoint = newCheckpoint(checkpointParameters)
+
+    numWorkers = workers if workers is not None else mp.cpu_count()
+    # Graphs are made by running every read, so the cache isn't used with save_graphs
+    if cacheDir is not None and not showGraphsGlobal:
+        resultCache = ResultCache(cacheDir, cacheMaxEntries)
+    sampleProfiles = None if profile is None else {}
+    # The pool is created once, and shared by all the files
+    pool = None if showGraphsGlobal else mp.Pool(numWorkers, initializer=configureWorkerLogging, initargs=(logging.getLogger().level,))
+    try:
+        sampleStats = process_sampleFiles(files, outputDir, pool, numWorkers, chunkSize, targetQnames, checkpoint, resumeEntries, checkpointInterval)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if resultCache is not None:
+            print(f"Result cache: {resultCache.hits} hits, {resultCache.misses} misses")
+            resultCache.close()
+            resultCache = None
 
     # Save pdf
-    pdf.close()
+    if pdf is not None:
+        pdf.close()
 
     # ********** Stats **********
 
+    printThroughput(sampleStats)
+    if profile is not None:
+        writeProfileReport(profile, sampleProfiles)
+        sampleProfiles = None
+    sampleStats = dict(completedStats, **sampleStats)
+
     totalReads = 0
     totalReadLengths = 0
     nonNegativeReads = 0
     initErrors = 0
     fusedReadErrors = 0
     strandTypeErrors = 0
+    noTelomereErrors = 0
     seqNotFound = 0
 
 
-    # go through table and see how many lengths are less than 0
-    for sampleKey in sampleQnames.keys():
-        sampleDf = sampleQnames[sampleKey]
-        sampleTotalReads = len(sampleDf)
-        sampleNonNegativeReads = len(sampleDf[sampleDf[outputColNames[0]] >= 0])
-        sampleInitErrors = len(sampleDf[sampleDf[outputColNames[0]] == errorReturns["init"]])
-        sampleFusedReadErrors = len(sampleDf[sampleDf[outputColNames[0]] == errorReturns["fusedRead"]])
-        sampleStrandTypeErrors = len(sampleDf[sampleDf[outputColNames[0]] == errorReturns["strandType"]])
-        sampleSeqNotFound = len(sampleDf[sampleDf[outputColNames[0]] == errorReturns["seqNotFound"]])
+    # go through the sample stats and see how many lengths are less than 0
+    for sampleKey in sampleStats.keys():
+        stats = sampleStats[sampleKey]
 
         vprint(f"Sample: {sampleKey}")
-        vprint(f"Average teloBP length: {sampleDf[sampleDf[outputColNames[0]] >= 0][outputColNames[0]].mean()}")
-
-        vprint(f"\nTotal reads (including errors): {sampleTotalReads}")
-        vprint(f"Reads without errors: {sampleNonNegativeReads}")
-        vprint(f"Initialization errors: {sampleInitErrors}")
-        vprint(f"Fused read errors: {sampleFusedReadErrors}")
-        vprint(f"Strand type errors: {sampleStrandTypeErrors}") 
-        vprint(f"Seq not found errors: {sampleSeqNotFound}")
-
-        totalReads += sampleTotalReads
-        totalReadLengths += sampleDf[sampleDf[outputColNames[0]] >= 0][outputColNames[0]].sum()
-        nonNegativeReads += sampleNonNegativeReads
-        initErrors += sampleInitErrors
-        fusedReadErrors += sampleFusedReadErrors
-        strandTypeErrors += sampleStrandTypeErrors
-        seqNotFound += sampleSeqNotFound
+        sampleAverage = stats["totalReadLengths"] / stats["nonNegativeReads"] if stats["nonNegativeReads"] > 0 else float("nan")
+        vprint(f"Average teloBP length: {sampleAverage}")
+
+        vprint(f"\nTotal reads (including errors): {stats['totalReads']}")
+        vprint(f"Reads without errors: {stats['nonNegativeReads']}")
+        vprint(f"Initialization errors: {stats['initErrors']}")
+        vprint(f"Fused read errors: {stats['fusedReadErrors']}")
+        vprint(f"Strand type errors: {stats['strandTypeErrors']}")
+        vprint(f"No telomere errors: {stats['noTelomereErrors']}")
+        vprint(f"Seq not found errors: {stats['seqNotFound']}")
+
+        totalReads += stats["totalReads"]
+        totalReadLengths += stats["totalReadLengths"]
+        nonNegativeReads += stats["nonNegativeReads"]
+        initErrors += stats["initErrors"]
+        fusedReadErrors += stats["fusedReadErrors"]
+        strandTypeErrors += stats["strandTypeErrors"]
+        noTelomereErrors += stats["noTelomereErrors"]
+        seqNotFound += stats["seqNotFound"]
 
     if nonNegativeReads == 0:
         avgTeloBP = 0
     else:
         avgTeloBP = totalReadLengths / nonNegativeReads
 
-    if totalReads == (nonNegativeReads + initErrors + fusedReadErrors + strandTypeErrors + seqNotFound):
+    # The failed reads are only counted, see --logLevel DEBUG for the reason of each failure
+    failedReads = totalReads - nonNegativeReads
+    print(f"Failed reads: {failedReads} of {totalReads} (initialization: {initErrors}, fused read: {fusedReadErrors}, "
+          f"strand type: {strandTypeErrors}, no telomere: {noTelomereErrors}, seq not found: {seqNotFound})")
+
+    if totalReads == (nonNegativeReads + initErrors + fusedReadErrors + strandTypeErrors + noTelomereErrors + seqNotFound):
         vprint("Total reads match")
-    else: 
+    else:
         print(f"Total reads: {totalReads}")
         print(f"Average telo length: {avgTeloBP}")
         print(f"Non-negative reads: {nonNegativeReads}")
         print(f"Initialization errors: {initErrors}")
         print(f"Fused read errors: {fusedReadErrors}")
         print(f"Strand type errors: {strandTypeErrors}")
+        print(f"No telomere errors: {noTelomereErrors}")
         print(f"Seq not found errors: {seqNotFound}")
 
         raise Warning("Error: Total reads do not match. Likely a script error.")
@@ -316,7 +800,7 @@ def run_analysis(dataDir, fileMode, teloNPIn, outputDir, save_graphs=False, targ
     #     f"Initialization errors: {initErrors}\n" + \
     #     f"Fused read errors: {fusedReadErrors}\n" + \
     #     f"Strand type errors: {strandTypeErrors}\n" + \
-    #     f"Seq not found errors: {seqNotFound}\n" 
+    #     f"Seq not found errors: {seqNotFound}\n"
 
     # graph(labels, sizes, colors, outputText, output_frame)
 
@@ -334,13 +818,32 @@ if __name__ == "__main__":
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     parser.add_argument('--save_graphs', action='store_true', help='Flag to indicate whether to save graphs')
     parser.add_argument('--targetQnamesCSV', type=str, help='Path to an input csv that has the qnammes we want to test')  # Optional argument for input file
-    
+    parser.add_argument('--noQnameIndex', action='store_true', help='With --targetQnamesCSV and --cacheDir, do not use or save the qname indexes of the fastq files')
+    parser.add_argument('--chunkSize', type=int, default=defaultChunkSize, help='Number of reads sent to a worker at a time')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: the number of CPUs)')
+    parser.add_argument('--prefilter', action='store_true', help='Reject reads without telomere repeats at their ends before the boundary search')
+    parser.add_argument('--prefilterEndLength', type=int, default=defaultPrefilterEndLength, help='Number of bases at each read end checked for telomere repeats by the prefilter')
+    parser.add_argument('--parser', type=str, choices=parsers, default="fast", help='fastq reader: "fast" skips building Bio.SeqIO records, "biopython" uses Bio.SeqIO')
+    parser.add_argument('--cacheDir', '--cache-dir', dest='cacheDir', type=str, default=None, help='Directory of a result cache, reads analyzed before with the same parameters are not analyzed again')
+    parser.add_argument('--readTable', type=str, choices=readTableFormats, default=None, help='Also write a table of every analyzed read, with its read length, strand and error code, in this format (requires pyarrow)')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run in outputDir, skipping the files and reads it already analyzed')
+    parser.add_argument('--checkpoint', action='store_true', help='Save the progress of the run, so that it can be continued with --resume')
+    parser.add_argument('--checkpointInterval', type=float, default=defaultCheckpointInterval, help='Seconds between checkpoints of the progress of the run')
+    parser.add_argument('--cacheMaxEntries', type=int, default=resultCacheMaxEntries, help='Number of reads kept in the result cache')
+    parser.add_argument('--alignmentEndDistance', type=int, default=defaultAlignmentEndDistance, help='Analyze the reads of BAM/CRAM files aligned within this many bases of a chromosome end')
+    parser.add_argument('--alignmentBackend', type=str, choices=alignmentBackends, default="auto", help='BAM/CRAM reader: "python" for the pure Python BAM reader, "pysam" (needed for CRAM), or "auto" to use pysam if it is installed')
+    parser.add_argument('--reference', type=str, default=None, help='Reference fasta of the CRAM files, if it is not found from their header')
+    parser.add_argument('--logLevel', type=str, choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="WARNING", help='Level of the log messages shown, failed reads are logged at the DEBUG level')
+    parser.add_argument('--coarseWindowStep', type=int, nargs='?', const=defaultCoarseWindowStep, default=None, help=f'Search for the boundary of long reads on windows this many bases apart first (default {defaultCoarseWindowStep} if given without a value), then at full resolution around it')
+    parser.add_argument('--profile', type=str, default=None, help='Path of a json report of the time spent in each stage of the boundary search')
+
     # parser.add_argument('--progressLabel', type=str, help='Progress label')
 
     # Parse the command line arguments
     args = parser.parse_args()
     verbose = args.verbose
+    logging.basicConfig(level=args.logLevel, format=logFormat)
 
     # Call the run_analysis function with the parsed arguments
-    run_analysis(args.dataDir, args.fileMode, args.teloNP, args.outputDir, save_graphs=args.save_graphs, targetQnamesCSV=args.targetQnamesCSV)
+    run_analysis(args.dataDir, args.fileMode, args.teloNP, args.outputDir, save_graphs=args.save_graphs, targetQnamesCSV=args.targetQnamesCSV, chunkSize=args.chunkSize, parser=args.parser, prefilterEndLengthIn=args.prefilterEndLength if args.prefilter else None, workers=args.workers, cacheDir=args.cacheDir, cacheMaxEntries=args.cacheMaxEntries, resume=args.resume, checkpointing=args.checkpoint, checkpointInterval=args.checkpointInterval, readTable=args.readTable, profile=args.profile, alignmentEndDistanceIn=args.alignmentEndDistance, alignmentBackendIn=args.alignmentBackend, reference=args.reference, qnameIndex=not args.noQnameIndex, coarseWindowStepIn=args.coarseWindowStep)
     # run_analysis("../data", False, True, "../output", None, None)
@@ -1,20 +1,32 @@
 # This script is used to trim the reference genome, removing the telomeric regions.
 # Example input: python .\trimGenome.py "../Data/ncbi_dataset/data/GCA_009914755.4/GCA_009914755.4_T2T-CHM13v2.0_genomic.fna" "../outputs/trimmedGenome/GCA_009914755.4_T2T-CHM13v2.0_genomic.NoTelo.fna"
 
-import sys
+import argparse
+import contextlib
+import multiprocessing as mp
 
 # sys.path.insert(0, '..\TeloBP')
 
 from TeloBP import trimTeloReferenceGenome
+from TeloBP.seqReader import parsers
+from TeloBP.resultCache import ResultCache
+from TeloBP.constants import resultCacheMaxEntries
 
-# Check if the correct number of arguments were passed
-if len(sys.argv) < 3 or len(sys.argv) > 4:
-    print("Usage: python trimGenome.py <reference genome> <output file> [output bed file]")
-    sys.exit()
-    
-bedFileOutput = sys.argv[3] if len(sys.argv) == 4 else None
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Trims the telomeric regions from a reference genome')
+    parser.add_argument('referenceGenome', type=str, help='Path to the reference genome fasta')
+    parser.add_argument('outputFile', type=str, help='Path to the trimmed output fasta')
+    parser.add_argument('outputBedFile', type=str, nargs='?', default=None, help='Optional path to an output bed file of the telomere boundaries')
+    parser.add_argument('--parser', type=str, choices=parsers, default="fast", help='fasta reader: "fast" or "biopython" (Bio.SeqIO)')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), help='Number of chromosomes analyzed in parallel (default: the number of CPUs)')
+    parser.add_argument('--cacheDir', '--cache-dir', dest='cacheDir', type=str, default=None, help='Directory of a result cache, chromosomes whose ends were analyzed before with the same parameters are not analyzed again')
+    parser.add_argument('--cacheMaxEntries', type=int, default=resultCacheMaxEntries, help='Number of results kept in the result cache (2 per chromosome)')
+    args = parser.parse_args()
 
-# Call the function to trim the reference genome
-# NOTE: This algorithm assumes that each chromosome is its own read, and not split into
-# q and p arms.
-trimTeloReferenceGenome(sys.argv[1], sys.argv[2], bedFileOutput)
+    # Call the function to trim the reference genome
+    # NOTE: This algorithm assumes that each chromosome is its own read, and not split into
+    # q and p arms.
+    with (ResultCache(args.cacheDir, args.cacheMaxEntries) if args.cacheDir is not None else contextlib.nullcontext()) as cache:
+        trimTeloReferenceGenome(args.referenceGenome, args.outputFile, args.outputBedFile, parser=args.parser, workers=args.workers, cache=cache)
+        if cache is not None:
+            print(f"Result cache: {cache.hits} hits, {cache.misses} misses (chromosome ends)")
@@ -1,21 +1,44 @@
 from TeloBP.teloBoundaryHelpers import *
-from TeloBP.constants import expectedTeloCompositionQ, expectedTeloCompositionP, areaDiffsThreshold, teloNPTeloCompositionGStrand, teloNPTeloCompositionCStrand, errorReturns
+from TeloBP.offsetScoring import ScoringWorkspace, getNtOffsets, scoreWindowRange, scanGraphAreaUntilBoundary, _compileFastPattern, _patternTargetLength, _patternMatchers
+from TeloBP.patternMatcher import repeatMatchSpans
+from TeloBP.seqReader import readSeqRecords
+from TeloBP.refIndex import readRefEnds, canIndex
+from TeloBP.resultCache import cachedBatch, parameterDigest, sequenceKey
+import TeloBP.profiling as profiling
+from TeloBP.constants import expectedTeloCompositionQ, expectedTeloCompositionP, areaDiffsThreshold, teloNPTeloCompositionGStrand, teloNPTeloCompositionCStrand, errorReturns, \
+    referenceSearchSize, referenceArmScanLength, coarseBracketSteps, coarseMinScanLength, prefilterEndLength, prefilterBlockSize, prefilterMinRepeats, prefilterKmersGStrand, prefilterKmersCStrand, teloNPPrefilterKmersGStrand, teloNPPrefilterKmersCStrand
 import numpy as np
 from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from collections import deque, namedtuple
+import contextlib
+import multiprocessing as mp
 import re
 import logging
+import functools
 
+# Logging is configured by the application (e.g. --logLevel in teloBPCmd.py), not when TeloBP is imported. Failed reads
+# are only logged at the debug level, since they can be counted from the error codes returned for them.
+logger = logging.getLogger(__name__)
+_loggedWarnings = set()
 
 
-logging.basicConfig(level=logging.ERROR)
-#logging.basicConfig(level=logging.WARNING)
+def _warnOnce(message):
+    # Logs a warning about the parameters once per process, rather than once for every read
+    if message not in _loggedWarnings:
+        _loggedWarnings.add(message)
+        logger.warning(message)
+
 
 # The following function takes in a sequence, and returns the index of the telomere boundary.
-def getTeloBoundary(seq, isGStrand = None, compositionGStrand=[], compositionCStrand = [], teloWindow=100, windowStep=6, changeThreshold=-20, plateauDetectionThreshold=-50, targetPatternIndex=-1, nucleotideGraphAreaWindowSize=500, showGraphs=False, pdf=None, returnLastDiscontinuity=False, secondarySearch = False):
+@profiling.profiledRead
+def getTeloBoundary(seq, isGStrand = None, compositionGStrand=[], compositionCStrand = [], teloWindow=100, windowStep=6, changeThreshold=-20, plateauDetectionThreshold=-50, targetPatternIndex=-1, nucleotideGraphAreaWindowSize=500, showGraphs=False, pdf=None, returnLastDiscontinuity=False, secondarySearch = False, earlyTermination=True, maxScanLength=None, coarseWindowStep=None, prefilter=False, prefilterEndLength=prefilterEndLength, prefilterMinRepeats=prefilterMinRepeats, prefilterKmersGStrand=prefilterKmersGStrand, prefilterKmersCStrand=prefilterKmersCStrand, cache=None):
     """
     This function takes in a sequence, and returns the index of the telomere boundary.
 
-    :param seq: The sequence to be analyzed
+    :param seq: The sequence to be analyzed, as a str, Bio Seq, bytes, memoryview or NumPy uint8 array. The sequence is uppercased
+           once into a bytes buffer (not copied if it is already uppercase bytes), and windows are scored on views of it.
     :param isGStrand: True if the sequence is the G strand (has TTAGGG telomeres), False if it is the C strand (has CCCTAA telomeres). 
            Is None by default, and will be determined using the composition lists (count of G vs C repeats) if not specified.
     :param compositionGStrand: A list of lists, where each list contains a nucleotide pattern representing the expected telomere pattern on the G Strand.
@@ -37,31 +60,64 @@ def getTeloBoundary(seq, isGStrand = None, compositionGStrand=[], compositionCSt
     :param pdf: A pdf object, if provided, the graphs will be saved to the pdf.
     :param returnLastDiscontinuity: Boolean value, if true, the algorithm will return the last possible point of discontinuity, rather than the first.
            For sequences which are very noisy, this may be necessary, as the first point of discontinuity may be a false positive.
+    :param earlyTermination: Boolean value, if true, the sequence is scored in chunks from the telomeric end, and scoring stops once the
+           boundary is confirmed, giving the same result as scoring the whole sequence. Not used with returnLastDiscontinuity or showGraphs,
+           which need the area curve of the whole sequence.
+    :param maxScanLength: If set, only the first maxScanLength bases from the telomeric end of the sequence are scored. This bounds the
+           work done per read when returnLastDiscontinuity is true. None scans the whole sequence.
+    :param coarseWindowStep: If set (e.g. to constants.defaultCoarseWindowStep, 60), the boundary is first searched for on windows
+           coarseWindowStep bases apart, then windows are scored at windowStep only around the boundary found, rather than along
+           the whole sequence. Only used when the whole sequence would be scored (returnLastDiscontinuity, or earlyTermination off),
+           on sequences of at least constants.coarseMinScanLength bases. If the boundary isn't found within coarseBracketSteps
+           coarse steps of the coarse boundary, the whole sequence is searched at windowStep. Not used with showGraphs, or if it is
+           not larger than windowStep. On synthetic 50 kb reads (400 per setting) with up to 4% substitutions and 2.7% insertions
+           and deletions, the boundaries were identical to the full resolution ones (within 0 bases, and both searches found or
+           missed the same boundaries), for TeloBP and TeloNP. The result differs when the coarse windows step over a short dip of
+           the area curve inside the telomere: with 6% substitutions, 4 of 400 TeloBP boundaries differed, by 0.8 to 10.6 kb, and
+           with 8%, 130 of 400 TeloBP and 1 of 400 TeloNP boundaries differed, by up to 17.5 kb. In all of these, the coarse
+           boundary was the closer one to the true boundary (see tests/test_coarseSearch.py).
+    :param prefilter: Boolean value, if true, reads without telomere repeats at their ends are rejected with errorReturns['noTelomere']
+           before the strand and boundary searches. See hasTeloEnd for the prefilterEndLength, prefilterMinRepeats and prefilterKmers parameters.
+    :param cache: A TeloBP.resultCache.ResultCache. If given, the result is taken from the cache when this sequence was analyzed
+           with the same parameters before, and saved to it otherwise. Not used with showGraphs.
     """
 
-    boundaryPoint = -1
-    ntOffsets = []
-    graphAreaWindowSize = int(nucleotideGraphAreaWindowSize / windowStep)
+    if cache is not None and not showGraphs:
+        params = {name: value for name, value in locals().items() if name not in ("seq", "cache")}
+        telomereLengths, isGStrandOut, _ = cachedBatch(cache, "getTeloBoundary", params, [seq], [isGStrand], lambda seqs, readStrands: _boundaryAsBatch(seqs[0], params))
+        return int(telomereLengths[0]), None if isGStrandOut[0] < 0 else bool(isGStrandOut[0])
+
+    seq = asSeqBuffer(seq)
     try:
         validate_seq_teloWindow(seq, teloWindow)
     except Warning as w:
-        logging.warning(f"Initial validation failed for read, returning {errorReturns['init']}: {w}")
+        logger.debug("Initial validation failed for read, returning %d: %s", errorReturns['init'], w)
         return errorReturns['init'], None
 
+    if prefilter:
+        with profiling.stage("prefilter"):
+            hasTelomere = hasTeloEnd(seq, isGStrand, prefilterEndLength, prefilterMinRepeats, prefilterKmersGStrand, prefilterKmersCStrand)
+        if not hasTelomere:
+            logger.debug("No telomere repeats at the read ends, returning %d", errorReturns['noTelomere'])
+            return errorReturns['noTelomere'], None
+
     if len(compositionGStrand) == 0:
         compositionGStrand = expectedTeloCompositionQ
     if len(compositionCStrand) == 0:
         compositionCStrand = expectedTeloCompositionP
 
+    seqUpper = asUpperSeqBytes(seq)
+
     # calculate telomere strand type
     if isGStrand == None:
-        isGStrand = getIsGStrandFromSeq(seq, compositionGStrand[targetPatternIndex], compositionCStrand[targetPatternIndex])
+        with profiling.stage("strandInference"):
+            isGStrand = getIsGStrandFromSeq(seqUpper, compositionGStrand[targetPatternIndex], compositionCStrand[targetPatternIndex])
         if isGStrand < 0 or not isinstance(isGStrand, bool) and not isinstance(isGStrand, np.bool_):
             # print("Could not determine telomere strand type, returning -1")
             if isGStrand == errorReturns['fusedRead']:
-                logging.warning(f"Warning: fused strand likely, returning {errorReturns['fusedRead']}")
+                logger.debug("Warning: fused strand likely, returning %d", errorReturns['fusedRead'])
                 return errorReturns['fusedRead'], None
-            logging.warning(f"Warning: could not determine telomere strand type from sequence, returning {errorReturns['strandType']}")
+            logger.debug("Warning: could not determine telomere strand type from sequence, returning %d", errorReturns['strandType'])
             return errorReturns['strandType'], None
         
     composition = []
@@ -78,192 +134,235 @@ def getTeloBoundary(seq, isGStrand = None, compositionGStrand=[], compositionCSt
     try:
         validate_parameters(seq, isGStrand, composition, teloWindow, windowStep, plateauDetectionThreshold, changeThreshold, targetPatternIndex, nucleotideGraphAreaWindowSize, showGraphs)
     except Warning as w:
-        logging.warning(f"Initial validation failed for read, returning {errorReturns['init']}: {w}")
+        logger.debug("Initial validation failed for read, returning %d: %s", errorReturns['init'], w)
         return errorReturns['init'], None
 
+    return _getTeloBoundaryForStrand(seq, isGStrand, composition, teloWindow, windowStep, changeThreshold, plateauDetectionThreshold, targetPatternIndex, nucleotideGraphAreaWindowSize, showGraphs, pdf, returnLastDiscontinuity, secondarySearch, earlyTermination, maxScanLength, seqUpper, coarseWindowStep)
+
+
+def _boundaryAsBatch(seq, params):
+    # Runs getTeloBoundary on a sequence, returning its result in the format of getTeloBoundaryBatch
+    teloLength, readIsGStrand = getTeloBoundary(seq, **params)
+    errorCode = teloLength if readIsGStrand is None else 0
+    return np.array([teloLength]), np.array([-1 if readIsGStrand is None else int(readIsGStrand)]), np.array([errorCode])
+
+
+def _getTeloBoundaryForStrand(seq, isGStrand, composition, teloWindow, windowStep, changeThreshold, plateauDetectionThreshold, targetPatternIndex, nucleotideGraphAreaWindowSize, showGraphs, pdf, returnLastDiscontinuity, secondarySearch, earlyTermination, maxScanLength, seqUpper=None, coarseWindowStep=None, workspace=None):
+    # The boundary search of getTeloBoundary, once the strand is known and the parameters have been validated.
+    # seq is the sequence buffer given by asSeqBuffer, and seqUpper its uppercase bytes. The windows are scored on
+    # seqUpper, while the secondary search regexes run on seq, keeping the case of the input.
+    # workspace is the ScoringWorkspace the windows are scored in, or None to allocate the arrays of this read.
+    if seqUpper is None:
+        seqUpper = asUpperSeqBytes(seq)
+    boundaryPoint = -1
+    graphAreaWindowSize = int(nucleotideGraphAreaWindowSize / windowStep)
+
     # Move through the sequence in windows of size teloWindow, and step size windowStep,
     # and calculate the offset of the nucleotide composition from the expected telomere composition
-    for i in range(0, len(seq) - teloWindow, windowStep):
-        teloSeq = ""
-        if isGStrand == True:
-            teloSeq = seq[(len(seq) - i) - teloWindow:len(seq) - i]
+    scanLength = len(seq) if maxScanLength is None else min(len(seq), maxScanLength)
+    numWindows = len(range(0, scanLength - teloWindow, windowStep))
+    # The index of the window of the first area in areaList
+    firstWindow = 0
+    areaList = None
+    # The coarse pass only pays off when the whole sequence would be scored, and the sequence is long
+    fullScan = returnLastDiscontinuity or not earlyTermination
+    if coarseWindowStep is not None and coarseWindowStep > windowStep and fullScan and scanLength >= coarseMinScanLength and not showGraphs:
+        windowRange = _coarseWindowRange(seqUpper, composition[targetPatternIndex], isGStrand, teloWindow, windowStep, coarseWindowStep, numWindows, scanLength, nucleotideGraphAreaWindowSize, changeThreshold, plateauDetectionThreshold, returnLastDiscontinuity, workspace)
+        if windowRange is None:
+            logger.debug("No telo boundary found by the coarse search, returning %d", errorReturns['init'])
+            return errorReturns['init'], None
+        firstWindow, lastWindow = windowRange
+        with profiling.stage("windowScoring"):
+            ntOffsets = scoreWindowRange(seqUpper, [composition[targetPatternIndex]], isGStrand, teloWindow, windowStep, firstWindow, lastWindow, workspace)
+        with profiling.stage("areaCurve"):
+            areaList = getGraphArea(ntOffsets, 0, graphAreaWindowSize)
+        with profiling.stage("thresholdSearch"):
+            areaDiffs = np.diff(areaList)
+            indexAtThreshold = _thresholdIndex(areaList, changeThreshold, plateauDetectionThreshold, returnLastDiscontinuity)
+            plateauIndex = findPlateauIndex(areaDiffs, indexAtThreshold) if indexAtThreshold != -1 else -1
+        if indexAtThreshold == -1 or plateauIndex == -1 and lastWindow < numWindows:
+            # The coarse boundary was off by more than the bracket, which is rare, so the whole sequence is searched
+            logger.debug("The boundary was not found around the coarse boundary, searching at full resolution")
+            firstWindow = 0
+            areaList = None
+
+    if areaList is None:
+        if earlyTermination and not returnLastDiscontinuity and not showGraphs:
+            areaList = scanGraphAreaUntilBoundary(seqUpper, composition[targetPatternIndex], isGStrand, teloWindow, windowStep, numWindows, graphAreaWindowSize, plateauDetectionThreshold, workspace=workspace)
         else:
-            teloSeq = seq[i:i + teloWindow]
-        teloLen = len(teloSeq)
-        teloSeqUpper = str(teloSeq.upper())
+            with profiling.stage("windowScoring"):
+                ntOffsets = getNtOffsets(seqUpper, composition, isGStrand, teloWindow, windowStep, numWindows, workspace)
+            with profiling.stage("areaCurve"):
+                areaList = getGraphArea(ntOffsets, targetPatternIndex, graphAreaWindowSize)
+        with profiling.stage("thresholdSearch"):
+            areaDiffs = np.diff(areaList)
+            indexAtThreshold = _thresholdIndex(areaList, changeThreshold, plateauDetectionThreshold, returnLastDiscontinuity)
+
+        if indexAtThreshold == -1:
+            logger.debug("No telo boundary found, returning %d", errorReturns['init'])
+            if showGraphs:
+                print(f"showGraph:  {showGraphs}")
+                graphLine(
+                    areaList, composition[targetPatternIndex][0] + " Area", windowStep, pdfOut=pdf)
+                # makeOffsetPlot(ntOffsets, composition,
+                #                offsetIndexToBPConstant=windowStep)
+            return errorReturns['init'], None
+
+        # Look through areaDiffs to find point where areaDiffs plateau
+        with profiling.stage("thresholdSearch"):
+            plateauIndex = findPlateauIndex(areaDiffs, indexAtThreshold)
+    if plateauIndex != -1:
+        boundaryPoint = (firstWindow + plateauIndex) * windowStep
+    else:
+        # This means we have reached the end of the telomere
+        # but we didn't find the point at which the telomere offset stopped changing.
+        logger.debug("Warning: Sequence was not long enough to find a telomere boundary, returning end of sequence as boundary point")
+        boundaryPoint = (firstWindow + len(areaDiffs)) * windowStep
+        
+    if secondarySearch == True:
+        with profiling.stage("secondarySearch"):
+            boundaryPoint = _secondarySearch(seq, isGStrand, boundaryPoint, composition, changeThreshold, returnLastDiscontinuity)
 
-        currentOffsets = []
-        # Calculate the offset of the nucleotide composition from the expected telomere composition
-        for ntPatternEntry in composition:
-            ntPattern = ntPatternEntry[0]
-            patternComposition = ntPatternEntry[1]
-            patternCount = len(re.findall(ntPattern, teloSeqUpper))
-            if is_regex_pattern(ntPattern) == True:
-                if len(ntPatternEntry) != 3:
-                    raise ValueError("Error: a target length must be specified as a third list item if using a regex pattern. Example: ['GGG|AAA', 3/6, 3], where the third item is the target length.")
-                regexTargetLength = ntPatternEntry[2]
-                rawOffsetValue = (
-                    (patternCount * regexTargetLength) / teloLen - patternComposition)
-                if patternComposition != 0:
-                    percentOffsetValue = (
-                        rawOffsetValue / patternComposition) * 100
-                    currentOffsets.append(percentOffsetValue)
-                else:
-                    percentOffsetValue = (rawOffsetValue) * 100
-                    currentOffsets.append(percentOffsetValue)
-            else:
-                # patternCount = the number of times we see the pattern
-                # len(ntPattern) = the length of the pattern, so GGG is 3
-                # teloLen = the length of the telomere window
-                # patternComposition = the expected composition of the pattern, so 3/6 for GGG
-                # Here we get an offset score based on the number of nucleotides we expect to see, given the pattern composition
-                rawOffsetValue = (
-                    (patternCount * len(ntPattern)) / teloLen - patternComposition)
-                if patternComposition != 0:
-                    # Here we convert the raw offset score to a percentage
-                    percentOffsetValue = (
-                        rawOffsetValue / patternComposition) * 100
-                    currentOffsets.append(percentOffsetValue)
-                else:
-                    # Incase the expected composition is 0, we just return the raw offset score
-                    percentOffsetValue = (rawOffsetValue) * 100
-                    currentOffsets.append(percentOffsetValue)
+    if showGraphs:
+        graphLine(areaList, composition[targetPatternIndex]
+                  [0] + " Area", windowStep, boundaryPoint=boundaryPoint, pdfOut=pdf)
+        # makeOffsetPlot(ntOffsets, composition, windowStep)
 
-        ntOffsets.append(currentOffsets)
+    return boundaryPoint, isGStrand
 
-    areaList = getGraphArea(ntOffsets, targetPatternIndex, graphAreaWindowSize)
-    areaDiffs = np.diff(areaList)
-    indexAtThreshold = -1
 
+def _thresholdIndex(areaList, changeThreshold, plateauDetectionThreshold, returnLastDiscontinuity):
+    # Returns the index of the area list from which the plateau is searched for, or -1 if there is none.
     # If returnLastDiscontinuity is true, we will scan for the
     # last point where we are above the changeThreshold, then look ahead for the first point where we
     # go below the plateauDetectionThreshold. This is because the area under the curve is not always monotonically
     # decreasing.
-
     if returnLastDiscontinuity:
         # Here, we grab the last point where the area is below the changeThreshold, and the slope is negative
-        indexAtThreshold = (next((y for y in range(len(areaList) - 2, 0, -1) if (
-            areaList[y] > changeThreshold and (0 > (areaList[y + 1] - areaList[y])))), indexAtThreshold))
+        indexAtThreshold = findLastChangeIndex(areaList, changeThreshold)
         if indexAtThreshold != -1:
             # The min threshold was reached, and the slope was negative, so we can look for the max threshold ahead of it
-            indexAtThreshold = (next((y for y in range(indexAtThreshold, len(areaList) - 2) if (
-                areaList[y] < plateauDetectionThreshold and (0 > (areaList[y + 1] - areaList[y])))), indexAtThreshold))
+            indexAhead = findThresholdIndex(areaList, plateauDetectionThreshold, indexAtThreshold)
+            if indexAhead != -1:
+                indexAtThreshold = indexAhead
+            return indexAtThreshold
+        # Didn't find a point above the changeThreshold, so we just scan for the first point past the maxThreshold
+    return findThresholdIndex(areaList, plateauDetectionThreshold)
+
+
+def _coarseWindowRange(seqUpper, ntPatternEntry, isGStrand, teloWindow, windowStep, coarseWindowStep, numWindows, scanLength, nucleotideGraphAreaWindowSize, changeThreshold, plateauDetectionThreshold, returnLastDiscontinuity, workspace=None):
+    # The coarse pass of the coarseWindowStep search of _getTeloBoundaryForStrand. Runs the boundary search on windows
+    # coarseWindowStep bases apart, and returns the range of windows at windowStep to score around the boundary it
+    # found, as (firstWindow, lastWindow), or None if no area went below the plateau detection threshold.
+    coarseGraphAreaWindowSize = max(int(nucleotideGraphAreaWindowSize / coarseWindowStep), 1)
+    numCoarseWindows = len(range(0, scanLength - teloWindow, coarseWindowStep))
+    with profiling.stage("windowScoring"):
+        ntOffsets = scoreWindowRange(seqUpper, [ntPatternEntry], isGStrand, teloWindow, coarseWindowStep, 0, numCoarseWindows, workspace)
+    with profiling.stage("areaCurve"):
+        areaList = getGraphArea(ntOffsets, 0, coarseGraphAreaWindowSize)
+    with profiling.stage("thresholdSearch"):
+        indexAtThreshold = _thresholdIndex(areaList, changeThreshold, plateauDetectionThreshold, returnLastDiscontinuity)
+        if indexAtThreshold == -1:
+            return None
+        # Coarse area differences are scaled to differences per windowStep, the step areaDiffsThreshold applies to
+        plateauIndex = findPlateauIndex(np.diff(areaList) * (windowStep / coarseWindowStep), indexAtThreshold)
+        if plateauIndex == -1:
+            plateauIndex = len(areaList) - 1
+
+    # The areas at windowStep from the coarse threshold crossing to the coarse plateau, with a margin of coarseBracketSteps
+    # coarse windows on each side. The areas of the last windows need graphAreaWindowSize more windows of offsets.
+    margin = coarseBracketSteps * coarseWindowStep
+    graphAreaWindowSize = int(nucleotideGraphAreaWindowSize / windowStep)
+    firstWindow = max((indexAtThreshold * coarseWindowStep - margin) // windowStep, 0)
+    lastWindow = min((plateauIndex * coarseWindowStep + margin) // windowStep + graphAreaWindowSize + 2, numWindows)
+    return firstWindow, lastWindow
+
+
+def _secondarySearch(seq, isGStrand, boundaryPoint, composition, changeThreshold, returnLastDiscontinuity):
+    # Refines the boundary point found by the primary search of _getTeloBoundaryForStrand, by rerunning the boundary
+    # search with a finer window around it, then matching the telomere pattern. Returns the refined boundary point.
+    # Lower being towards the telomere, upper being towards the centromere
+    telomereOffset = 500
+    subTelomereOffset = 1000
+    telomereOffsetRE = 30
+    subTelomereOffsetRE = 30
+    ntPatternEntry = composition[-1]
+    ntPattern = ntPatternEntry[0]
+    patternComposition = ntPatternEntry[1]
+
+    if isGStrand == True:
+        # scanSeq = seq[boundaryPoint-telomereOffset:boundaryPoint+subTelomereOffset]
+        lowerIndex = (len(seq) - (boundaryPoint+subTelomereOffset))
+        upperIndex = len(seq) - (boundaryPoint-telomereOffset)            
+        if lowerIndex < 0:
+            lowerIndex = 0
+        if upperIndex > len(seq):
+            upperIndex = len(seq)
+
+        scanSeq = seq[lowerIndex:upperIndex]
+        if len(scanSeq) < 100:
+            logger.debug("Warning: Sequence was not long enough to perform secondary search, returning original boundary point")
         else:
-            # Didn't find a point above the changeThreshold, so we just scan for the first point past the maxThreshold
-            indexAtThreshold = (next((y for y in range(len(areaList) - 2) if (
-                areaList[y] < plateauDetectionThreshold and (0 > (areaList[y + 1] - areaList[y])))), indexAtThreshold))
+            res = getTeloBoundary(scanSeq, isGStrand, composition, teloWindow=90, windowStep=6, changeThreshold=changeThreshold, plateauDetectionThreshold=-60, targetPatternIndex=-1, nucleotideGraphAreaWindowSize=100, showGraphs=False, returnLastDiscontinuity=returnLastDiscontinuity, secondarySearch=False)
+
+            if isinstance(res, int):
+                return boundaryPoint # if secondary search results in an error, just return primary search results
+            else:
+                # TODO: consider checking the consistency of C-G strand inference
+                secBoundary, _ = res
+
+            tempBoundary = boundaryPoint + secBoundary - telomereOffset
+            if upperIndex == len(seq):
+                tempBoundary = secBoundary
+
+            # ***( upper and lower here might be wrong, check this)
+            scanSeq = seq[(len(seq) - (tempBoundary+subTelomereOffsetRE)):len(seq) - (tempBoundary-telomereOffsetRE)]
+            scan_pattern = "("+ntPattern+")" + "("+ntPattern+")"
+            match = re.search(scan_pattern.encode(), scanSeq)
+            if match:
+                secBoundary = len(scanSeq) - match.span()[0]
+                boundaryPoint = tempBoundary + secBoundary - telomereOffsetRE
+            else:
+                boundaryPoint = tempBoundary
+                logger.debug("Secondary search failed to find a match, returning original boundary point")
     else:
-        indexAtThreshold = (next((y for y in range(len(areaList) - 2) if (
-            areaList[y] < plateauDetectionThreshold and (0 > (areaList[y + 1] - areaList[y])))), indexAtThreshold))
-
-    if indexAtThreshold == -1:
-        logging.warning(f"No telo boundary found, returning {errorReturns['init']}")
-        if showGraphs:
-            print(f"showGraph:  {showGraphs}")
-            graphLine(
-                areaList, composition[targetPatternIndex][0] + " Area", windowStep, pdfOut=pdf)
-            # makeOffsetPlot(ntOffsets, composition,
-            #                offsetIndexToBPConstant=windowStep)
-        return errorReturns['init'], None
+        lowerIndex = boundaryPoint-telomereOffset
+        upperIndex = boundaryPoint+subTelomereOffset
+        if lowerIndex < 0:
+            lowerIndex = 0
+        if upperIndex > len(seq):
+            upperIndex = len(seq)
+        scanSeq = seq[lowerIndex:upperIndex]
+        if len(scanSeq) < 100:
+            logger.debug("Warning: Sequence was not long enough to perform secondary search, returning original boundary point")
+        else:
+            res = getTeloBoundary(scanSeq, isGStrand, composition, teloWindow=90, windowStep=6, changeThreshold=changeThreshold, plateauDetectionThreshold=-60, targetPatternIndex=-1, nucleotideGraphAreaWindowSize=100, showGraphs=False, returnLastDiscontinuity=returnLastDiscontinuity, secondarySearch=False)
 
-    # Look through areaDiffs to find point where areaDiffs plateau
-    for x in range(indexAtThreshold, len(areaDiffs)-1):
-        # if it plateaus, or in the rare case that the diff jumps over the threshold, we have found the boundary point
-        if abs(areaDiffs[x]) < areaDiffsThreshold or areaDiffs[x] < areaDiffsThreshold and areaDiffs[x+1] > areaDiffsThreshold :
-            boundaryPoint = x * windowStep
-            break
-    if boundaryPoint == -1:
-        # This means we have reached the end of the telomere
-        # but we didn't find the point at which the telomere offset stopped changing.
-        logging.debug("Warning: Sequence was not long enough to find a telomere boundary, returning end of sequence as boundary point")
-        boundaryPoint = len(areaDiffs) * windowStep
-        
-    if secondarySearch == True:
-        # Lower being towards the telomere, upper being towards the centromere
-        telomereOffset = 500
-        subTelomereOffset = 1000
-        telomereOffsetRE = 30
-        subTelomereOffsetRE = 30
-        ntPattern = ntPatternEntry[0]
-
-        if isGStrand == True:
-            # scanSeq = seq[boundaryPoint-telomereOffset:boundaryPoint+subTelomereOffset]
-            lowerIndex = (len(seq) - (boundaryPoint+subTelomereOffset))
-            upperIndex = len(seq) - (boundaryPoint-telomereOffset)            
-            if lowerIndex < 0:
-                lowerIndex = 0
-            if upperIndex > len(seq):
-                upperIndex = len(seq)
-            
-            scanSeq = seq[lowerIndex:upperIndex]
-            if len(scanSeq) < 100:
-                logging.debug("Warning: Sequence was not long enough to perform secondary search, returning original boundary point")
+            if isinstance(res, int):
+                return boundaryPoint
             else:
-                res = getTeloBoundary(scanSeq, isGStrand, composition, teloWindow=90, windowStep=6, changeThreshold=changeThreshold, plateauDetectionThreshold=-60, targetPatternIndex=-1, nucleotideGraphAreaWindowSize=100, showGraphs=False, returnLastDiscontinuity=returnLastDiscontinuity, secondarySearch=False)
-                
-                if isinstance(res, int):
-                    return boundaryPoint, isGStrand # if secondary search results in an error, just return primary search results
-                else:
-                    # TODO: consider checking the consistency of C-G strand inference
-                    secBoundary, _ = res
+                # TODO: consider checking the consistency of C-G strand inference
+                secBoundary, _ = res
 
-                tempBoundary = boundaryPoint + secBoundary - telomereOffset
-                if upperIndex == len(seq):
-                    tempBoundary = secBoundary
+            tempBoundary = boundaryPoint + secBoundary - telomereOffset
+            if lowerIndex == 0:
+                tempBoundary = secBoundary
+            scanSeq = seq[tempBoundary-telomereOffsetRE:tempBoundary+subTelomereOffsetRE]
 
-                # ***( upper and lower here might be wrong, check this)
-                scanSeq = seq[(len(seq) - (tempBoundary+subTelomereOffsetRE)):len(seq) - (tempBoundary-telomereOffsetRE)]
-                scan_pattern = "("+ntPattern+")" + "("+ntPattern+")"
-                match = re.search(str(scan_pattern), str(scanSeq))
-                if match:
-                    secBoundary = len(scanSeq) - match.span()[0]
-                    boundaryPoint = tempBoundary + secBoundary - telomereOffsetRE
-                else:
-                    boundaryPoint = tempBoundary
-                    logging.debug("Secondary search failed to find a match, returning original boundary point")
-        else:
-            lowerIndex = boundaryPoint-telomereOffset
-            upperIndex = boundaryPoint+subTelomereOffset
-            if lowerIndex < 0:
-                lowerIndex = 0
-            if upperIndex > len(seq):
-                upperIndex = len(seq)
-            scanSeq = seq[lowerIndex:upperIndex]
-            if len(scanSeq) < 100:
-                logging.debug("Warning: Sequence was not long enough to perform secondary search, returning original boundary point")
+            if patternComposition != 1:
+                _warnOnce("Warning: Secondary search is not fully compatible with telomere compositions less than 1. Please provide a telomere pattern that covers 6/6 of the expected telomere nucleotides, like 'TTAGGG' or 'GGG...'.")
             else:
-                res = getTeloBoundary(scanSeq, isGStrand, composition, teloWindow=90, windowStep=6, changeThreshold=changeThreshold, plateauDetectionThreshold=-60, targetPatternIndex=-1, nucleotideGraphAreaWindowSize=100, showGraphs=False, returnLastDiscontinuity=returnLastDiscontinuity, secondarySearch=False)
 
-                if isinstance(res, int):
-                    return boundaryPoint, isGStrand
-                else:
-                    # TODO: consider checking the consistency of C-G strand inference
-                    secBoundary, _ = res
-
-                tempBoundary = boundaryPoint + secBoundary - telomereOffset
-                if lowerIndex == 0:
-                    tempBoundary = secBoundary
-                scanSeq = seq[tempBoundary-telomereOffsetRE:tempBoundary+subTelomereOffsetRE]
-                
-                if patternComposition != 1:
-                    logging.warning("Warning: Secondary search is not fully compatible with telomere compositions less than 1. Please provide a telomere pattern that covers 6/6 of the expected telomere nucleotides, like 'TTAGGG' or 'GGG...'.")
+                scan_pattern = "("+ntPattern+")" + "("+ntPattern+")"
+                matches = [match for match in re.finditer(scan_pattern.encode(), scanSeq)]
+                if matches:
+                    teloEnd = matches[-1].end()
+                    boundaryPoint = tempBoundary + teloEnd - telomereOffsetRE
                 else:
-                    
-                    scan_pattern = "("+ntPattern+")" + "("+ntPattern+")"
-                    matches = [match for match in re.finditer(scan_pattern, str(scanSeq))]
-                    if matches:
-                        teloEnd = matches[-1].end()
-                        boundaryPoint = tempBoundary + teloEnd - telomereOffsetRE
-                    else:
-                        boundaryPoint = tempBoundary
-                        logging.debug("Secondary search failed to find a match, returning original boundary point")
-
-    if showGraphs:
-        graphLine(areaList, composition[targetPatternIndex]
-                  [0] + " Area", windowStep, boundaryPoint=boundaryPoint, pdfOut=pdf)
-        # makeOffsetPlot(ntOffsets, composition, windowStep)
+                    boundaryPoint = tempBoundary
+                    logger.debug("Secondary search failed to find a match, returning original boundary point")
 
-    return boundaryPoint, isGStrand
+    return boundaryPoint
 
 
 # The following function takes in the location of a reference genome, and outputs
@@ -272,83 +371,271 @@ def getTeloBoundary(seq, isGStrand = None, compositionGStrand=[], compositionCSt
 # NOTE: This algorithm assumes that each chromosome is its own read, and not split into
 # q and p arms.
 
-def refRecordTeloLengths(record, searchSize = 500000, compositionCStrandIn=expectedTeloCompositionP, compositionGStrandIn=expectedTeloCompositionQ, teloWindowIn=100, windowStepIn=6, plateauDetectionThresholdIn=-60, changeThresholdIn=-20, targetPatternIndexIn=-1, nucleotideGraphAreaWindowSizeIn=500, showGraphsIn=False, returnLastDiscontinuityIn=False, secondarySearchIn = False):
-    startTeloLength = getTeloBoundary(record.seq[:searchSize], isGStrand=False,  compositionGStrand = compositionGStrandIn, compositionCStrand=compositionCStrandIn, teloWindow=teloWindowIn, windowStep=windowStepIn, plateauDetectionThreshold=plateauDetectionThresholdIn, changeThreshold=changeThresholdIn,
-                                          targetPatternIndex=targetPatternIndexIn, nucleotideGraphAreaWindowSize=nucleotideGraphAreaWindowSizeIn, showGraphs=showGraphsIn, returnLastDiscontinuity=returnLastDiscontinuityIn, secondarySearch = secondarySearchIn)
-    endTeloLength = getTeloBoundary(record.seq[-searchSize:], isGStrand=True,  compositionGStrand = compositionGStrandIn, compositionCStrand=compositionCStrandIn, teloWindow=teloWindowIn, windowStep=windowStepIn, plateauDetectionThreshold=plateauDetectionThresholdIn, changeThreshold=changeThresholdIn,
-                                    targetPatternIndex=targetPatternIndexIn, nucleotideGraphAreaWindowSize=nucleotideGraphAreaWindowSizeIn, showGraphs=showGraphsIn, returnLastDiscontinuity=returnLastDiscontinuityIn, secondarySearch = secondarySearchIn)
-    return startTeloLength, endTeloLength
+# The telomere lengths of the start (p arm, C strand) and end (q arm, G strand) of a reference chromosome
+RefTeloLengths = namedtuple("RefTeloLengths", ["startTeloLength", "endTeloLength"])
+
+
+def refRecordTeloLengths(record, searchSize = referenceSearchSize, compositionCStrandIn=expectedTeloCompositionP, compositionGStrandIn=expectedTeloCompositionQ, teloWindowIn=100, windowStepIn=6, plateauDetectionThresholdIn=-60, changeThresholdIn=-20, targetPatternIndexIn=-1, nucleotideGraphAreaWindowSizeIn=500, showGraphsIn=False, returnLastDiscontinuityIn=False, secondarySearchIn = False):
+    # Returns the RefTeloLengths of a chromosome record (or sequence), from the first and last searchSize bases.
+    # Each end is scanned from its telomere with getTeloBoundary, on the first referenceArmScanLength bases only,
+    # then on 4 times as many until its boundary is confirmed. A boundary confirmed within a scan is the one found
+    # by scanning all searchSize bases, so only the start of each end is copied and uppercased.
+    seq = record.seq if isinstance(record, SeqRecord) else record
+    if not isinstance(seq, Seq):
+        seq = memoryview(asSeqBuffer(seq))
+    teloLengthArgs = dict(compositionGStrand = compositionGStrandIn, compositionCStrand=compositionCStrandIn, teloWindow=teloWindowIn, windowStep=windowStepIn, plateauDetectionThreshold=plateauDetectionThresholdIn, changeThreshold=changeThresholdIn,
+                          targetPatternIndex=targetPatternIndexIn, nucleotideGraphAreaWindowSize=nucleotideGraphAreaWindowSizeIn, showGraphs=showGraphsIn, returnLastDiscontinuity=returnLastDiscontinuityIn, secondarySearch = secondarySearchIn)
+    return RefTeloLengths(_refArmTeloLength(seq, False, searchSize, teloLengthArgs), _refArmTeloLength(seq, True, searchSize, teloLengthArgs))
+
+
+def _refArmTeloLength(seq, isGStrand, searchSize, teloLengthArgs):
+    # The telomere length of the start (isGStrand False) or end of a chromosome, see refRecordTeloLengths
+    armLength = min(len(seq), searchSize)
+    # The last discontinuity and the graphs need the whole area curve
+    scanLength = armLength if teloLengthArgs["returnLastDiscontinuity"] or teloLengthArgs["showGraphs"] else min(referenceArmScanLength, armLength)
+    # A boundary this close to the end of a scan may be the end of the area curve rather than a plateau, and the
+    # secondary search looks up to 1030 bases past the boundary
+    confirmMargin = teloLengthArgs["teloWindow"] + teloLengthArgs["nucleotideGraphAreaWindowSize"] + 4 * teloLengthArgs["windowStep"]
+    if teloLengthArgs["secondarySearch"]:
+        confirmMargin += 1100
+    while True:
+        # getTeloBoundary returns (length, isGStrand), only the length is needed here
+        teloLength, _ = getTeloBoundary(seq[len(seq) - scanLength:] if isGStrand else seq[:scanLength], isGStrand=isGStrand, **teloLengthArgs)
+        if scanLength == armLength or teloLength >= 0 and teloLength + confirmMargin <= scanLength:
+            return teloLength
+        scanLength = min(4 * scanLength, armLength)
+
+
+def trimTeloReferenceGenome(filename, outputFilename, bedFileName = None, subSec = None, compositionCStrandIn=expectedTeloCompositionP, compositionGStrandIn=expectedTeloCompositionQ, teloWindowIn=100, windowStepIn=6, plateauDetectionThresholdIn=-60, changeThresholdIn=-20, targetPatternIndexIn=-1, nucleotideGraphAreaWindowSizeIn=500, showGraphsIn=False, returnLastDiscontinuityIn=False, secondarySearchIn = False, parser="fast", workers=1, cache=None):
+    # parser: "fast" or "biopython", the reader used for the reference fasta (see TeloBP.seqReader)
+    # workers: the number of processes analyzing chromosomes in parallel. The trimmed chromosomes and bed entries
+    # are written as they are analyzed, in input order, so at most workers + 1 chromosomes are held in memory.
+    # cache: an optional ResultCache (see TeloBP.resultCache). Chromosomes whose ends were analyzed before with the
+    # same parameters take their telomere lengths from it, see writeTeloReferenceBed.
+    teloLengthArgs = dict(compositionCStrandIn=compositionCStrandIn, compositionGStrandIn=compositionGStrandIn, teloWindowIn=teloWindowIn, windowStepIn=windowStepIn, plateauDetectionThresholdIn=plateauDetectionThresholdIn, changeThresholdIn=changeThresholdIn, targetPatternIndexIn=targetPatternIndexIn, nucleotideGraphAreaWindowSizeIn=nucleotideGraphAreaWindowSizeIn, showGraphsIn=showGraphsIn, returnLastDiscontinuityIn=returnLastDiscontinuityIn, secondarySearchIn = secondarySearchIn)
+    records = readSeqRecords(filename, "fasta", parser)
+
+    with open(outputFilename, "w") as outputFile, \
+            (open(bedFileName, "w") if bedFileName != None else contextlib.nullcontext()) as bedFile:
+        # Trims the records and saves them
+        recordEnds = ((record, _refRecordEnds(record)) for record in records)
+        for record, (startTeloLength, endTeloLength) in _mapRefEndsTeloLengths(recordEnds, teloLengthArgs, workers, cache):
+            if bedFile is not None:
+                bed_data = []
+                recordBedData(bed_data, record, startTeloLength, endTeloLength)
+                append_bed_entries(bedFile, bed_data)
+
+            if subSec == None:
+                trimmed_sequences = [record[startTeloLength:-endTeloLength]]
+            else:
+                # We will save 2 subsequences, one for the q arm and one for the p arm
+                cStrand = record[startTeloLength:startTeloLength+subSec]
+                gStrand = record[-endTeloLength-subSec:-endTeloLength]
+                # change the id of the sequence
+                cStrand.id = cStrand.id + "_C"
+                gStrand.id = gStrand.id + "_G"
+                trimmed_sequences = [cStrand, gStrand]
 
+            # Write the trimmed sequences to the output file
+            SeqIO.write(trimmed_sequences, outputFile, "fasta")
 
-def trimTeloReferenceGenome(filename, outputFilename, bedFileName = None, subSec = None, compositionCStrandIn=expectedTeloCompositionP, compositionGStrandIn=expectedTeloCompositionQ, teloWindowIn=100, windowStepIn=6, plateauDetectionThresholdIn=-60, changeThresholdIn=-20, targetPatternIndexIn=-1, nucleotideGraphAreaWindowSizeIn=500, showGraphsIn=False, returnLastDiscontinuityIn=False, secondarySearchIn = False):
-    trimmed_sequences = []
-    bed_data = []
 
-    # Trims the records and saves them
-    for record in SeqIO.parse(filename, "fasta"):
-        startTeloLength, endTeloLength = refRecordTeloLengths(record, compositionCStrandIn=compositionCStrandIn, compositionGStrandIn=compositionGStrandIn, teloWindowIn=teloWindowIn, windowStepIn=windowStepIn, plateauDetectionThresholdIn=plateauDetectionThresholdIn, changeThresholdIn=changeThresholdIn, targetPatternIndexIn=targetPatternIndexIn, nucleotideGraphAreaWindowSizeIn=nucleotideGraphAreaWindowSizeIn, showGraphsIn=showGraphsIn, returnLastDiscontinuityIn=returnLastDiscontinuityIn, secondarySearchIn = secondarySearchIn)
-        
-        if bedFileName != None:
-            recordBedData(bed_data, record, startTeloLength, endTeloLength)
+def writeTeloReferenceBed(filename, bedFileName, indexed=True, compositionCStrandIn=expectedTeloCompositionP, compositionGStrandIn=expectedTeloCompositionQ, teloWindowIn=100, windowStepIn=6, plateauDetectionThresholdIn=-60, changeThresholdIn=-20, targetPatternIndexIn=-1, nucleotideGraphAreaWindowSizeIn=500, showGraphsIn=False, returnLastDiscontinuityIn=False, secondarySearchIn = False, parser="fast", workers=1, cache=None):
+    """
+    Writes a bed file with the telomere boundaries of every chromosome of a reference genome, as
+    trimTeloReferenceGenome does.
+
+    :param indexed: If true, only the ends of the chromosomes are read, using the .fai index of the reference
+           (and .gzi index for bgzip compressed references), which are built if they are missing. Gzip files that
+           aren't bgzip compressed can't be indexed, and are parsed with the reader selected by parser instead.
+    :param workers: The number of processes analyzing chromosomes in parallel.
+    :param cache: Optional ResultCache (see TeloBP.resultCache). The telomere lengths of each chromosome are cached,
+           keyed by a hash of the chromosome ends and the parameters, so rerunning on the same reference reads the
+           chromosome ends only, and a new release of an assembly only analyzes the chromosomes that changed.
+    """
+    teloLengthArgs = dict(compositionCStrandIn=compositionCStrandIn, compositionGStrandIn=compositionGStrandIn, teloWindowIn=teloWindowIn, windowStepIn=windowStepIn, plateauDetectionThresholdIn=plateauDetectionThresholdIn, changeThresholdIn=changeThresholdIn, targetPatternIndexIn=targetPatternIndexIn, nucleotideGraphAreaWindowSizeIn=nucleotideGraphAreaWindowSizeIn, showGraphsIn=showGraphsIn, returnLastDiscontinuityIn=returnLastDiscontinuityIn, secondarySearchIn = secondarySearchIn)
 
-        if subSec == None:
-            trimmed_sequences.append(record[startTeloLength:-endTeloLength])
-        else:
-            # We will save 2 subsequences, one for the q arm and one for the p arm
-            cStrand = record[startTeloLength:startTeloLength+subSec]
-            gStrand = record[-endTeloLength-subSec:-endTeloLength]
-            # change the id of the sequence
-            cStrand.id = cStrand.id + "_C"
-            gStrand.id = gStrand.id + "_G"
-            trimmed_sequences.append(cStrand)
-            trimmed_sequences.append(gStrand)
-    
-    if bedFileName != None:
-        write_bed_file(bedFileName, bed_data)
+    if indexed and not canIndex(filename):
+        logger.warning(f"{filename} is not bgzip compressed and can't be indexed, the whole file will be parsed")
+        indexed = False
+    if indexed:
+        contigEnds = (((name, length), seqEnds) for name, length, seqEnds in readRefEnds(filename))
+    else:
+        contigEnds = (((record.id, len(record.seq)), _refRecordEnds(record)) for record in readSeqRecords(filename, "fasta", parser))
+
+    with open(bedFileName, "w") as bedFile:
+        for (chrName, chrLength), (startTeloLength, endTeloLength) in _mapRefEndsTeloLengths(contigEnds, teloLengthArgs, workers, cache):
+            bed_data = []
+            contigBedData(bed_data, chrName, chrLength, startTeloLength, endTeloLength)
+            append_bed_entries(bedFile, bed_data)
+
+
+def _mapRefEndsTeloLengths(items, teloLengthArgs, workers=1, cache=None):
+    # Takes (key, seqEnds) pairs, where seqEnds is given by _refRecordEnds, and yields (key, (startTeloLength, endTeloLength))
+    # in input order. With more than 1 worker the items are analyzed in a process pool, with at most workers + 1 items
+    # waiting for their results. With a cache, the items found in it are not analyzed, and the results of the others
+    # are added to it.
+    if cache is not None and teloLengthArgs["showGraphsIn"]:
+        cache = None
+    digests = _refEndsDigests(teloLengthArgs) if cache is not None else None
+
+    def cachedLengths(seqEnds):
+        # Returns the cache keys of the chromosome ends, and their cached lengths or None
+        if cache is None:
+            return None, None
+        keys = _refEndsCacheKeys(seqEnds, digests)
+        cached = cache.get(keys)
+        if None in cached:
+            return keys, None
+        return keys, RefTeloLengths(*(telomereLength for telomereLength, _ in cached))
+
+    def cacheLengths(keys, teloLengths):
+        # The start of a chromosome is analyzed as a C strand, and its end as a G strand
+        if keys is not None:
+            cache.put(keys, teloLengths, (0, 1))
+
+    if workers <= 1:
+        for key, seqEnds in items:
+            keys, teloLengths = cachedLengths(seqEnds)
+            if teloLengths is None:
+                teloLengths = _refEndsTeloLengths(seqEnds, teloLengthArgs)
+                cacheLengths(keys, teloLengths)
+            yield key, teloLengths
+        return
+
+    with mp.Pool(workers) as pool:
+        pending = deque()
+
+        def nextResult():
+            key, keys, teloLengths, result = pending.popleft()
+            if teloLengths is None:
+                teloLengths = result.get()
+                cacheLengths(keys, teloLengths)
+            return key, teloLengths
+
+        for key, seqEnds in items:
+            keys, teloLengths = cachedLengths(seqEnds)
+            result = pool.apply_async(_refEndsTeloLengths, (seqEnds, teloLengthArgs)) if teloLengths is None else None
+            pending.append((key, keys, teloLengths, result))
+            if len(pending) > workers:
+                yield nextResult()
+        while pending:
+            yield nextResult()
+
+
+def _refEndsDigests(teloLengthArgs, searchSize=referenceSearchSize):
+    # Parameter digests of the start (C strand) and end (G strand) of the chromosomes analyzed by refRecordTeloLengths
+    params = dict(teloLengthArgs, searchSize=searchSize)
+    return tuple(parameterDigest("refRecordTeloLengths", dict(params, isGStrand=isGStrand)) for isGStrand in (False, True))
+
+
+def _refEndsCacheKeys(seqEnds, digests, searchSize=referenceSearchSize):
+    # The cache keys of the start and end of a chromosome, keyed by the bases refRecordTeloLengths analyzes at each end
+    seqEnds = memoryview(seqEnds)
+    return [sequenceKey(seqEnds[:searchSize], digests[0]), sequenceKey(seqEnds[-searchSize:], digests[1])]
+
+
+def _refRecordEnds(record, searchSize=referenceSearchSize):
+    # refRecordTeloLengths only looks at the first and last searchSize bases, so only those are sent to the workers
+    seq = record.seq
+    if len(seq) > 2 * searchSize:
+        seq = seq[:searchSize] + seq[-searchSize:]
+    return bytes(seq)
+
+
+def _refEndsTeloLengths(seqEnds, teloLengthArgs):
+    return refRecordTeloLengths(seqEnds, **teloLengthArgs)
+
+
+def hasTeloEnd(seq, isGStrand=None, endLength=prefilterEndLength, minRepeats=prefilterMinRepeats, kmersGStrand=prefilterKmersGStrand, kmersCStrand=prefilterKmersCStrand, blockSize=prefilterBlockSize):
+    """
+    Cheap check for whether a read can contain a telomere. Looks for the telomere repeat k-mers in the
+    first endLength bases (C strand telomeres) and the last endLength bases (G strand telomeres), ignoring case.
+    The ends are searched as views of the sequence, so nothing is copied for bytes-like sequences.
+
+    :param isGStrand: If True or False, only the end of that strand is checked. If None, either end can pass.
+    :param minRepeats: The number of non-overlapping k-mer occurrences that must fall within blockSize bases for an end to pass.
+    Returns True if an end has at least minRepeats repeats within blockSize bases.
+    """
+    seq = memoryview(asSeqBuffer(seq))
+    if isGStrand is None or not isGStrand:
+        if _hasRepeatBlock(seq[:endLength], kmersCStrand, blockSize, minRepeats):
+            return True
+    if isGStrand is None or isGStrand:
+        if _hasRepeatBlock(seq[max(len(seq) - endLength, 0):], kmersGStrand, blockSize, minRepeats):
+            return True
+    return False
+
+
+def _hasRepeatBlock(region, kmers, blockSize, minRepeats):
+    # Returns True if minRepeats non-overlapping k-mers fit within blockSize bases somewhere in region
+    starts = [match.start() for match in _kmerRegex(tuple(kmers)).finditer(region)]
+    span = blockSize - min(len(kmer) for kmer in kmers)
+    return any(starts[i + minRepeats - 1] - starts[i] <= span for i in range(len(starts) - minRepeats + 1))
+
+
+@functools.lru_cache(maxsize=None)
+def _kmerRegex(kmers):
+    return re.compile("|".join(re.escape(kmer) for kmer in kmers).encode(), re.IGNORECASE)
+
+
+# Bases allowed between the repeats counted by getIsGStrandFromSeq
+strandRepeatMaxGap = 6
+# Shorter sequences are searched with the regex, which has less overhead than the hit vectors on them
+strandRepeatRegexMaxLength = 5000
+
+
+@functools.lru_cache(maxsize=None)
+def _strandRepeatRegex(pattern, searchStrandRepeats):
+    # Compiles the pattern repeated searchStrandRepeats times, allowing a few bases between repeats
+    boundaryReg = ".{0," + str(strandRepeatMaxGap) + "}"
+    strandPattern = ("("+pattern+")"+boundaryReg) * searchStrandRepeats
+    strandPattern = strandPattern[:-len(boundaryReg)]
+    return re.compile(strandPattern.encode())
+
+
+def _strandRepeatSpans(seq, pattern, searchStrandRepeats, mapped):
+    # Returns the (start, end) of the matches of _strandRepeatRegex in the uppercase sequence. Patterns with compiled
+    # matchers are found from their hit vectors, in a single pass shared by both strands through the mapped dict.
+    matchers = _patternMatchers(pattern)
+    if matchers is None or len(seq) < strandRepeatRegexMaxLength or b"\n" in seq:
+        return [match.span() for match in _strandRepeatRegex(pattern, searchStrandRepeats).finditer(seq)]
+    return repeatMatchSpans(matchers, seq, searchStrandRepeats, strandRepeatMaxGap, mapped)
 
-    # Write the trimmed sequences to the output file
-    SeqIO.write(trimmed_sequences, outputFilename, "fasta")
 
 def getIsGStrandFromSeq(seq, GStrandPatternIn, CStrandPatternIn, searchStrandRepeats = 4, minTeloCountDiff = 1, fusedReadTeloRepeatThreshold = 20, maxTelomereGap = 150):
     # We will look at the beginning of the seq and count for C strands, then look at the end and count for G strands
     # the compare the counts to see which is greater and return the result
-    
-    CStrandPattern = CStrandPatternIn[0]
-    GStrandPattern = GStrandPatternIn[0]
-
-    boundaryReg = ".{0,6}"
-
-    CStrandPattern =  ("("+CStrandPattern+")"+boundaryReg) * searchStrandRepeats
-    GStrandPattern =  ("("+GStrandPattern+")"+boundaryReg) * searchStrandRepeats
-    CStrandPattern = CStrandPattern[:-len(boundaryReg)]
-    GStrandPattern = GStrandPattern[:-len(boundaryReg)]
+    seq = asUpperSeqBytes(seq)
+    # Lookup tables applied to the sequence, shared by the C and G strand patterns
+    mapped = {}
 
-    allCStrands = [match for match in re.finditer(CStrandPattern, str(seq.upper()))]
+    allCStrands = _strandRepeatSpans(seq, CStrandPatternIn[0], searchStrandRepeats, mapped)
     # get start index of each match. For C strand start at the beginning and count forward
     cStrandCount = 0
     cStrandMatchLengths = 0
     lastMatch = 0
-    for match in allCStrands:
+    for matchStart, matchEnd in allCStrands:
         if lastMatch == 0:
-            lastMatch = match.start()
+            lastMatch = matchStart
 
-        if match.start() - lastMatch <= maxTelomereGap:
+        if matchStart - lastMatch <= maxTelomereGap:
             cStrandCount += 1
-            cStrandMatchLengths += match.end() - match.start()
-        lastMatch = match.start()
+            cStrandMatchLengths += matchEnd - matchStart
+        lastMatch = matchStart
         
-    allGStrands = [match for match in re.finditer(GStrandPattern, str(seq.upper()))]
+    allGStrands = _strandRepeatSpans(seq, GStrandPatternIn[0], searchStrandRepeats, mapped)
 
     gStrandCount = 0
     gStrandMatchLengths = 0
     lastMatch = 0
-    for match in allGStrands[::-1]:
+    for matchStart, matchEnd in allGStrands[::-1]:
         if lastMatch == 0:
-            lastMatch = match.start()
-        if lastMatch - match.start() <= maxTelomereGap:
+            lastMatch = matchStart
+        if lastMatch - matchStart <= maxTelomereGap:
             gStrandCount += 1
-            gStrandMatchLengths += match.end() - match.start()
-        lastMatch = match.start()
+            gStrandMatchLengths += matchEnd - matchStart
+        lastMatch = matchStart
 
     if max(cStrandCount, gStrandCount) <= minTeloCountDiff and abs(cStrandCount - gStrandCount) <= minTeloCountDiff:
 
@@ -385,11 +672,121 @@ def getTeloNPBoundary(seq, isGStrand=None, compositionCStrandIn=teloNPTeloCompos
                     compositionGStrandIn=teloNPTeloCompositionGStrand, teloWindow=100, \
                     windowStep=6, changeThreshold=-20, plateauDetectionThreshold=-60, \
                     targetPatternIndex=-1, nucleotideGraphAreaWindowSize=750, showGraphs=False, \
-                    pdf=None, returnLastDiscontinuity=True, secondarySearch=True):
+                    pdf=None, returnLastDiscontinuity=True, secondarySearch=True, earlyTermination=True, \
+                    maxScanLength=None, coarseWindowStep=None, prefilter=False, prefilterEndLength=prefilterEndLength, \
+                    prefilterMinRepeats=prefilterMinRepeats, prefilterKmersGStrand=teloNPPrefilterKmersGStrand, \
+                    prefilterKmersCStrand=teloNPPrefilterKmersCStrand, cache=None):
     return getTeloBoundary(seq, isGStrand, compositionCStrand=compositionCStrandIn, \
                         compositionGStrand=compositionGStrandIn, teloWindow=teloWindow, \
                         windowStep=windowStep, changeThreshold=changeThreshold, \
                         plateauDetectionThreshold=plateauDetectionThreshold, \
                         targetPatternIndex=targetPatternIndex, nucleotideGraphAreaWindowSize=nucleotideGraphAreaWindowSize, \
                         showGraphs=showGraphs, pdf=pdf, returnLastDiscontinuity=returnLastDiscontinuity, \
-                        secondarySearch=secondarySearch)
+                        secondarySearch=secondarySearch, earlyTermination=earlyTermination, \
+                        maxScanLength=maxScanLength, coarseWindowStep=coarseWindowStep, prefilter=prefilter, prefilterEndLength=prefilterEndLength, \
+                        prefilterMinRepeats=prefilterMinRepeats, prefilterKmersGStrand=prefilterKmersGStrand, \
+                        prefilterKmersCStrand=prefilterKmersCStrand, cache=cache)
+
+
+
+def getTeloBoundaryBatch(seqs, isGStrand=None, compositionGStrand=[], compositionCStrand=[], teloWindow=100, windowStep=6, changeThreshold=-20, plateauDetectionThreshold=-50, targetPatternIndex=-1, nucleotideGraphAreaWindowSize=500, returnLastDiscontinuity=False, secondarySearch=False, earlyTermination=True, maxScanLength=None, coarseWindowStep=None, prefilter=False, prefilterEndLength=prefilterEndLength, prefilterMinRepeats=prefilterMinRepeats, prefilterKmersGStrand=prefilterKmersGStrand, prefilterKmersCStrand=prefilterKmersCStrand, cache=None):
+    """
+    Runs getTeloBoundary over many sequences. The parameters are validated and the patterns are compiled
+    once for the whole batch, rather than for every read.
+
+    :param seqs: An iterable of sequences, of any of the types accepted by getTeloBoundary
+    :param isGStrand: None, True or False for every sequence, or an iterable with one of these values per sequence
+    The other parameters are the same as for getTeloBoundary. Graphs are not supported for batches.
+
+    Returns a tuple of three NumPy arrays, with one entry per sequence:
+        telomereLengths (int64): the telomere length, or the error code if the read failed
+        isGStrand (int8): 1 for the G strand, 0 for the C strand, -1 if the read failed
+        errorCodes (int64): 0 if the read passed, otherwise the error code from errorReturns
+
+    If cache (a TeloBP.resultCache.ResultCache) is given, only the reads that aren't cached for these parameters are analyzed.
+    """
+    if cache is not None:
+        params = {name: value for name, value in locals().items() if name not in ("seqs", "isGStrand", "cache")}
+    if len(compositionGStrand) == 0:
+        compositionGStrand = expectedTeloCompositionQ
+    if len(compositionCStrand) == 0:
+        compositionCStrand = expectedTeloCompositionP
+
+    validate_teloWindow(teloWindow)
+    for composition in (compositionGStrand, compositionCStrand):
+        validate_settings(True, composition, windowStep, targetPatternIndex, nucleotideGraphAreaWindowSize)
+        for ntPatternEntry in composition:
+            _patternTargetLength(ntPatternEntry)
+            _compileFastPattern(ntPatternEntry[0])
+
+    seqs = list(seqs)
+    if isGStrand is None or isinstance(isGStrand, (bool, np.bool_)):
+        readStrands = [isGStrand] * len(seqs)
+    else:
+        readStrands = list(isGStrand)
+        if len(readStrands) != len(seqs):
+            raise ValueError("isGStrand should be None, a boolean, or have one value per sequence")
+    if cache is not None:
+        return cachedBatch(cache, "getTeloBoundaryBatch", params, seqs, readStrands,
+                           lambda missingSeqs, missingStrands: getTeloBoundaryBatch(missingSeqs, missingStrands, **params))
+
+    telomereLengths = np.empty(len(seqs), dtype=np.int64)
+    isGStrandOut = np.full(len(seqs), -1, dtype=np.int8)
+    errorCodes = np.zeros(len(seqs), dtype=np.int64)
+    # The scoring arrays are allocated for the longest read so far, and reused for the others
+    workspace = ScoringWorkspace()
+    for i, (seq, readIsGStrand) in enumerate(zip(seqs, readStrands)):
+        seq = asSeqBuffer(seq)
+        # The reads are recorded by the active profiler, if any. The finally clause also runs for the reads that fail early.
+        profiledRead = profiling.startRead(len(seq))
+        try:
+            if len(seq) < teloWindow:
+                telomereLengths[i] = errorCodes[i] = errorReturns['init']
+                continue
+            if readIsGStrand is not None and not isinstance(readIsGStrand, (bool, np.bool_)):
+                raise ValueError("isGStrand should be a boolean, or numpy boolean")
+            if prefilter:
+                with profiling.stage("prefilter"):
+                    hasTelomere = hasTeloEnd(seq, readIsGStrand, prefilterEndLength, prefilterMinRepeats, prefilterKmersGStrand, prefilterKmersCStrand)
+                if not hasTelomere:
+                    telomereLengths[i] = errorCodes[i] = errorReturns['noTelomere']
+                    continue
+            seqUpper = asUpperSeqBytes(seq)
+            if readIsGStrand is None:
+                with profiling.stage("strandInference"):
+                    readIsGStrand = getIsGStrandFromSeq(seqUpper, compositionGStrand[targetPatternIndex], compositionCStrand[targetPatternIndex])
+                if not isinstance(readIsGStrand, (bool, np.bool_)):
+                    errorCode = errorReturns['fusedRead'] if readIsGStrand == errorReturns['fusedRead'] else errorReturns['strandType']
+                    telomereLengths[i] = errorCodes[i] = errorCode
+                    continue
+
+            composition = compositionGStrand if readIsGStrand else compositionCStrand
+            boundaryPoint, readIsGStrand = _getTeloBoundaryForStrand(seq, readIsGStrand, composition, teloWindow, windowStep, changeThreshold, plateauDetectionThreshold, targetPatternIndex, nucleotideGraphAreaWindowSize, False, None, returnLastDiscontinuity, secondarySearch, earlyTermination, maxScanLength, seqUpper, coarseWindowStep, workspace)
+            telomereLengths[i] = boundaryPoint
+            if readIsGStrand is None:
+                errorCodes[i] = boundaryPoint
+            else:
+                isGStrandOut[i] = readIsGStrand
+        finally:
+            if profiledRead:
+                profiling.endRead(telomereLengths[i], None if isGStrandOut[i] < 0 else isGStrandOut[i])
+    return telomereLengths, isGStrandOut, errorCodes
+
+
+def getTeloNPBoundaryBatch(seqs, isGStrand=None, compositionCStrandIn=teloNPTeloCompositionCStrand, \
+                    compositionGStrandIn=teloNPTeloCompositionGStrand, teloWindow=100, \
+                    windowStep=6, changeThreshold=-20, plateauDetectionThreshold=-60, \
+                    targetPatternIndex=-1, nucleotideGraphAreaWindowSize=750, \
+                    returnLastDiscontinuity=True, secondarySearch=True, earlyTermination=True, \
+                    maxScanLength=None, coarseWindowStep=None, prefilter=False, prefilterEndLength=prefilterEndLength, \
+                    prefilterMinRepeats=prefilterMinRepeats, prefilterKmersGStrand=teloNPPrefilterKmersGStrand, \
+                    prefilterKmersCStrand=teloNPPrefilterKmersCStrand, cache=None):
+    return getTeloBoundaryBatch(seqs, isGStrand, compositionCStrand=compositionCStrandIn, \
+                        compositionGStrand=compositionGStrandIn, teloWindow=teloWindow, \
+                        windowStep=windowStep, changeThreshold=changeThreshold, \
+                        plateauDetectionThreshold=plateauDetectionThreshold, \
+                        targetPatternIndex=targetPatternIndex, nucleotideGraphAreaWindowSize=nucleotideGraphAreaWindowSize, \
+                        returnLastDiscontinuity=returnLastDiscontinuity, secondarySearch=secondarySearch, \
+                        earlyTermination=earlyTermination, maxScanLength=maxScanLength, coarseWindowStep=coarseWindowStep, prefilter=prefilter, \
+                        prefilterEndLength=prefilterEndLength, prefilterMinRepeats=prefilterMinRepeats, \
+                        prefilterKmersGStrand=prefilterKmersGStrand, prefilterKmersCStrand=prefilterKmersCStrand, cache=cache)
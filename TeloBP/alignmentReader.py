@@ -0,0 +1,212 @@
+# Reader of the telomeric reads of aligned BAM and CRAM files.
+#
+# Reads aligned to a reference carry the chromosome arm and strand that getTeloBoundary otherwise
+# infers from the sequence with getIsGStrandFromSeq. readChromosomeEndReads streams the records of
+# a BAM (or CRAM) file and yields only the primary alignments that reach within endDistance bases of
+# a chromosome end, along with their strand from isGStrand(chrArm, strand), so the strand search is
+# skipped and the other reads are never decoded. Telomeric bases often don't align to the reference
+# and are soft clipped, so the distance to the chromosome end is measured from the unclipped ends of
+# the alignment. Sequences are returned in their sequenced orientation (reverse complemented back for
+# reads aligned to the minus strand), so results match those of the same reads in a fastq file.
+#
+# BAM files are decoded in pure Python by default, parsing only the position and CIGAR of each
+# record until it's known to be at a chromosome end. pysam is used instead if it's installed (or
+# with backend="pysam"), and is needed for CRAM files.
+
+import gzip
+import struct
+
+import numpy as np
+
+from TeloBP.TeloBP import isGStrand
+from TeloBP.constants import alignmentEndDistance
+
+alignmentExtensions = (".bam", ".cram")
+alignmentBackends = ("auto", "python", "pysam")
+
+# Unmapped, secondary and supplementary records
+_skippedFlags = 0x4 | 0x100 | 0x800
+_reverseFlag = 0x10
+
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+_recordHeader = struct.Struct("<iiBBHHHIiii")
+# CIGAR operations that consume the reference: M, D, N, = and X
+_referenceOps = np.array([True, False, True, True, False, False, False, True, True, False, False, False, False, False, False, False])
+_softClipOp = 4
+_hardClipOp = 5
+_seqCodes = np.frombuffer(b"=ACMGRSVTWYHKDBN", dtype=np.uint8)
+# Complements of every base a BAM sequence can hold: the IUPAC codes, and "=" (the reference base), which stays "="
+_complement = bytes.maketrans(b"ACGTMRWSYKVHDBNacgtmrwsykvhdbn=", b"TGCAKYWSRMBDHVNtgcakywsrmbdhvn=")
+_complementedBases = b"ACGTMRWSYKVHDBNacgtmrwsykvhdbn="
+# Sizes of the fixed size tag types, for skipping tags
+_tagSizes = {b"A": 1, b"c": 1, b"C": 1, b"s": 2, b"S": 2, b"i": 4, b"I": 4, b"f": 4}
+
+
+def isAlignmentFile(filename):
+    return filename.endswith(alignmentExtensions)
+
+
+def chromosomeEndArm(referenceLength, unclippedStart, unclippedEnd, endDistance=alignmentEndDistance):
+    """
+    Returns "p" if an alignment is within endDistance bases of the start of its chromosome, "q" if it is within
+    endDistance bases of its end, and None otherwise. An alignment near both ends gets the arm of the closer one.
+
+    :param unclippedStart, unclippedEnd: The reference positions of the alignment, extended by its soft clips
+    """
+    distanceToP = unclippedStart
+    distanceToQ = referenceLength - unclippedEnd
+    if distanceToP >= endDistance and distanceToQ >= endDistance:
+        return None
+    return "p" if distanceToP <= distanceToQ else "q"
+
+
+def _softClips(ops, lengths):
+    # Returns the leading and trailing soft clips of a cigar, given as sequences of operations and lengths.
+    # Soft clips are inside any hard clips.
+    first = 1 if ops[0] == _hardClipOp and len(ops) > 1 else 0
+    last = len(ops) - 2 if ops[-1] == _hardClipOp and len(ops) > 1 else len(ops) - 1
+    leadingClip = int(lengths[first]) if ops[first] == _softClipOp else 0
+    trailingClip = int(lengths[last]) if ops[last] == _softClipOp and last > first else 0
+    return leadingClip, trailingClip
+
+
+def _cigarSpan(cigar):
+    # Returns the reference length, and the leading and trailing soft clips of an array of BAM cigar operations
+    ops = cigar & 0xF
+    lengths = cigar >> 4
+    referenceLength = int(np.sum(lengths[_referenceOps[ops]]))
+    return (referenceLength,) + _softClips(ops, lengths)
+
+
+def _findArrayTag(tags, tagName):
+    # Returns the values of a B:I array tag of a BAM record, or None if it doesn't have the tag
+    pos = 0
+    while pos + 3 <= len(tags):
+        name = tags[pos:pos + 2]
+        valueType = tags[pos + 2:pos + 3]
+        pos += 3
+        if valueType in _tagSizes:
+            pos += _tagSizes[valueType]
+        elif valueType in (b"Z", b"H"):
+            pos = tags.index(b"\0", pos) + 1
+        elif valueType == b"B":
+            subtype = tags[pos:pos + 1]
+            count = struct.unpack_from("<i", tags, pos + 1)[0]
+            pos += 5
+            if name == tagName and subtype in (b"I", b"i"):
+                return np.frombuffer(tags, dtype=np.uint32, count=count, offset=pos)
+            pos += count * _tagSizes[subtype]
+        else:
+            raise ValueError(f"Invalid BAM tag type {valueType!r}")
+    return None
+
+
+def _decodeSeq(packed, seqLength):
+    # Decodes the 4 bit encoded sequence of a BAM record to bytes
+    codes = np.frombuffer(packed, dtype=np.uint8)
+    bases = np.empty(2 * len(codes), dtype=np.uint8)
+    bases[0::2] = _seqCodes[codes >> 4]
+    bases[1::2] = _seqCodes[codes & 0xF]
+    return bases[:seqLength].tobytes()
+
+
+def reverseComplement(seq):
+    # Raises a ValueError for bases without a complement, rather than keeping them as they are
+    otherBases = seq.translate(None, _complementedBases)
+    if otherBases:
+        raise ValueError(f"Can't complement the bases {bytes(sorted(set(otherBases)))!r} of the sequence")
+    return seq.translate(_complement)[::-1]
+
+
+def _readExact(handle, size, filename):
+    data = handle.read(size)
+    if len(data) != size:
+        raise ValueError(f"Truncated BAM file: {filename}")
+    return data
+
+
+def _readBamEnds(filename, endDistance):
+    # Pure Python BAM decoding, see readChromosomeEndReads. BGZF files are gzip files, which gzip reads member by member.
+    with gzip.open(filename, "rb") as handle:
+        if handle.read(4) != b"BAM\1":
+            raise ValueError(f"{filename} is not a BAM file")
+        textLength = struct.unpack("<i", _readExact(handle, 4, filename))[0]
+        _readExact(handle, textLength, filename)
+        numReferences = struct.unpack("<i", _readExact(handle, 4, filename))[0]
+        referenceLengths = []
+        for _ in range(numReferences):
+            nameLength = struct.unpack("<i", _readExact(handle, 4, filename))[0]
+            _readExact(handle, nameLength, filename)
+            referenceLengths.append(struct.unpack("<i", _readExact(handle, 4, filename))[0])
+
+        while True:
+            blockSizeBytes = handle.read(4)
+            if len(blockSizeBytes) == 0:
+                return
+            if len(blockSizeBytes) != 4:
+                raise ValueError(f"Truncated BAM file: {filename}")
+            record = _readExact(handle, struct.unpack("<i", blockSizeBytes)[0], filename)
+            refID, pos, nameLength, _, _, numCigarOps, flag, seqLength, _, _, _ = _recordHeader.unpack_from(record)
+            if flag & _skippedFlags or refID < 0 or numCigarOps == 0 or seqLength == 0:
+                continue
+            cigarStart = _recordHeader.size + nameLength
+            seqStart = cigarStart + 4 * numCigarOps
+            cigar = np.frombuffer(record, dtype=np.uint32, count=numCigarOps, offset=cigarStart)
+            # The cigars of more than 65535 operations are in the CG tag, in place of a placeholder kSmN cigar
+            if numCigarOps == 2 and cigar[0] & 0xF == _softClipOp and cigar[0] >> 4 == seqLength:
+                tagsStart = seqStart + (seqLength + 1) // 2 + seqLength
+                longCigar = _findArrayTag(record[tagsStart:], b"CG")
+                if longCigar is not None:
+                    cigar = longCigar
+            referenceSpan, leadingClip, trailingClip = _cigarSpan(cigar)
+            arm = chromosomeEndArm(referenceLengths[refID], pos - leadingClip, pos + referenceSpan + trailingClip, endDistance)
+            if arm is None:
+                continue
+            qname = record[_recordHeader.size:cigarStart - 1].decode()
+            seq = _decodeSeq(record[seqStart:seqStart + (seqLength + 1) // 2], seqLength)
+            strand = "-" if flag & _reverseFlag else "+"
+            yield qname, reverseComplement(seq) if strand == "-" else seq, isGStrand(arm, strand)
+
+
+def _readPysamEnds(filename, endDistance, reference):
+    import pysam
+    mode = "rc" if filename.endswith(".cram") else "rb"
+    with pysam.AlignmentFile(filename, mode, reference_filename=reference, check_sq=False) as alignments:
+        referenceLengths = alignments.lengths
+        for read in alignments.fetch(until_eof=True):
+            if read.flag & _skippedFlags or read.reference_id < 0 or not read.cigartuples or read.query_sequence is None:
+                continue
+            ops, lengths = zip(*read.cigartuples)
+            leadingClip, trailingClip = _softClips(ops, lengths)
+            arm = chromosomeEndArm(referenceLengths[read.reference_id], read.reference_start - leadingClip,
+                                   read.reference_end + trailingClip, endDistance)
+            if arm is None:
+                continue
+            seq = read.query_sequence.encode()
+            strand = "-" if read.is_reverse else "+"
+            yield read.query_name, reverseComplement(seq) if strand == "-" else seq, isGStrand(arm, strand)
+
+
+def readChromosomeEndReads(filename, endDistance=alignmentEndDistance, backend="auto", reference=None):
+    """
+    Yields (qname, sequence bytes, isGStrand) for the primary alignments of a BAM or CRAM file whose unclipped
+    alignment starts or ends within endDistance bases of the end of its chromosome. The sequence is in the
+    orientation it was sequenced in, and isGStrand is given by the chromosome arm and the alignment strand.
+
+    :param backend: "python" to decode BAM files in this module, "pysam" to use pysam, or "auto" to use pysam if
+           it's installed. CRAM files need pysam.
+    :param reference: The reference fasta of a CRAM file, if it isn't found from the CRAM header
+    """
+    if backend not in alignmentBackends:
+        raise ValueError(f"backend should be one of {alignmentBackends}")
+    if backend == "auto":
+        try:
+            import pysam
+            backend = "pysam"
+        except ImportError:
+            backend = "python"
+    if backend == "python":
+        if filename.endswith(".cram"):
+            raise ImportError("Reading CRAM files needs pysam, which can be installed with: pip install pysam")
+        return _readBamEnds(filename, endDistance)
+    return _readPysamEnds(filename, endDistance, reference)
@@ -52,9 +52,58 @@ teloNPTeloCompositionCStrand = [["CTTCTT|CCTGG|CCC(?!CCC)[ATCG]{3}", 6/6, 6]]
 # is considered to be plateauing.
 areaDiffsThreshold = 0.2
 
+# When getTeloBoundary runs with earlyTermination, the sequence is scored in chunks
+# starting from the telomeric end. This is the size of the first chunk in bases,
+# each following chunk is twice the size of the previous one.
+scanChunkSize = 10000
 
+# With coarseWindowStep, getTeloBoundary first searches for the boundary on windows coarseWindowStep bases
+# apart, then scores windows at windowStep only from coarseBracketSteps coarse steps before the coarse
+# threshold crossing to coarseBracketSteps coarse steps past the coarse plateau. Sequences shorter than
+# coarseMinScanLength are searched at windowStep only, as the extra pass costs more than it saves on them.
+defaultCoarseWindowStep = 60
+coarseBracketSteps = 2
+coarseMinScanLength = 40000
 
-errorReturns = {"init": -1, "fusedRead": -10,"strandType": -20, "seqNotFound": -1000}
+
+
+# Number of bases scanned at each end of a reference chromosome by refRecordTeloLengths
+referenceSearchSize = 500000
+# refRecordTeloLengths scans the first referenceArmScanLength bases from each chromosome end, and scans 4 times
+# as many (up to referenceSearchSize) while the boundary isn't confirmed within them. Reference telomeres are
+# 2-15 kb long, so most ends are settled by the first scan.
+referenceArmScanLength = 20000
+
+errorReturns = {"init": -1, "fusedRead": -10,"strandType": -20, "noTelomere": -30, "seqNotFound": -1000}
+
+# Telomere end prefilter. Before any strand or boundary work, the telomere repeat k-mers are searched
+# for in the first (C strand) and last (G strand) prefilterEndLength bases of the read. Reads without
+# prefilterMinRepeats repeats within prefilterBlockSize bases at either end are rejected with
+# errorReturns["noTelomere"]. prefilterEndLength covers the longest telomeres we expect (~30 kb).
+# A random 500 bp block has ~0.12 TTAGGG repeats on average.
+prefilterEndLength = 30000
+prefilterBlockSize = 500
+prefilterMinRepeats = 4
+prefilterKmersGStrand = ("TTAGGG",)
+prefilterKmersCStrand = ("CCCTAA",)
+# Guppy often calls telomeres as TTAAAA / CTTCTT repeats, so these are counted too for TeloNP
+teloNPPrefilterKmersGStrand = ("TTAGGG", "TTAAAA")
+teloNPPrefilterKmersCStrand = ("CCCTAA", "CTTCTT")
+
+# On-disk result cache (see TeloBP.resultCache). The least recently used results are evicted once the
+# cache holds more than resultCacheMaxEntries reads (roughly 60 bytes each).
+resultCacheMaxEntries = 10000000
+# Part of every cache key. Increase it when a change to the algorithm changes its results, so that
+# results cached by earlier versions are not reused.
+resultCacheVersion = 1
+
+# Number of rows per row group of the Parquet and Arrow read tables (see TeloBP.readTable)
+readTableRowGroupSize = 100000
+
+# Aligned reads (see TeloBP.alignmentReader) are analyzed if their unclipped alignment starts or ends within
+# alignmentEndDistance bases of a chromosome end. It covers the unplaced sequence at the ends of assemblies
+# like hg38 (10 kb of Ns before most p arms), with room for reads whose telomere is soft clipped.
+alignmentEndDistance = 20000
 
 
 # The following dictionaries are used to test the telomere length and
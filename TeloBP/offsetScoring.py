@@ -0,0 +1,476 @@
+# Scoring of the nucleotide offset matrix used by getTeloBoundary.
+#
+# The original implementation sliced every teloWindow sized window out of the read and
+# ran re.findall on it once per pattern, so each base was re-scanned teloWindow/windowStep
+# times. Here each composition pattern is run once over the whole read, and the per window
+# match counts are derived from the match start positions with NumPy. The counts (and so
+# the offsets) are identical to the per window findall counts, i.e. leftmost, non-overlapping
+# matches confined to the window.
+#
+# Patterns whose alternatives can be compiled by TeloBP.patternMatcher (all the default and TeloNP
+# compositions) get their match positions from NumPy hit vectors, the others from regex finders.
+#
+# Sequences are scored as uppercase bytes (see asUpperSeqBytes), with the patterns compiled
+# as bytes patterns, and the scored regions are memoryview slices rather than copies.
+#
+# Only the match positions of each pattern are kept, rather than tables with an entry per base, and
+# the offset arrays of a read can be taken from a ScoringWorkspace, which getTeloBoundaryBatch reuses
+# for all the reads of a batch, so that they are only allocated again when a longer read arrives.
+
+import functools
+import re
+
+import numpy as np
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+from TeloBP.teloBoundaryHelpers import is_regex_pattern, getGraphArea, findThresholdIndex, findPlateauIndex, asUpperSeqBytes
+from TeloBP.patternMatcher import compilePatternMatcher, matcherHits, _firstAlternative
+from TeloBP.constants import scanChunkSize
+import TeloBP.profiling as profiling
+
+
+class ScoringWorkspace:
+    """
+    Buffers reused by the window scoring of successive reads. Each named buffer grows to the largest size requested
+    so far, and the arrays returned are views of it, so they are only valid until the buffer is requested again.
+    A workspace must only be used by one thread at a time.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def array(self, name, shape, dtype):
+        # Returns an uninitialized array of the given shape, a view of the buffer called name
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or len(buffer) < size:
+            # Some headroom, so that reads slightly longer than the previous longest don't reallocate
+            buffer = np.empty(size if buffer is None else max(size, len(buffer) + len(buffer) // 2), dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer[:size].reshape(shape)
+
+
+_UNIT_OPS = (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN)
+_REPEAT_OPS = tuple(getattr(sre_constants, name) for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+                    if hasattr(sre_constants, name))
+
+
+def _splitTopLevelAlternation(pattern):
+    # Splits "A|B|C" into its top level alternatives, ignoring any "|" nested in groups or classes
+    branches = []
+    current = []
+    depth = 0
+    inClass = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            current.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if inClass:
+            if c == "]":
+                inClass = False
+        elif c == "[":
+            inClass = True
+            # a "]" directly after "[" or "[^" is a literal
+            j = i + 1
+            if j < len(pattern) and pattern[j] == "^":
+                j += 1
+            if j < len(pattern) and pattern[j] == "]":
+                current.append(pattern[i:j + 1])
+                i = j + 1
+                continue
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            branches.append("".join(current))
+            current = []
+            i += 1
+            continue
+        current.append(c)
+        i += 1
+    branches.append("".join(current))
+    return branches
+
+
+def _maxReach(subpattern):
+    # Returns (maximum width, reach) of a parsed pattern, where reach is the furthest position past the
+    # match start that the regex engine may inspect (lookaheads can inspect past the end of the match).
+    # Returns None for constructs that may look outside of the match (lookbehinds, anchors, backreferences)
+    # or are unbounded.
+    cur = 0
+    reach = 0
+    for op, av in subpattern:
+        if op in _UNIT_OPS:
+            cur += 1
+            reach = max(reach, cur)
+        elif op is sre_constants.SUBPATTERN:
+            res = _maxReach(av[-1])
+            if res is None:
+                return None
+            reach = max(reach, cur + res[1])
+            cur += res[0]
+        elif op is sre_constants.BRANCH:
+            results = [_maxReach(branch) for branch in av[1]]
+            if any(res is None for res in results):
+                return None
+            reach = max(reach, cur + max(res[1] for res in results))
+            cur += max(res[0] for res in results)
+        elif op in _REPEAT_OPS:
+            low, high, item = av
+            res = _maxReach(item)
+            if res is None or high == sre_constants.MAXREPEAT:
+                return None
+            if high > 0:
+                reach = max(reach, cur + (high - 1) * res[0] + res[1])
+                cur += high * res[0]
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            direction, item = av
+            res = _maxReach(item)
+            if direction < 0 or res is None:
+                return None
+            reach = max(reach, cur + res[1])
+        else:
+            return None
+    return cur, reach
+
+
+@functools.lru_cache(maxsize=None)
+def _compileFastPattern(pattern):
+    """
+    Splits a composition pattern into its top level alternatives and compiles an overlapping
+    finder for each of them. Returns a tuple of (finder, width) pairs, in the order the regex engine
+    tries the alternatives, or None if the pattern can't be scored from whole read match positions
+    (in that case the per window reference scoring is used for it).
+
+    Every alternative must match a fixed number of bases, and must not inspect anything outside of
+    the bases it matches. This guarantees that a match found in the whole read is also a match within
+    any window containing it.
+    """
+    try:
+        if re.compile(pattern).flags != re.UNICODE:
+            return None
+        branches = []
+        for branch in _splitTopLevelAlternation(pattern):
+            parsed = sre_parse.parse(branch)
+            minWidth, maxWidth = parsed.getwidth()
+            res = _maxReach(parsed)
+            if res is None or minWidth != maxWidth or minWidth < 1 or res[1] > maxWidth:
+                return None
+            branches.append((re.compile(("(?=(?:" + branch + "))").encode()), maxWidth))
+    except (re.error, RecursionError, UnicodeEncodeError):
+        return None
+    return tuple(branches)
+
+
+@functools.lru_cache(maxsize=None)
+def _patternMatchers(pattern):
+    # Returns the compiled matchers of a pattern that has a fast path, or None to use its regex finders
+    if _compileFastPattern(pattern) is None:
+        return None
+    return compilePatternMatcher(tuple(_splitTopLevelAlternation(pattern)))
+
+
+def _chainCounts(candStarts, candEnds, firstCand, lastCand, maxSteps):
+    # Counts the leftmost, non-overlapping chain of candidates starting at firstCand, stopping
+    # before lastCand, for every window at once using binary lifting over the "next candidate" jumps.
+    numCands = len(candStarts)
+    jump = np.append(np.searchsorted(candStarts, candEnds, "left"), numCands)
+    jumps = []
+    for _ in range(int(maxSteps).bit_length()):
+        jumps.append(jump)
+        jump = jump[jump]
+
+    node = firstCand.copy()
+    counts = (node < lastCand).astype(np.int64)
+    for k in reversed(range(len(jumps))):
+        nextNode = jumps[k][node]
+        ok = (counts > 0) & (nextNode < lastCand)
+        node = np.where(ok, nextNode, node)
+        counts += ok.astype(np.int64) << k
+    return counts, node
+
+
+@functools.lru_cache(maxsize=None)
+def _bytesPattern(pattern):
+    # Compiles a composition pattern for bytes sequences, or returns None if it is only valid for strings
+    try:
+        return re.compile(pattern.encode())
+    except (re.error, UnicodeEncodeError):
+        return None
+
+
+def _referencePatternCounts(seq, windowStarts, teloWindow, pattern):
+    compiled = _bytesPattern(pattern)
+    if compiled is None:
+        compiled = re.compile(pattern)
+        return np.array([len(compiled.findall(bytes(seq[start:start + teloWindow]).decode("latin-1"))) for start in windowStarts], dtype=np.int64)
+    return np.array([len(compiled.findall(seq[start:start + teloWindow])) for start in windowStarts], dtype=np.int64)
+
+
+def _hitsAt(hits, positions):
+    # Returns whether each position is in the sorted array hits
+    index = np.searchsorted(hits, positions, "left")
+    found = index < len(hits)
+    found[found] = hits[index[found]] == positions[found]
+    return found
+
+
+def _windowPatternCounts(seq, windowStarts, teloWindow, pattern):
+    """
+    Returns the number of re.findall matches of pattern in seq[start:start + teloWindow] for each window start.
+    """
+    branches = _compileFastPattern(pattern)
+    if branches is None:
+        return _referencePatternCounts(seq, windowStarts, teloWindow, pattern)
+
+    widths = [width for _, width in branches]
+    minWidth, maxWidth = min(widths), max(widths)
+    matchers = _patternMatchers(pattern)
+    if matchers is not None:
+        branchHits = matcherHits(matchers, seq)
+    else:
+        branchHits = [np.fromiter((match.start() for match in finder.finditer(seq)), dtype=np.int64)
+                      for finder, _ in branches]
+
+    # The positions where an alternative matches, and the end of the match of the first alternative matching there,
+    # which is the one the regex engine prefers
+    candStarts, candEnds = _firstAlternative(branchHits, [hits + width for hits, width in zip(branchHits, widths)])
+
+    windowEnds = windowStarts + teloWindow
+    # Matches starting at or before interiorLimits fit in the window whichever alternative is used
+    interiorLimits = windowEnds - maxWidth
+    firstCand = np.searchsorted(candStarts, windowStarts, "left")
+    lastCand = np.searchsorted(candStarts, interiorLimits, "right")
+
+    if len(candStarts) == 0:
+        counts = np.zeros(len(windowStarts), dtype=np.int64)
+        cursor = windowStarts.copy()
+    else:
+        if np.all(candEnds[:-1] <= candStarts[1:]):
+            # No candidates overlap, so every window's chain is simply every candidate inside it,
+            # which is given by the prefix count of the match start positions.
+            counts = np.maximum(lastCand - firstCand, 0)
+            lastNode = firstCand + counts - 1
+        else:
+            counts, lastNode = _chainCounts(candStarts, candEnds, firstCand, lastCand, teloWindow // minWidth + 1)
+        cursor = np.where(counts > 0, candEnds[np.clip(lastNode, 0, len(candStarts) - 1)], windowStarts)
+
+    if maxWidth > minWidth:
+        # Near the end of a window only the shorter alternatives still fit, so the match found
+        # there may differ from the one found in the whole read.
+        cursor = np.maximum(cursor, interiorLimits + 1)
+        while True:
+            room = windowEnds - cursor
+            active = room >= minWidth
+            if not active.any():
+                break
+            # The width of the first alternative that fits in the room left and matches at the cursor, 0 if none does
+            width = np.zeros(len(cursor), dtype=np.int64)
+            for hits, branchWidth in reversed(list(zip(branchHits, widths))):
+                fits = active & (room >= branchWidth)
+                fits[fits] = _hitsAt(hits, cursor[fits])
+                width[fits] = branchWidth
+            counts += width > 0
+            cursor = np.where(active, cursor + np.maximum(width, 1), cursor)
+
+    return counts
+
+
+def _patternTargetLength(ntPatternEntry):
+    ntPattern = ntPatternEntry[0]
+    if is_regex_pattern(ntPattern) == True:
+        if len(ntPatternEntry) != 3:
+            raise ValueError("Error: a target length must be specified as a third list item if using a regex pattern. Example: ['GGG|AAA', 3/6, 3], where the third item is the target length.")
+        return ntPatternEntry[2]
+    return len(ntPattern)
+
+
+def getWindowStarts(seqLen, isGStrand, teloWindow, windowStep):
+    """
+    Returns the start index of every window scored by getTeloBoundary, in scoring order. Windows
+    are scored from the telomeric end of the sequence, so for the G strand they run from the end
+    of the sequence backwards.
+    """
+    offsets = np.arange(0, seqLen - teloWindow, windowStep, dtype=np.int64)
+    if isGStrand == True:
+        return (seqLen - offsets) - teloWindow
+    return offsets
+
+
+def scoreWindows(seq, windowStarts, composition, teloWindow, workspace=None):
+    """
+    Returns a (number of windows, number of patterns) array of the offsets of each window's nucleotide
+    composition from the expected telomere composition, as percentages.
+
+    :param seq: The uppercase sequence, as bytes or a memoryview (see asUpperSeqBytes)
+    :param windowStarts: A NumPy array with the start index of each window in seq
+    :param composition: A list of lists, where each list contains a nucleotide pattern, the expected
+           composition of the pattern and, for regex patterns, the length of the pattern.
+    :param teloWindow: The size of the windows
+    :param workspace: A ScoringWorkspace to take the offsets array from. The offsets returned are then only valid
+           until the next use of the workspace.
+    """
+    windowStarts = np.asarray(windowStarts, dtype=np.int64)
+    if workspace is None:
+        workspace = ScoringWorkspace()
+    ntOffsets = workspace.array("ntOffsets", (len(windowStarts), len(composition)), np.float64)
+    if len(windowStarts) == 0:
+        return ntOffsets
+
+    for col, ntPatternEntry in enumerate(composition):
+        ntPattern = ntPatternEntry[0]
+        patternComposition = ntPatternEntry[1]
+        targetLength = _patternTargetLength(ntPatternEntry)
+        patternCount = _windowPatternCounts(seq, windowStarts, teloWindow, ntPattern)
+        # Same operation order as the per window implementation, so that the values are bit identical
+        rawOffsetValue = (patternCount * targetLength) / teloWindow - patternComposition
+        if patternComposition != 0:
+            ntOffsets[:, col] = (rawOffsetValue / patternComposition) * 100
+        else:
+            ntOffsets[:, col] = rawOffsetValue * 100
+    return ntOffsets
+
+
+def scoreWindowRange(seq, composition, isGStrand, teloWindow=100, windowStep=6, firstWindow=0, lastWindow=None, workspace=None):
+    """
+    Returns the offsets of windows firstWindow to lastWindow (exclusive, in scoring order) from the expected
+    telomere composition, as a (number of windows, number of patterns) array. Only the part of the sequence
+    covered by these windows is read. See scoreWindows for workspace.
+
+    The sequence can be a str, Bio Seq, bytes, memoryview or NumPy uint8 array. It is only copied if it isn't
+    already uppercase bytes.
+    """
+    seq = asUpperSeqBytes(seq)
+    windowStarts = getWindowStarts(len(seq), isGStrand, teloWindow, windowStep)[firstWindow:lastWindow]
+    if len(windowStarts) == 0:
+        return np.empty((0, len(composition)))
+    regionStart = windowStarts.min()
+    regionEnd = windowStarts.max() + teloWindow
+    # Bases covered by these windows and not by the windows before them
+    profiling.count(len(windowStarts), len(windowStarts) * windowStep + (teloWindow - windowStep if firstWindow == 0 else 0))
+    region = memoryview(seq)[regionStart:regionEnd]
+    return scoreWindows(region, windowStarts - regionStart, composition, teloWindow, workspace)
+
+
+def getNtOffsets(seq, composition, isGStrand, teloWindow=100, windowStep=6, numWindows=None, workspace=None):
+    """
+    Returns the offsets of every window in the sequence from the expected telomere composition, as a
+    (number of windows, number of patterns) array. Equivalent to getNtOffsetsReference.
+
+    :param seq: The sequence to be analyzed
+    :param composition: The composition list for the strand of the sequence
+    :param isGStrand: True if the sequence is the G strand, in which case windows are scored from the end of the sequence
+    :param teloWindow: The size of the windows
+    :param windowStep: The step size between windows
+    :param numWindows: If given, only the first numWindows windows from the telomeric end are scored
+    :param workspace: See scoreWindows
+    """
+    return scoreWindowRange(seq, composition, isGStrand, teloWindow, windowStep, 0, numWindows, workspace)
+
+
+def scanGraphAreaUntilBoundary(seq, ntPatternEntry, isGStrand, teloWindow, windowStep, numWindows, graphAreaWindowSize, plateauDetectionThreshold, chunkSize=scanChunkSize, workspace=None):
+    """
+    Scores the windows of the sequence in chunks, starting from the telomeric end, and stops as soon as
+    the boundary search of getTeloBoundary (with returnLastDiscontinuity off) is settled, i.e. a point below
+    plateauDetectionThreshold has been found, followed by the point where the area differences plateau.
+
+    Returns the area list of the windows scored so far. Searching it gives the same boundary as searching the
+    area list of the whole sequence, since every area in it is final and the search never needs to look past it.
+
+    :param ntPatternEntry: The composition entry of the pattern used to find the boundary
+    :param numWindows: The total number of windows that may be scored
+    :param chunkSize: The number of bases scored in the first chunk. Each following chunk is twice as large.
+    :param workspace: A ScoringWorkspace to score the windows in, see scoreWindows
+    """
+    seq = asUpperSeqBytes(seq)
+    if workspace is None:
+        workspace = ScoringWorkspace()
+    # The offsets of the windows scored so far are written to the start of this array
+    allOffsets = workspace.array("scanOffsets", (numWindows, 1), np.float64)
+    areaList = np.empty(0)
+    chunkWindows = max(chunkSize // windowStep, 1)
+    scoredWindows = 0
+    indexAtThreshold = -1
+    thresholdSearchStart = 0
+    plateauSearchStart = 0
+    while scoredWindows < numWindows:
+        lastWindow = min(scoredWindows + chunkWindows, numWindows)
+        with profiling.stage("windowScoring"):
+            allOffsets[scoredWindows:lastWindow] = scoreWindowRange(seq, [ntPatternEntry], isGStrand, teloWindow, windowStep, scoredWindows, lastWindow, workspace)
+        scoredWindows = lastWindow
+        # The areas are recomputed over all the offsets so far, so they are identical to the areas of the whole
+        # sequence. Only the areas whose window of offsets has been fully scored are included.
+        with profiling.stage("areaCurve"):
+            areaList = getGraphArea(allOffsets[:scoredWindows], 0, graphAreaWindowSize)
+
+        with profiling.stage("thresholdSearch"):
+            if indexAtThreshold == -1:
+                indexAtThreshold = findThresholdIndex(areaList, plateauDetectionThreshold, thresholdSearchStart)
+                thresholdSearchStart = max(len(areaList) - 2, 0)
+            plateauFound = indexAtThreshold != -1 and findPlateauIndex(np.diff(areaList), max(indexAtThreshold, plateauSearchStart)) != -1
+        if plateauFound:
+            break
+        if indexAtThreshold != -1:
+            plateauSearchStart = max(len(areaList) - 2, indexAtThreshold)
+        chunkWindows *= 2
+    return areaList
+
+
+def getNtOffsetsReference(seq, composition, isGStrand, teloWindow=100, windowStep=6):
+    """
+    Per window reference implementation of getNtOffsets, which runs re.findall on every window.
+    Kept to check the vectorized implementation against. Returns a list of lists.
+    """
+    seq = asUpperSeqBytes(seq).decode("latin-1")
+    ntOffsets = []
+    for i in range(0, len(seq) - teloWindow, windowStep):
+        teloSeq = ""
+        if isGStrand == True:
+            teloSeq = seq[(len(seq) - i) - teloWindow:len(seq) - i]
+        else:
+            teloSeq = seq[i:i + teloWindow]
+        teloLen = len(teloSeq)
+        teloSeqUpper = str(teloSeq.upper())
+
+        currentOffsets = []
+        # Calculate the offset of the nucleotide composition from the expected telomere composition
+        for ntPatternEntry in composition:
+            ntPattern = ntPatternEntry[0]
+            patternComposition = ntPatternEntry[1]
+            patternCount = len(re.findall(ntPattern, teloSeqUpper))
+            if is_regex_pattern(ntPattern) == True:
+                if len(ntPatternEntry) != 3:
+                    raise ValueError("Error: a target length must be specified as a third list item if using a regex pattern. Example: ['GGG|AAA', 3/6, 3], where the third item is the target length.")
+                regexTargetLength = ntPatternEntry[2]
+                rawOffsetValue = (
+                    (patternCount * regexTargetLength) / teloLen - patternComposition)
+            else:
+                # patternCount = the number of times we see the pattern
+                # len(ntPattern) = the length of the pattern, so GGG is 3
+                # teloLen = the length of the telomere window
+                # patternComposition = the expected composition of the pattern, so 3/6 for GGG
+                # Here we get an offset score based on the number of nucleotides we expect to see, given the pattern composition
+                rawOffsetValue = (
+                    (patternCount * len(ntPattern)) / teloLen - patternComposition)
+            if patternComposition != 0:
+                # Here we convert the raw offset score to a percentage
+                percentOffsetValue = (
+                    rawOffsetValue / patternComposition) * 100
+                currentOffsets.append(percentOffsetValue)
+            else:
+                # Incase the expected composition is 0, we just return the raw offset score
+                percentOffsetValue = (rawOffsetValue) * 100
+                currentOffsets.append(percentOffsetValue)
+
+        ntOffsets.append(currentOffsets)
+    return ntOffsets
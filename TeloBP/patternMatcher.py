@@ -0,0 +1,272 @@
+# Compiled matchers for fixed width composition patterns.
+#
+# The TeloNP compositions are alternations with lookaheads, e.g. "(?!GGG)[ATC]{2}.GGG|(?!AAA)[AT]{3}AAA|TTAGG.".
+# Running an overlapping regex finder for every alternative makes the regex engine re-evaluate the
+# lookaheads at every position, and yields one Python match object per hit. Since every alternative
+# matches a fixed number of bases, whether it matches at a position only depends on the bases at fixed
+# offsets from it. compilePatternMatcher turns each alternative into a list of terms over these offsets
+# (a 256 entry lookup table per base, and the and/or/not of lookaheads and nested alternations), which
+# are evaluated for every position of a sequence at once with NumPy, giving a hit vector per alternative.
+# Each distinct lookup table is applied to the sequence once, and shared by all the terms that use it.
+#
+# repeatMatchSpans uses the same hit vectors to find the repeat runs that getIsGStrandFromSeq counts,
+# without running the backtracking regex of the repeated pattern.
+
+import functools
+import re
+
+import numpy as np
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+
+_REPEAT_OPS = tuple(getattr(sre_constants, name) for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+                    if hasattr(sre_constants, name))
+
+# Term kinds
+_BASE, _ANY_OF, _NONE_OF = 0, 1, 2
+
+# Lookup tables matching (or not matching) at most this many bytes are applied with comparisons
+_maxCompares = 8
+
+
+def _unitTable(op, av):
+    # Returns the 256 entry lookup table of the bytes matched by a single base unit, or None if it isn't supported
+    table = np.zeros(256, dtype=bool)
+    if op is sre_constants.LITERAL:
+        if av > 127:
+            return None
+        table[av] = True
+    elif op is sre_constants.NOT_LITERAL:
+        if av > 127:
+            return None
+        table[:] = True
+        table[av] = False
+    elif op is sre_constants.ANY:
+        table[:] = True
+        table[ord("\n")] = False
+    elif op is sre_constants.IN:
+        negate = False
+        for itemOp, itemAv in av:
+            if itemOp is sre_constants.NEGATE:
+                negate = True
+            elif itemOp is sre_constants.LITERAL and itemAv <= 127:
+                table[itemAv] = True
+            elif itemOp is sre_constants.RANGE and itemAv[1] <= 127:
+                table[itemAv[0]:itemAv[1] + 1] = True
+            else:
+                return None
+        if negate:
+            table = ~table
+    else:
+        return None
+    return table
+
+
+def _compileTerms(subpattern, offset):
+    # Compiles a parsed pattern matching at offset into (terms, width), where terms must all hold for a match.
+    # Returns None for anything that isn't fixed width, or may look outside of the bases it matches.
+    terms = []
+    cur = offset
+    for op, av in subpattern:
+        table = _unitTable(op, av)
+        if table is not None:
+            terms.append((_BASE, cur, table.tobytes()))
+            cur += 1
+        elif op is sre_constants.SUBPATTERN:
+            if av[1] or av[2]:
+                # inline flags, e.g. (?i:...)
+                return None
+            res = _compileTerms(av[-1], cur)
+            if res is None:
+                return None
+            terms.extend(res[0])
+            cur += res[1]
+        elif op is sre_constants.BRANCH:
+            alternatives = [_compileTerms(branch, cur) for branch in av[1]]
+            if any(res is None for res in alternatives) or len({res[1] for res in alternatives}) != 1:
+                return None
+            terms.append((_ANY_OF, tuple(tuple(res[0]) for res in alternatives)))
+            cur += alternatives[0][1]
+        elif op in _REPEAT_OPS:
+            low, high, item = av
+            if low != high:
+                return None
+            for _ in range(low):
+                res = _compileTerms(item, cur)
+                if res is None:
+                    return None
+                terms.extend(res[0])
+                cur += res[1]
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            direction, item = av
+            res = _compileTerms(item, cur)
+            if direction < 0 or res is None:
+                return None
+            if op is sre_constants.ASSERT:
+                terms.extend(res[0])
+            else:
+                terms.append((_NONE_OF, tuple(res[0])))
+        else:
+            return None
+    return terms, cur - offset
+
+
+@functools.lru_cache(maxsize=None)
+def compilePatternMatcher(branches):
+    """
+    Compiles the top level alternatives of a composition pattern (as split by offsetScoring) into matchers.
+    Returns a tuple of (terms, width) per alternative, or None if any alternative can't be compiled, in which
+    case the regex finders are used instead.
+
+    Lookaheads must stay within the bases matched by the alternative, so every term is within [0, width).
+    """
+    matchers = []
+    try:
+        for branch in branches:
+            res = _compileTerms(sre_parse.parse(branch), 0)
+            if res is None or res[1] < 1 or _maxOffset(res[0]) >= res[1]:
+                return None
+            matchers.append((tuple(res[0]), res[1]))
+    except (re.error, RecursionError):
+        return None
+    return tuple(matchers)
+
+
+def _maxOffset(terms):
+    offsets = [-1]
+    for term in terms:
+        if term[0] == _BASE:
+            offsets.append(term[1])
+        elif term[0] == _ANY_OF:
+            offsets.extend(_maxOffset(alternative) for alternative in term[1])
+        else:
+            offsets.append(_maxOffset(term[1]))
+    return max(offsets)
+
+
+def _evaluateTerms(terms, mappedBases, numPositions):
+    # Returns a boolean array, True at the positions where all the terms hold
+    result = np.ones(numPositions, dtype=bool)
+    for term in terms:
+        kind = term[0]
+        if kind == _BASE:
+            result &= mappedBases(term[2])[term[1]:term[1] + numPositions]
+        elif kind == _ANY_OF:
+            anyOf = np.zeros(numPositions, dtype=bool)
+            for alternative in term[1]:
+                anyOf |= _evaluateTerms(alternative, mappedBases, numPositions)
+            result &= anyOf
+        else:
+            result &= ~_evaluateTerms(term[1], mappedBases, numPositions)
+    return result
+
+
+def _applyTable(table, bases):
+    # Tables of a few bases (or all but a few) are applied with comparisons, which are much faster than a lookup
+    matched = np.flatnonzero(table)
+    if len(matched) <= _maxCompares:
+        result = np.zeros(len(bases), dtype=bool)
+        for base in matched:
+            result |= bases == base
+        return result
+    unmatched = np.flatnonzero(~table)
+    if len(unmatched) <= _maxCompares:
+        result = np.ones(len(bases), dtype=bool)
+        for base in unmatched:
+            result &= bases != base
+        return result
+    return np.take(table, bases)
+
+
+def matcherMasks(matchers, seq, mapped=None):
+    """
+    Returns, for each compiled alternative, a boolean array that is True at the positions of seq where it
+    matches. seq is a bytes-like sequence, it is read through a NumPy view without copying it. The mapped dict
+    can be shared between calls on the same sequence, so the lookup tables common to several patterns are
+    only applied once.
+    """
+    bases = np.frombuffer(seq, dtype=np.uint8)
+    if mapped is None:
+        mapped = {}
+
+    def mappedBases(table):
+        # Applies a lookup table to the whole sequence, once per distinct table
+        if table not in mapped:
+            mapped[table] = _applyTable(np.frombuffer(table, dtype=bool), bases)
+        return mapped[table]
+
+    masks = []
+    for terms, width in matchers:
+        mask = np.zeros(len(bases), dtype=bool)
+        numPositions = len(bases) - width + 1
+        if numPositions > 0:
+            mask[:numPositions] = _evaluateTerms(terms, mappedBases, numPositions)
+        masks.append(mask)
+    return masks
+
+
+def matcherHits(matchers, seq, mapped=None):
+    # Returns, for each compiled alternative, the sorted start positions in seq where it matches
+    return [np.flatnonzero(mask) for mask in matcherMasks(matchers, seq, mapped)]
+
+
+def repeatMatchSpans(matchers, seq, repeats, maxGap, mapped=None):
+    """
+    Returns the (start, end) spans of the matches that re.finditer gives for the pattern repeated
+    repeats times, with up to maxGap bases between repeats, i.e. ("(" + pattern + ")" + ".{0,maxGap}") * repeats
+    without the last gap. seq must not contain line breaks, which "." doesn't match.
+
+    The regex engine tries the alternatives of each repeat in order, and the longest gap first. Whether a match
+    can be completed from a position only depends on the position and the repeat, so the end of the first
+    complete match the engine would find is computed for all the hits of the pattern at once, from the last
+    repeat back to the first. The longest gap that can be completed is a search for the last position, within
+    maxGap bases of the end of the hit, where the rest of the match can be completed.
+    """
+    hits = matcherHits(matchers, seq, mapped)
+
+    # completable and completableEnds are the sorted positions where the remaining repeats can be matched,
+    # and the end of the match from each of them
+    completable = completableEnds = None
+    for _ in range(repeats):
+        positions, ends = [], []
+        for (_, width), starts in zip(matchers, hits):
+            if completable is None:
+                positions.append(starts)
+                ends.append(starts + width)
+                continue
+            lastInGap = np.searchsorted(completable, starts + width + maxGap, "right") - 1
+            ok = lastInGap >= 0
+            ok[ok] = completable[lastInGap[ok]] >= starts[ok] + width
+            positions.append(starts[ok])
+            ends.append(completableEnds[lastInGap[ok]])
+        completable, completableEnds = _firstAlternative(positions, ends)
+        if len(completable) == 0:
+            return []
+
+    # finditer continues searching from the end of each match
+    nextMatch = np.searchsorted(completable, completableEnds, "left").tolist()
+    starts, ends = completable.tolist(), completableEnds.tolist()
+    spans = []
+    i = 0
+    while i < len(starts):
+        spans.append((starts[i], ends[i]))
+        i = nextMatch[i]
+    return spans
+
+
+def _firstAlternative(positions, ends):
+    # Merges the (positions, ends) of each alternative, given in priority order, keeping the first alternative
+    # at positions where several of them match
+    if len(positions) == 1:
+        return positions[0], ends[0]
+    positions = np.concatenate(positions)
+    ends = np.concatenate(ends)
+    order = np.argsort(positions, kind="stable")
+    positions, first = np.unique(positions[order], return_index=True)
+    return positions, ends[order[first]]
@@ -0,0 +1,256 @@
+# Per-stage profiling of the boundary search.
+#
+# When the throughput drops on a dataset, the time of each read can be split into the stages of
+# getTeloBoundary: the prefilter, strand inference, window scoring, the area curve, the threshold
+# search and the secondary search. Profiling is enabled by making a BoundaryProfiler active with
+# `with profiled() as profiler:`, after which every read analyzed by getTeloBoundary or the batch
+# functions in this process is recorded: its length, result, wall time, the time of each stage, and
+# the number of windows scored and bases scanned. ProfileAccumulator turns the recorded reads into
+# totals and histograms, in constant memory, e.g. for each sample of a teloBPCmd.py run.
+#
+# When no profiler is active, stage() returns a shared no-op context manager and the other hooks
+# return immediately, so the instrumentation costs a global lookup per stage.
+
+import contextlib
+import functools
+import time
+
+import numpy as np
+
+profileStages = ("prefilter", "strandInference", "windowScoring", "areaCurve", "thresholdSearch", "secondarySearch")
+_stageIndex = {name: index for index, name in enumerate(profileStages)}
+
+# Per read columns of BoundaryProfiler.readArrays, other than stageSeconds
+_readColumns = (("readLength", np.int64), ("telomereLength", np.int64), ("isGStrand", np.int8), ("seconds", np.float64),
+                ("windowsScored", np.int64), ("basesScanned", np.int64))
+
+# Histogram bin edges: read times from 1 us to 100 s, and counts in powers of 2
+_secondsEdges = 10.0 ** np.arange(-6, 2.25, 0.25)
+_countEdges = np.concatenate(([0], 2.0 ** np.arange(0, 32)))
+
+# The BoundaryProfiler recording the reads analyzed in this process, or None when profiling is disabled
+activeProfiler = None
+
+_noStage = contextlib.nullcontext()
+
+
+class _Stage:
+    # Times a stage of the current read
+    __slots__ = ("profiler", "index", "start")
+
+    def __init__(self, profiler, index):
+        self.profiler = profiler
+        self.index = index
+
+    def __enter__(self):
+        self.profiler._stageDepth += 1
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.profiler._read[6 + self.index] += time.perf_counter() - self.start
+        self.profiler._stageDepth -= 1
+        return False
+
+
+class BoundaryProfiler:
+    """
+    Records the reads analyzed while it is active (see profiled). Stages run within another stage (e.g. the
+    window scoring of the secondary search) are counted in the outer stage only.
+
+    :param onRead: Optional callback, called with a dict of the columns of readArrays (and the stage times as
+           a dict) after every read
+    :param keepReads: If False, the reads are only passed to onRead, and not kept for readArrays
+    """
+
+    def __init__(self, onRead=None, keepReads=True):
+        self.onRead = onRead
+        self.keepReads = keepReads
+        self.clear()
+
+    def clear(self):
+        self.rows = []
+        self._read = None
+        self._stageDepth = 0
+        self._readStart = 0.0
+
+    def startRead(self, readLength):
+        # Reads analyzed within a read (the secondary search) are part of it
+        if self._read is not None:
+            return False
+        # readLength, telomereLength, isGStrand, seconds, windowsScored, basesScanned, then the stage times
+        self._read = [readLength, 0, -1, 0.0, 0, 0] + [0.0] * len(profileStages)
+        self._stageDepth = 0
+        self._readStart = time.perf_counter()
+        return True
+
+    def endRead(self, telomereLength, isGStrand):
+        read = self._read
+        self._read = None
+        read[1] = int(telomereLength)
+        read[2] = -1 if isGStrand is None else int(isGStrand)
+        read[3] = time.perf_counter() - self._readStart
+        if self.keepReads:
+            self.rows.append(read)
+        if self.onRead is not None:
+            record = {name: value for (name, _), value in zip(_readColumns, read)}
+            record["stageSeconds"] = dict(zip(profileStages, read[6:]))
+            self.onRead(record)
+
+    def stage(self, name):
+        if self._read is None or self._stageDepth > 0:
+            return _noStage
+        return _Stage(self, _stageIndex[name])
+
+    def count(self, windows, bases):
+        if self._read is not None:
+            self._read[4] += windows
+            self._read[5] += bases
+
+    def readArrays(self):
+        # Returns the recorded reads as a dict of NumPy arrays, with stageSeconds as a (reads, stages) array
+        rows = np.array(self.rows, dtype=np.float64).reshape(len(self.rows), len(_readColumns) + len(profileStages))
+        arrays = {name: rows[:, i].astype(dtype) for i, (name, dtype) in enumerate(_readColumns)}
+        arrays["stageSeconds"] = rows[:, len(_readColumns):]
+        return arrays
+
+
+@contextlib.contextmanager
+def profiled(profiler=None):
+    """
+    Makes profiler (or a new BoundaryProfiler) the active profiler of this process within the with block,
+    and yields it.
+    """
+    global activeProfiler
+    if profiler is None:
+        profiler = BoundaryProfiler()
+    previous = activeProfiler
+    activeProfiler = profiler
+    try:
+        yield profiler
+    finally:
+        activeProfiler = previous
+
+
+def stage(name):
+    # Context manager timing a stage of the current read, a no-op if profiling is disabled
+    if activeProfiler is None:
+        return _noStage
+    return activeProfiler.stage(name)
+
+
+def count(windows, bases):
+    # Adds to the windows scored and bases scanned of the current read
+    if activeProfiler is not None:
+        activeProfiler.count(windows, bases)
+
+
+def startRead(readLength):
+    if activeProfiler is None:
+        return False
+    return activeProfiler.startRead(readLength)
+
+
+def endRead(telomereLength, isGStrand):
+    activeProfiler.endRead(telomereLength, isGStrand)
+
+
+def profiledRead(function):
+    # Decorator recording each call of a function taking a sequence and returning (telomereLength, isGStrand) as a read
+    @functools.wraps(function)
+    def wrapper(seq, *args, **kwargs):
+        if activeProfiler is None or not activeProfiler.startRead(len(seq)):
+            return function(seq, *args, **kwargs)
+        try:
+            result = function(seq, *args, **kwargs)
+        except BaseException:
+            activeProfiler._read = None
+            raise
+        activeProfiler.endRead(*result)
+        return result
+    return wrapper
+
+
+def selectReads(arrays, indices):
+    return {name: values[indices] for name, values in arrays.items()}
+
+
+def _histogram(values, edges):
+    counts, _ = np.histogram(np.clip(values, edges[0], edges[-1]), edges)
+    return counts
+
+
+class ProfileAccumulator:
+    """
+    Totals and histograms of the reads added from BoundaryProfiler.readArrays, with fixed bins so that it
+    takes constant memory however many reads are added.
+    """
+
+    def __init__(self):
+        self.reads = 0
+        self.cachedReads = 0
+        self.seconds = 0.0
+        self.stageSeconds = np.zeros(len(profileStages))
+        self.windowsScored = 0
+        self.basesScanned = 0
+        self.readBases = 0
+        self.errorCodes = {}
+        self.histograms = {"seconds": np.zeros(len(_secondsEdges) - 1, dtype=np.int64),
+                           "windowsScored": np.zeros(len(_countEdges) - 1, dtype=np.int64),
+                           "basesScanned": np.zeros(len(_countEdges) - 1, dtype=np.int64),
+                           "readLength": np.zeros(len(_countEdges) - 1, dtype=np.int64)}
+
+    def add(self, arrays, cachedReads=0):
+        # cachedReads counts the reads taken from a result cache, which weren't profiled
+        self.cachedReads += cachedReads
+        self.reads += len(arrays["seconds"])
+        self.seconds += float(np.sum(arrays["seconds"]))
+        self.stageSeconds += np.sum(arrays["stageSeconds"], axis=0)
+        self.windowsScored += int(np.sum(arrays["windowsScored"]))
+        self.basesScanned += int(np.sum(arrays["basesScanned"]))
+        self.readBases += int(np.sum(arrays["readLength"]))
+        failed = arrays["isGStrand"] < 0
+        codes, codeCounts = np.unique(arrays["telomereLength"][failed], return_counts=True)
+        for code, codeCount in zip(codes.tolist(), codeCounts.tolist()):
+            self.errorCodes[code] = self.errorCodes.get(code, 0) + codeCount
+        self.histograms["seconds"] += _histogram(arrays["seconds"], _secondsEdges)
+        for name in ("windowsScored", "basesScanned", "readLength"):
+            self.histograms[name] += _histogram(arrays[name], _countEdges)
+
+    def merge(self, other):
+        self.reads += other.reads
+        self.cachedReads += other.cachedReads
+        self.seconds += other.seconds
+        self.stageSeconds += other.stageSeconds
+        self.windowsScored += other.windowsScored
+        self.basesScanned += other.basesScanned
+        self.readBases += other.readBases
+        for code, codeCount in other.errorCodes.items():
+            self.errorCodes[code] = self.errorCodes.get(code, 0) + codeCount
+        for name in self.histograms:
+            self.histograms[name] += other.histograms[name]
+
+    def report(self):
+        # Returns the totals and histograms as a dict that can be saved as json. Histograms are given as
+        # bin edges and the number of reads in each bin, out of range values are counted in the first or last bin.
+        stageSeconds = dict(zip(profileStages, self.stageSeconds.tolist()))
+        return {
+            "reads": self.reads,
+            "cachedReads": self.cachedReads,
+            "seconds": self.seconds,
+            "readsPerSecond": self.reads / self.seconds if self.seconds > 0 else None,
+            "basesPerSecond": self.readBases / self.seconds if self.seconds > 0 else None,
+            "stageSeconds": stageSeconds,
+            "stageFractions": {name: seconds / self.seconds if self.seconds > 0 else None for name, seconds in stageSeconds.items()},
+            # Time of the reads outside of the stages, e.g. validation and uppercasing
+            "otherSeconds": self.seconds - float(np.sum(self.stageSeconds)),
+            "windowsScored": self.windowsScored,
+            "basesScanned": self.basesScanned,
+            "readBases": self.readBases,
+            "errorCodes": {str(code): codeCount for code, codeCount in sorted(self.errorCodes.items())},
+            "histograms": {
+                "seconds": {"edges": _secondsEdges.tolist(), "counts": self.histograms["seconds"].tolist()},
+                "windowsScored": {"edges": _countEdges.tolist(), "counts": self.histograms["windowsScored"].tolist()},
+                "basesScanned": {"edges": _countEdges.tolist(), "counts": self.histograms["basesScanned"].tolist()},
+                "readLength": {"edges": _countEdges.tolist(), "counts": self.histograms["readLength"].tolist()},
+            },
+        }
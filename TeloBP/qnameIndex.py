@@ -0,0 +1,227 @@
+# Targeted reading of fastq files by qname.
+#
+# A targeted reanalysis (teloBPCmd.py --targetQnamesCSV) usually wants a few thousand reads out of tens of
+# millions. readTargetFastq compares the qname of each header line with the targets as bytes, and skips the
+# sequence and quality lines of the other records without decoding them. It stops reading as soon as every
+# target has been found, so each target is read from its first record in the file only.
+#
+# If it is given an index directory, while it scans a plain or bgzip compressed fastq it also records the hash of
+# every qname with the offset of its record in the uncompressed file, and saves them in that directory as a compact
+# index (".qni": sorted 64 bit hashes and offsets, 16 bytes per read). Later targeted runs look their targets up
+# in the index and seek directly to their records, using the .gzi index of bgzip files (see TeloBP.refIndex),
+# which is also kept in the index directory. Nothing is written next to the fastqs. If a scan stopped early, the
+# index covers the start of the file only, and the next scan continues where it stopped. Plain gzip files can't
+# be seeked, so they are only filtered.
+
+import array
+import contextlib
+import gzip
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+from TeloBP.refIndex import canIndex, isBgzip, readGzi, buildGzi, writeGzi, _loadIndex
+from TeloBP.seqReader import openSeqFile, defaultBlockSize
+
+qnameIndexVersion = 1
+qnameIndexExtension = ".qni"
+
+logger = logging.getLogger(__name__)
+
+
+def qnameHash(qname):
+    # 64 bit hash of a qname (bytes), stable between runs. Collisions only cost an extra record read, since every
+    # record found in the index is checked against the targets.
+    return int.from_bytes(hashlib.blake2b(qname, digest_size=8).digest(), "little")
+
+
+def _headerQname(header):
+    # The qname of a fastq header line, as bytes
+    words = header[1:].split(None, 1)
+    return words[0] if len(words) > 0 else b""
+
+
+class QnameIndex:
+    """
+    The hashes of the qnames of a fastq file and the offsets of their records in the uncompressed file. The index
+    covers the records before scannedTo, which is the whole file if complete is True.
+    """
+
+    def __init__(self, hashes=None, offsets=None, scannedTo=0, complete=False):
+        self.hashes = np.zeros(0, dtype=np.uint64) if hashes is None else hashes
+        self.offsets = np.zeros(0, dtype=np.uint64) if offsets is None else offsets
+        self.scannedTo = scannedTo
+        self.complete = complete
+
+    @classmethod
+    def load(cls, indexFilename):
+        with np.load(indexFilename) as data:
+            if int(data["version"]) != qnameIndexVersion:
+                raise ValueError(f"{indexFilename} was written by a different version of TeloBP")
+            return cls(data["hashes"], data["offsets"], int(data["scannedTo"]), bool(data["complete"]))
+
+    def save(self, indexFilename):
+        # Written to a temporary file first, so that an interrupted write never leaves a partial index
+        tmpFilename = indexFilename + ".tmp"
+        with open(tmpFilename, "wb") as indexFile:
+            np.savez(indexFile, version=qnameIndexVersion, hashes=self.hashes, offsets=self.offsets,
+                     scannedTo=self.scannedTo, complete=self.complete)
+        os.replace(tmpFilename, indexFilename)
+
+    def extend(self, hashes, offsets, scannedTo, complete):
+        # Adds the records scanned from self.scannedTo to scannedTo
+        hashes = np.concatenate((self.hashes, hashes))
+        offsets = np.concatenate((self.offsets, offsets))
+        order = np.argsort(hashes, kind="stable")
+        self.hashes, self.offsets = hashes[order], offsets[order]
+        self.scannedTo = scannedTo
+        self.complete = complete
+
+    def lookup(self, qnames):
+        # Returns the sorted offsets of the records whose qname hash matches one of the qnames (bytes)
+        if len(qnames) == 0 or len(self.hashes) == 0:
+            return np.zeros(0, dtype=np.uint64)
+        targetHashes = np.array([qnameHash(qname) for qname in qnames], dtype=np.uint64)
+        starts = np.searchsorted(self.hashes, targetHashes, side="left")
+        ends = np.searchsorted(self.hashes, targetHashes, side="right")
+        return np.sort(np.concatenate([self.offsets[start:end] for start, end in zip(starts, ends)]))
+
+
+def qnameIndexPrefix(filename, indexDir):
+    # Path prefix of the index files of a fastq in indexDir. It includes a hash of the absolute path of the fastq,
+    # so that fastqs with the same name in different directories get different indexes.
+    pathHash = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=6).hexdigest()
+    return os.path.join(indexDir, f"{os.path.basename(filename)}.{pathHash}")
+
+
+def loadQnameIndex(filename, indexFilename):
+    # Returns the index of a fastq file, or an empty index if it has none or the fastq is newer than it
+    if os.path.exists(indexFilename) and os.path.getmtime(indexFilename) >= os.path.getmtime(filename):
+        try:
+            return QnameIndex.load(indexFilename)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not read the index {indexFilename}, it will be rebuilt: {e}")
+    return QnameIndex()
+
+
+class _OffsetReader:
+    # Opens a plain or bgzip compressed file at offsets of the uncompressed file. The block index of bgzip files
+    # is loaded from, or saved to, gziFilename (filename + ".gzi" by default).
+    def __init__(self, filename, gziFilename=None):
+        self.filename = filename
+        self.blocks = None
+        if isBgzip(filename):
+            gziFilename = filename + ".gzi" if gziFilename is None else gziFilename
+            self.blocks = _loadIndex(gziFilename, filename, readGzi, buildGzi, writeGzi)
+            self.blockStarts = np.array([uncompressedOffset for _, uncompressedOffset in self.blocks], dtype=np.int64)
+
+    @contextlib.contextmanager
+    def open(self, offset):
+        with open(self.filename, "rb") as raw:
+            if self.blocks is None:
+                raw.seek(offset)
+                yield raw
+                return
+            # Every bgzip block is a gzip member, so the file can be decompressed from the start of any block
+            block = int(np.searchsorted(self.blockStarts, offset, side="right")) - 1
+            compressedOffset, uncompressedOffset = self.blocks[block]
+            raw.seek(compressedOffset)
+            with gzip.GzipFile(fileobj=raw, mode="rb") as handle:
+                handle.read(offset - uncompressedOffset)
+                yield handle
+
+
+def _scanFastq(handle, offset, remaining, hashes=None, offsets=None, blockSize=defaultBlockSize):
+    # Yields the (qname, sequence bytes) records of a fastq handle positioned at offset whose qname (bytes) is in
+    # remaining, removing it. If hashes and offsets are given, the qname hash and offset of every record are added to
+    # them. Stops once remaining is empty, and returns the offset of the first record not scanned, and whether the
+    # end of the file was reached.
+    carry = []
+    while remaining:
+        block = handle.readlines(blockSize)
+        if not block:
+            break
+        lines = carry + block if carry else block
+        numComplete = len(lines) - len(lines) % 4
+        for i in range(0, numComplete, 4):
+            if not remaining:
+                return offset, False
+            header = lines[i]
+            if header[:1] != b"@" or lines[i + 2][:1] != b"+":
+                raise ValueError(f"Invalid fastq record {header[:50]!r}. Only fastq files with single line records are supported by the fast parser, use the biopython parser for other files.")
+            qname = _headerQname(header)
+            if hashes is not None:
+                hashes.append(qnameHash(qname))
+                offsets.append(offset)
+            offset += len(header) + len(lines[i + 1]) + len(lines[i + 2]) + len(lines[i + 3])
+            if qname in remaining:
+                remaining.discard(qname)
+                yield qname.decode(), lines[i + 1].rstrip(b"\r\n")
+        carry = lines[numComplete:]
+    if not remaining:
+        return offset, False
+    if any(line.strip() for line in carry):
+        raise ValueError("Truncated fastq record at the end of the file")
+    return offset, True
+
+
+def readTargetFastq(filename, targetQnames, indexDir=None):
+    """
+    Yields the (qname, sequence bytes) pairs of the records of a fastq file whose qname is in targetQnames, in file
+    order, and stops once all of them have been found. Each target is read once, from its first record.
+
+    :param targetQnames: The set of qnames (str) to read. The qnames found are removed from it.
+    :param indexDir: If given, the qname index of the file in this directory (created if needed) is used, and built or
+           extended as the file is scanned. If None, the file is scanned without an index.
+    """
+    remaining = {qname.encode() for qname in targetQnames}
+
+    def found(qname):
+        targetQnames.discard(qname)
+        return qname
+
+    if not remaining:
+        return
+    if indexDir is None or not canIndex(filename):
+        with openSeqFile(filename) as handle:
+            for qname, seq in _scanFastq(handle, 0, remaining):
+                yield found(qname), seq
+        return
+
+    indexPrefix = qnameIndexPrefix(filename, indexDir)
+    try:
+        os.makedirs(indexDir, exist_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not create the index directory {indexDir}: {e}")
+    index = loadQnameIndex(filename, indexPrefix + qnameIndexExtension)
+    reader = _OffsetReader(filename, indexPrefix + ".gzi")
+    for offset in index.lookup(list(remaining)).tolist():
+        with reader.open(offset) as handle:
+            header = handle.readline()
+            seq = handle.readline()
+        qname = _headerQname(header)
+        if qname in remaining:
+            remaining.discard(qname)
+            yield found(qname.decode()), seq.rstrip(b"\r\n")
+    if index.complete or not remaining:
+        return
+
+    # The rest of the targets are after the part of the file covered by the index
+    hashes = array.array("Q")
+    offsets = array.array("Q")
+    with reader.open(index.scannedTo) as handle:
+        scan = _scanFastq(handle, index.scannedTo, remaining, hashes, offsets)
+        while True:
+            try:
+                qname, seq = next(scan)
+            except StopIteration as stop:
+                scannedTo, complete = stop.value
+                break
+            yield found(qname), seq
+    index.extend(np.frombuffer(hashes, dtype=np.uint64), np.frombuffer(offsets, dtype=np.uint64), scannedTo, complete)
+    try:
+        index.save(indexPrefix + qnameIndexExtension)
+    except OSError as e:
+        logger.warning(f"Could not save the qname index of {filename}, it will be rebuilt next time: {e}")
@@ -0,0 +1,150 @@
+# Columnar per-read output.
+#
+# The output csvs only hold the reads with a telomere, so the error code, read length and strand
+# of the failed reads are lost, and downstream aggregation has to parse large text files.
+# ReadTableWriter writes one row per analyzed read (qname, sample key, read length, telomere length,
+# strand and error code) with compact dtypes, to a Parquet file or an Arrow IPC file. pyarrow is
+# only needed when a read table is written.
+#
+# The rows are streamed to an Arrow IPC stream (path + ".partial") as each batch of reads is analyzed.
+# A stream can be read up to any batch boundary even if it was never closed, so a checkpointed size
+# can be resumed by truncating the stream to it. When the writer is closed, the stream is converted to
+# the final file, with row groups of exactly readTableRowGroupSize rows (but the last), which then replaces
+# path in one step.
+
+import os
+
+import numpy as np
+
+from TeloBP.constants import readTableRowGroupSize
+
+readTableFormats = ("parquet", "arrow")
+readTableExtensions = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+def _importPyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Arrow read tables need pyarrow, which can be installed with: pip install pyarrow") from None
+    return pyarrow
+
+
+def readTableSchema():
+    pa = _importPyarrow()
+    return pa.schema([
+        ("qname", pa.string()),
+        ("sampleKey", pa.dictionary(pa.int32(), pa.string())),
+        ("readLength", pa.uint32()),
+        # The telomere length, or the error code if the read failed
+        ("telomereLength", pa.int32()),
+        # 1 for the G strand, 0 for the C strand, -1 if the read failed
+        ("isGStrand", pa.int8()),
+        # 0 if the read passed, otherwise the error code from errorReturns
+        ("errorCode", pa.int16()),
+    ])
+
+
+class ReadTableWriter:
+    """
+    Writes the per-read results of a sample to path, in the "parquet" or "arrow" (IPC file) format.
+    Rows are added with write, and path is only created by close, once all the rows are written.
+
+    :param resumeBytes: The size returned by checkpoint for the partial rows of a previous writer of this path,
+           which are kept. If None, any partial rows are discarded.
+    """
+
+    def __init__(self, path, tableFormat="parquet", resumeBytes=None, rowGroupSize=readTableRowGroupSize):
+        if tableFormat not in readTableFormats:
+            raise ValueError(f"tableFormat should be one of {readTableFormats}")
+        self.pa = _importPyarrow()
+        self.path = path
+        self.tableFormat = tableFormat
+        self.rowGroupSize = rowGroupSize
+        self.schema = readTableSchema()
+        self.partialPath = path + ".partial"
+
+        previousBatches = []
+        # A writer checkpointed before its first batch has no rows to resume (its stream isn't started)
+        if resumeBytes:
+            # Read into memory, as batches read from a path may be memory mapped from the file rewritten below
+            with open(self.partialPath, "rb") as partialFile:
+                partialRows = partialFile.read(resumeBytes)
+            with self.pa.ipc.open_stream(partialRows) as reader:
+                previousBatches = list(reader)
+        # The stream is rewritten with the resumed batches, since a stream can't be appended to
+        self.partialFile = open(self.partialPath, "wb")
+        self.stream = self.pa.ipc.new_stream(self.partialFile, self.schema)
+        for batch in previousBatches:
+            self.stream.write_batch(batch)
+
+    def write(self, qnames, sampleKey, readLengths, telomereLengths, isGStrand, errorCodes=None):
+        # Adds the rows of a batch of reads. errorCodes are derived from the results if they aren't given.
+        if len(qnames) == 0:
+            return
+        pa = self.pa
+        telomereLengths = np.asarray(telomereLengths)
+        isGStrand = np.asarray(isGStrand)
+        if errorCodes is None:
+            errorCodes = np.where(isGStrand < 0, telomereLengths, 0)
+        sampleKeys = pa.DictionaryArray.from_arrays(np.zeros(len(qnames), dtype=np.int32), pa.array([sampleKey], pa.string()))
+        batch = pa.record_batch([
+            pa.array([str(qname) for qname in qnames], pa.string()),
+            sampleKeys,
+            pa.array(np.asarray(readLengths, dtype=np.uint32)),
+            pa.array(telomereLengths.astype(np.int32)),
+            pa.array(isGStrand.astype(np.int8)),
+            pa.array(np.asarray(errorCodes).astype(np.int16)),
+        ], schema=self.schema)
+        self.stream.write_batch(batch)
+
+    def checkpoint(self):
+        # Syncs the rows written so far, and returns the size to resume them from
+        self.partialFile.flush()
+        os.fsync(self.partialFile.fileno())
+        return os.fstat(self.partialFile.fileno()).st_size
+
+    def abort(self):
+        # Closes the partial rows without writing path, so they can still be resumed from a checkpoint
+        self.partialFile.close()
+
+    def close(self):
+        # Converts the partial rows to the final file, which replaces path
+        pa = self.pa
+        self.stream.close()
+        self.partialFile.close()
+        tmpPath = self.path + ".tmp"
+        with pa.ipc.open_stream(self.partialPath) as reader:
+            if self.tableFormat == "parquet":
+                with pa.parquet.ParquetWriter(tmpPath, self.schema, compression="zstd") as writer:
+                    for rowGroup in _rowGroups(reader, self.rowGroupSize):
+                        writer.write_table(pa.Table.from_batches(rowGroup, self.schema), row_group_size=self.rowGroupSize)
+            else:
+                with pa.ipc.new_file(tmpPath, self.schema) as writer:
+                    for rowGroup in _rowGroups(reader, self.rowGroupSize):
+                        # The batches of a row group are combined into one record batch of the file
+                        writer.write_table(pa.Table.from_batches(rowGroup, self.schema).combine_chunks(), max_chunksize=self.rowGroupSize)
+        os.replace(tmpPath, self.path)
+        os.remove(self.partialPath)
+
+
+def _rowGroups(batches, rowGroupSize):
+    # Groups the streamed batches into lists of rowGroupSize rows (the last one may be shorter), splitting the
+    # batches that straddle two row groups
+    rowGroup = []
+    numRows = 0
+    for batch in batches:
+        while numRows + batch.num_rows >= rowGroupSize:
+            split = rowGroupSize - numRows
+            rowGroup.append(batch.slice(0, split))
+            yield rowGroup
+            rowGroup = []
+            numRows = 0
+            batch = batch.slice(split)
+        if batch.num_rows > 0:
+            rowGroup.append(batch)
+            numRows += batch.num_rows
+    if rowGroup:
+        yield rowGroup
@@ -0,0 +1,200 @@
+# Indexed access to the ends of reference chromosomes.
+#
+# refRecordTeloLengths only looks at the first and last searchSize bases of each chromosome, so
+# for BED output the rest of a reference never needs to be parsed. IndexedFasta uses a samtools
+# style .fai index (and a .gzi index for bgzip compressed references) to seek directly to any
+# region of a chromosome. Missing indexes are built with one pass over the file, and saved next
+# to the reference when possible, so they are compatible with samtools faidx.
+
+import bisect
+import logging
+import os
+import struct
+
+from Bio import bgzf
+
+from TeloBP.constants import referenceSearchSize
+from TeloBP.seqReader import openSeqFile, _headerToQname
+
+# Fields of a .fai line
+faiColumns = ("name", "length", "offset", "lineBases", "lineWidth")
+
+logger = logging.getLogger(__name__)
+
+
+def isBgzip(filename):
+    # bgzip files are gzip files whose first member has a "BC" extra subfield
+    with open(filename, "rb") as handle:
+        header = handle.read(18)
+    return len(header) == 18 and header[:2] == b"\x1f\x8b" and bool(header[3] & 4) and header[12:14] == b"BC"
+
+
+def isGzip(filename):
+    with open(filename, "rb") as handle:
+        return handle.read(2) == b"\x1f\x8b"
+
+
+def canIndex(filename):
+    # Plain and bgzip compressed fasta files can be indexed, other gzip files have to be parsed
+    return not isGzip(filename) or isBgzip(filename)
+
+
+def readFai(faiFilename):
+    contigs = []
+    with open(faiFilename) as faiFile:
+        for line in faiFile:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5:
+                continue
+            contigs.append(dict(zip(faiColumns, [fields[0]] + [int(field) for field in fields[1:5]])))
+    return contigs
+
+
+def writeFai(faiFilename, contigs):
+    with open(faiFilename, "w") as faiFile:
+        for contig in contigs:
+            faiFile.write("\t".join(str(contig[column]) for column in faiColumns) + "\n")
+
+
+def buildFai(filename):
+    """
+    Scans a plain or bgzip compressed fasta file and returns its .fai entries. Offsets are positions
+    in the uncompressed file. Like samtools, every line of a sequence except the last must have the
+    same length.
+    """
+    contigs = []
+    contig = None
+    position = 0
+    lastLine = False
+    with openSeqFile(filename) as handle:
+        for line in handle:
+            lineWidth = len(line)
+            position += lineWidth
+            if line[:1] == b">":
+                contig = {"name": _headerToQname(line[1:]), "length": 0, "offset": position, "lineBases": 0, "lineWidth": 0}
+                contigs.append(contig)
+                lastLine = False
+                continue
+            if contig is None:
+                continue
+            lineBases = len(line.rstrip(b"\r\n"))
+            if lineBases == 0:
+                lastLine = True
+                continue
+            if lastLine:
+                raise ValueError(f"Different line lengths in sequence {contig['name']} of {filename}, it can't be indexed")
+            if contig["lineBases"] == 0:
+                contig["lineBases"] = lineBases
+                contig["lineWidth"] = lineWidth
+            elif lineBases != contig["lineBases"] or lineWidth != contig["lineWidth"]:
+                # Only the last line of a sequence can be shorter
+                if lineBases > contig["lineBases"]:
+                    raise ValueError(f"Different line lengths in sequence {contig['name']} of {filename}, it can't be indexed")
+                lastLine = True
+            contig["length"] += lineBases
+    return contigs
+
+
+def readGzi(gziFilename):
+    # Returns the (compressed offset, uncompressed offset) of every bgzip block, including the first one
+    with open(gziFilename, "rb") as gziFile:
+        data = gziFile.read()
+    numEntries = struct.unpack_from("<Q", data)[0]
+    values = struct.unpack_from(f"<{2 * numEntries}Q", data, 8)
+    return [(0, 0)] + list(zip(values[::2], values[1::2]))
+
+
+def writeGzi(gziFilename, blocks):
+    # The first block is left out of .gzi files, since it always starts at (0, 0)
+    entries = blocks[1:]
+    with open(gziFilename, "wb") as gziFile:
+        gziFile.write(struct.pack("<Q", len(entries)))
+        for compressedOffset, uncompressedOffset in entries:
+            gziFile.write(struct.pack("<QQ", compressedOffset, uncompressedOffset))
+
+
+def buildGzi(filename):
+    with open(filename, "rb") as handle:
+        return [(start, dataStart) for start, _, dataStart, dataLength in bgzf.BgzfBlocks(handle) if dataLength > 0]
+
+
+def _loadIndex(indexFilename, filename, readIndex, buildIndex, writeIndex):
+    # Reads an index that is newer than the reference, or builds it and tries to save it next to the reference
+    if os.path.exists(indexFilename) and os.path.getmtime(indexFilename) >= os.path.getmtime(filename):
+        return readIndex(indexFilename)
+    index = buildIndex(filename)
+    try:
+        writeIndex(indexFilename, index)
+    except OSError as e:
+        logger.warning(f"Could not save the index {indexFilename}, it will be rebuilt next time: {e}")
+    return index
+
+
+class IndexedFasta:
+    """
+    Random access to the sequences of a plain or bgzip compressed fasta file, using its .fai index
+    (and .gzi index for bgzip files). The indexes are built if they are missing.
+    """
+
+    def __init__(self, filename):
+        if not canIndex(filename):
+            raise ValueError(f"{filename} is gzip compressed, but not with bgzip, so it can't be indexed")
+        self.filename = filename
+        self.contigs = _loadIndex(filename + ".fai", filename, readFai, buildFai, writeFai)
+        self.contigsByName = {contig["name"]: contig for contig in self.contigs}
+        self.blocks = None
+        if isBgzip(filename):
+            self.blocks = _loadIndex(filename + ".gzi", filename, readGzi, buildGzi, writeGzi)
+            self.blockStarts = [uncompressedOffset for _, uncompressedOffset in self.blocks]
+            self.handle = bgzf.BgzfReader(filename, "rb")
+        else:
+            self.handle = open(filename, "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.handle.close()
+
+    def _seek(self, offset):
+        # Seeks to an offset of the uncompressed file
+        if self.blocks is None:
+            self.handle.seek(offset)
+            return
+        block = bisect.bisect_right(self.blockStarts, offset) - 1
+        compressedOffset, uncompressedOffset = self.blocks[block]
+        self.handle.seek(bgzf.make_virtual_offset(compressedOffset, offset - uncompressedOffset))
+
+    def fetch(self, name, start=0, end=None):
+        # Returns the bases [start, end) of a sequence as bytes, without line breaks
+        contig = self.contigsByName[name]
+        end = contig["length"] if end is None else min(end, contig["length"])
+        start = max(start, 0)
+        if end <= start:
+            return b""
+        lineBases, lineWidth = contig["lineBases"], contig["lineWidth"]
+        startByte = contig["offset"] + (start // lineBases) * lineWidth + start % lineBases
+        endByte = contig["offset"] + ((end - 1) // lineBases) * lineWidth + (end - 1) % lineBases + 1
+        self._seek(startByte)
+        data = self.handle.read(endByte - startByte)
+        return data.replace(b"\n", b"").replace(b"\r", b"")
+
+
+def readRefEnds(filename, searchSize=referenceSearchSize):
+    """
+    Yields (name, length, seqEnds) for every sequence of a plain or bgzip compressed fasta file, reading
+    only the first and last searchSize bases of each sequence. seqEnds is the two ends joined together,
+    or the whole sequence if it is at most 2 x searchSize long, so that refRecordTeloLengths gives the
+    same result on it as on the whole sequence.
+    """
+    with IndexedFasta(filename) as fasta:
+        for contig in fasta.contigs:
+            name, length = contig["name"], contig["length"]
+            if length > 2 * searchSize:
+                seqEnds = fasta.fetch(name, 0, searchSize) + fasta.fetch(name, length - searchSize, length)
+            else:
+                seqEnds = fasta.fetch(name)
+            yield name, length, seqEnds
@@ -0,0 +1,162 @@
+# On-disk cache of telomere boundary results.
+#
+# Reruns on the same fastqs (e.g. while tuning downstream filters, or when a cohort is re-processed
+# after adding samples) analyze the same reads with the same parameters again. ResultCache stores
+# the (telomere length, strand) of every analyzed read in an SQLite database, keyed by a hash of the
+# read sequence together with a digest of every parameter that affects the result, so cached reads
+# are skipped entirely. Changing any parameter (or resultCacheVersion) gives new keys, and the least
+# recently used results are evicted once the cache holds more than maxEntries reads.
+
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from TeloBP.constants import resultCacheMaxEntries, resultCacheVersion
+from TeloBP.teloBoundaryHelpers import asSeqBuffer
+
+# Parameters that don't change the results, or are given per read
+_unkeyedParameters = ("seq", "seqs", "cache", "showGraphs", "pdf")
+
+# Number of keys per SQLite query, below the default limit of query parameters
+_queryBatchSize = 500
+
+
+def _canonicalValue(value):
+    if isinstance(value, (np.bool_, np.integer, np.floating)):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return repr(value)
+
+
+def parameterDigest(functionName, params):
+    """
+    Returns a digest of the parameters of a call to functionName (a dict of parameter name to value). The
+    parameters are serialized canonically, so equal parameters always give the same digest.
+    """
+    params = {name: value for name, value in params.items() if name not in _unkeyedParameters}
+    canonical = json.dumps([resultCacheVersion, functionName, params], sort_keys=True, default=_canonicalValue)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).digest()
+
+
+def functionParameters(function, **kwargs):
+    # Returns every parameter of a call to function with kwargs, including the defaults, as parameterDigest expects
+    arguments = inspect.signature(function).bind_partial(**kwargs)
+    arguments.apply_defaults()
+    return dict(arguments.arguments)
+
+
+def sequenceKey(seq, digest):
+    # The cache key of a read: a hash of its sequence (as given, see asSeqBuffer), keyed by the parameter digest
+    return hashlib.blake2b(asSeqBuffer(seq), digest_size=16, key=digest).digest()
+
+
+class ResultCache:
+    """
+    LRU cache of (telomere length, isGStrand) results in cacheDir, which is created if needed. Several
+    processes can share a cache directory. isGStrand is stored as 1 for the G strand, 0 for the C strand
+    and -1 if the read failed, as returned by getTeloBoundaryBatch.
+    """
+
+    def __init__(self, cacheDir, maxEntries=resultCacheMaxEntries):
+        os.makedirs(cacheDir, exist_ok=True)
+        self.maxEntries = maxEntries
+        self.connection = sqlite3.connect(os.path.join(cacheDir, "teloBPResults.sqlite"), timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, telomereLength INTEGER, "
+                                "isGStrand INTEGER, lastUsed INTEGER) WITHOUT ROWID")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS resultsLastUsed ON results (lastUsed)")
+        self.connection.commit()
+        lastUsed, self.numEntries = self.connection.execute("SELECT MAX(lastUsed), COUNT(*) FROM results").fetchone()
+        self.clock = (lastUsed or 0) + 1
+        if self.numEntries > self.maxEntries:
+            self.evict()
+            self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, keys):
+        """
+        Returns a list with the cached (telomereLength, isGStrand) of each key, or None for the keys that
+        aren't cached. The keys found are marked as the most recently used.
+        """
+        found = {}
+        for start in range(0, len(keys), _queryBatchSize):
+            batch = keys[start:start + _queryBatchSize]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(f"SELECT key, telomereLength, isGStrand FROM results WHERE key IN ({placeholders})", batch).fetchall()
+            for key, telomereLength, isGStrand in rows:
+                found[key] = (telomereLength, isGStrand)
+            if rows:
+                self.connection.execute(f"UPDATE results SET lastUsed = ? WHERE key IN ({placeholders})", [self.clock] + list(batch))
+        self.connection.commit()
+        self.clock += 1
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+    def put(self, keys, telomereLengths, isGStrand):
+        # Stores the results of the given keys, then evicts the least recently used results if the cache is full
+        rows = [(key, int(telomereLength), int(readIsGStrand), self.clock)
+                for key, telomereLength, readIsGStrand in zip(keys, telomereLengths, isGStrand)]
+        cursor = self.connection.executemany("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)", rows)
+        self.numEntries += max(cursor.rowcount, 0)
+        self.clock += 1
+        if self.numEntries > self.maxEntries:
+            self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        # Evicts down to 90% of maxEntries, so that eviction doesn't run after every put once the cache is full
+        numEvicted = self.numEntries - int(self.maxEntries * 0.9)
+        self.connection.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY lastUsed LIMIT ?)", (numEvicted,))
+        self.numEntries = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+def cachedBatch(cache, functionName, params, seqs, readStrands, compute):
+    """
+    Returns the (telomereLengths, isGStrand, errorCodes) arrays of a batch of reads, as getTeloBoundaryBatch does,
+    taking the cached reads from cache and running compute(seqs, readStrands) on the others only.
+
+    :param params: The parameters of the batch function, without the sequences and strands
+    :param readStrands: The isGStrand value (None, True or False) of each read, which is part of its key
+    """
+    digests = {}
+    keys = []
+    for seq, readIsGStrand in zip(seqs, readStrands):
+        strandKey = None if readIsGStrand is None else bool(readIsGStrand)
+        if strandKey not in digests:
+            digests[strandKey] = parameterDigest(functionName, dict(params, isGStrand=strandKey))
+        keys.append(sequenceKey(seq, digests[strandKey]))
+
+    cached = cache.get(keys)
+    telomereLengths = np.empty(len(seqs), dtype=np.int64)
+    isGStrand = np.empty(len(seqs), dtype=np.int8)
+    missing = []
+    for i, result in enumerate(cached):
+        if result is None:
+            missing.append(i)
+        else:
+            telomereLengths[i], isGStrand[i] = result
+    if missing:
+        missingLengths, missingStrands, _ = compute([seqs[i] for i in missing], [readStrands[i] for i in missing])
+        telomereLengths[missing] = missingLengths
+        isGStrand[missing] = missingStrands
+        cache.put([keys[i] for i in missing], missingLengths, missingStrands)
+    # Failed reads have no strand, and their telomere length is the error code
+    errorCodes = np.where(isGStrand < 0, telomereLengths, 0)
+    return telomereLengths, isGStrand, errorCodes
@@ -0,0 +1,172 @@
+# Minimal fastq/fasta readers used by the TeloBP scripts.
+#
+# Bio.SeqIO builds a full SeqRecord for every read, including the per-letter quality
+# annotations, which TeloBP never uses. The readers here parse plain or gzipped files
+# in large blocks and yield (qname, sequence bytes) pairs, skipping the quality lines
+# without decoding them. Bio.SeqIO can still be selected with parser="biopython", for
+# formats the fast readers don't handle (e.g. multi-line fastq records).
+
+import gzip
+import io
+
+import numpy as np
+
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+# Number of bytes read from the file at a time
+defaultBlockSize = 1 << 22
+
+parsers = ("fast", "biopython")
+
+
+def openSeqFile(filename):
+    # Opens a plain or gzipped file for binary reading, detecting gzip from the file contents
+    with open(filename, "rb") as handle:
+        magic = handle.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(filename, "rb")
+    return open(filename, "rb", buffering=defaultBlockSize)
+
+
+def _headerToQname(header):
+    # The qname is the first word of the header, like the record.id given by Bio.SeqIO
+    words = header.split(None, 1)
+    return words[0].decode() if len(words) > 0 else ""
+
+
+def readFastq(filename, blockSize=defaultBlockSize):
+    """
+    Yields (qname, sequence bytes) pairs from a plain or gzipped fastq file. Records must have
+    their sequence and quality on a single line each.
+    """
+    with openSeqFile(filename) as handle:
+        carry = []
+        while True:
+            block = handle.readlines(blockSize)
+            if not block:
+                break
+            lines = carry + block if carry else block
+            numComplete = len(lines) - len(lines) % 4
+            for i in range(0, numComplete, 4):
+                header = lines[i]
+                if header[:1] != b"@" or lines[i + 2][:1] != b"+":
+                    raise ValueError(f"Invalid fastq record {header[:50]!r} in {filename}. Only fastq files with single line records are supported by the fast parser, use the biopython parser for other files.")
+                yield _headerToQname(header[1:]), lines[i + 1].rstrip(b"\r\n")
+            carry = lines[numComplete:]
+        if any(line.strip() for line in carry):
+            raise ValueError(f"Truncated fastq record at the end of {filename}")
+
+
+def _readFastaWithHeaders(filename, blockSize=defaultBlockSize):
+    # Yields (header bytes, sequence bytes) pairs from a plain or gzipped fasta file
+    with openSeqFile(filename) as handle:
+        header = None
+        parts = []
+        pending = b""
+        while True:
+            block = handle.read(blockSize)
+            if block:
+                data = pending + block
+                # Only complete lines are processed, the rest is kept for the next block
+                cut = data.rfind(b"\n") + 1
+                pending = data[cut:]
+                data = data[:cut]
+            elif pending:
+                data = pending + b"\n"
+                pending = b""
+            else:
+                break
+
+            pos = 0
+            while pos < len(data):
+                if data[pos:pos + 1] == b">":
+                    headerStart = pos
+                else:
+                    headerStart = data.find(b"\n>", pos)
+                    if headerStart == -1:
+                        headerStart = len(data)
+                    else:
+                        headerStart += 1
+                if header is not None:
+                    parts.append(data[pos:headerStart])
+                if headerStart == len(data):
+                    break
+                if header is not None:
+                    yield header, _joinFastaLines(parts)
+                headerEnd = data.find(b"\n", headerStart)
+                header = data[headerStart + 1:headerEnd].rstrip(b"\r")
+                parts = []
+                pos = headerEnd + 1
+        if header is not None:
+            yield header, _joinFastaLines(parts)
+
+
+def _joinFastaLines(parts):
+    return b"".join(parts).replace(b"\n", b"").replace(b"\r", b"").replace(b" ", b"")
+
+
+def readFasta(filename, blockSize=defaultBlockSize):
+    """
+    Yields (qname, sequence bytes) pairs from a plain or gzipped fasta file.
+    """
+    for header, seq in _readFastaWithHeaders(filename, blockSize):
+        yield _headerToQname(header), seq
+
+
+def readSeqs(filename, fileFormat="fastq", parser="fast"):
+    """
+    Yields (qname, sequence bytes) pairs from a fastq or fasta file.
+
+    :param fileFormat: "fastq" or "fasta"
+    :param parser: "fast" to use the readers in this module, or "biopython" to use Bio.SeqIO
+    """
+    if parser == "biopython":
+        with openSeqFile(filename) as handle:
+            for record in SeqIO.parse(io.TextIOWrapper(handle), fileFormat):
+                yield record.id, bytes(record.seq)
+    elif parser == "fast":
+        if fileFormat == "fastq":
+            yield from readFastq(filename)
+        elif fileFormat == "fasta":
+            yield from readFasta(filename)
+        else:
+            raise ValueError(f"Unsupported format for the fast parser: {fileFormat}")
+    else:
+        raise ValueError(f"parser should be one of {parsers}")
+
+
+def readSeqRecords(filename, fileFormat="fasta", parser="fast"):
+    """
+    Yields SeqRecords from a fasta file (or any format Bio.SeqIO reads, with parser="biopython"),
+    with the same id, name and description that Bio.SeqIO gives.
+    """
+    if parser == "biopython":
+        with openSeqFile(filename) as handle:
+            yield from SeqIO.parse(io.TextIOWrapper(handle), fileFormat)
+    elif parser == "fast":
+        if fileFormat != "fasta":
+            raise ValueError("The fast parser only reads SeqRecords from fasta files, use the biopython parser for other formats")
+        for header, seq in _readFastaWithHeaders(filename):
+            qname = _headerToQname(header)
+            yield SeqRecord(Seq(seq), id=qname, name=qname, description=header.decode())
+    else:
+        raise ValueError(f"parser should be one of {parsers}")
+
+
+def packSeqs(seqs):
+    """
+    Packs a list of sequence bytes into a single buffer, so that a batch of reads can be sent to another
+    process as one object rather than a list of many small ones. Returns (buffer, offsets), where read i
+    is buffer[offsets[i]:offsets[i + 1]].
+    """
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+    return b"".join(seqs), offsets
+
+
+def unpackSeqs(buffer, offsets):
+    # Returns the list of sequences packed by packSeqs, as memoryview slices of the buffer rather than copies
+    buffer = memoryview(buffer)
+    return [buffer[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
@@ -1,9 +1,10 @@
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 import matplotlib.pyplot as plt
 import re
 
-from TeloBP.constants import manualLabelsCHM13Positions, manualLabelsCHM13
+from TeloBP.constants import manualLabelsCHM13Positions, manualLabelsCHM13, areaDiffsThreshold
 import warnings
 
 
@@ -27,28 +28,99 @@ def descriptionToChrName(description):
     return description.split(" ")[0]
 
 
+def asSeqBuffer(seq):
+    # Returns a sequence as a bytes-like object, without copying it when possible. bytes, bytearray and memoryview
+    # sequences are returned as they are and NumPy arrays with 1 byte items (e.g. uint8) as a memoryview, while
+    # str and Bio Seq sequences are encoded
+    if isinstance(seq, (bytes, bytearray)):
+        return seq
+    if isinstance(seq, memoryview):
+        return seq if seq.format == "B" and seq.ndim == 1 else seq.cast("B")
+    if isinstance(seq, np.ndarray):
+        if seq.dtype.itemsize != 1:
+            raise ValueError("NumPy sequences should have 1 byte items, e.g. uint8")
+        return memoryview(np.ascontiguousarray(seq).reshape(-1).view(np.uint8))
+    if isinstance(seq, str):
+        return seq.encode("latin-1", "replace")
+    if hasattr(seq, "__bytes__"):
+        # Bio Seq objects
+        return bytes(seq)
+    return str(seq).encode("latin-1", "replace")
+
+
+def asUpperSeqBytes(seq):
+    # Returns the uppercase sequence as bytes. Uppercase bytes are returned as they are, so this can be called on
+    # a sequence that was already converted without copying it again
+    seq = asSeqBuffer(seq)
+    if isinstance(seq, bytes):
+        return seq if seq.isupper() else seq.upper()
+    seq = bytes(seq)
+    return seq if seq.isupper() else seq.upper()
+
+
 def is_regex_pattern(input_string):
     return bool(re.search(r'[^a-zA-Z]', input_string))
 
 
 def write_bed_file(file_path, bed_data):
     with open(file_path, 'w') as bed_file:
-        for entry in bed_data:
-            bed_file.write('\t'.join(str(e) for e in entry) + '\n')
+        append_bed_entries(bed_file, bed_data)
+
+
+def append_bed_entries(bed_file, bed_data):
+    # Writes bed entries to an open file, so bed files can be written incrementally
+    for entry in bed_data:
+        bed_file.write('\t'.join(str(e) for e in entry) + '\n')
 
 
 def getGraphArea(offsets, targetColumn, windowSize):
-    data = np.array(offsets)
-    transposed_data = data.T
-    areaList = []
-    row = transposed_data[targetColumn, :]
-    
-    # print(row)
-    for i in range(0, len(row) - windowSize, 1):
-        area = row[i:i + windowSize].sum()
-        areaList.append((area / windowSize))
-        # areaList.append(area)
-    return areaList
+    # Returns the mean of every windowSize run of offsets in the target column, as a NumPy array. Each run is summed
+    # on its own, as row[i:i + windowSize].sum() does, so the areas are exactly those of the per window sums. Areas
+    # from a cumulative sum differ in their last bits, which turns flat stretches of the curve into tiny slopes.
+    data = np.asarray(offsets, dtype=float)
+    if data.ndim != 2:
+        return np.empty(0)
+    row = np.ascontiguousarray(data[:, targetColumn])
+    numAreas = len(row) - windowSize
+    if numAreas <= 0:
+        return np.empty(0)
+
+    return sliding_window_view(row, windowSize)[:numAreas].sum(axis=1) / windowSize
+
+
+def findThresholdIndex(areaList, plateauDetectionThreshold, start=0):
+    # Returns the first index from start where the area is below plateauDetectionThreshold and still decreasing, or -1
+    areaList = np.asarray(areaList)
+    end = len(areaList) - 2
+    if end <= start:
+        return -1
+    mask = (areaList[start:end] < plateauDetectionThreshold) & (areaList[start + 1:end + 1] < areaList[start:end])
+    index = np.argmax(mask)
+    return start + int(index) if mask[index] else -1
+
+
+def findLastChangeIndex(areaList, changeThreshold):
+    # Returns the last index (excluding 0) where the area is above changeThreshold and decreasing, or -1
+    areaList = np.asarray(areaList)
+    end = len(areaList) - 1
+    if end <= 1:
+        return -1
+    mask = (areaList[1:end] > changeThreshold) & (areaList[2:end + 1] < areaList[1:end])
+    index = np.flatnonzero(mask)
+    return 1 + int(index[-1]) if len(index) > 0 else -1
+
+
+def findPlateauIndex(areaDiffs, start):
+    # Returns the first index from start where the area differences plateau, or -1.
+    # It plateaus when the difference is below areaDiffsThreshold, or in the rare case that the diff jumps over the threshold
+    areaDiffs = np.asarray(areaDiffs)
+    end = len(areaDiffs) - 1
+    if end <= start:
+        return -1
+    diffs = areaDiffs[start:end]
+    mask = (np.abs(diffs) < areaDiffsThreshold) | ((diffs < areaDiffsThreshold) & (areaDiffs[start + 1:end + 1] > areaDiffsThreshold))
+    index = np.argmax(mask)
+    return start + int(index) if mask[index] else -1
 
 
 def graphLine(rowIn, labelIn, windowStep, boundaryPoint=-1, pdfOut=None):
@@ -132,22 +204,23 @@ def testTeloLength(chr, length, testDict=manualLabelsCHM13):
     return (length - expectedLength)
 
 def recordBedData(bed_data, record, startTeloLength, endTeloLength):
-    chrName = record.id
+    contigBedData(bed_data, record.id, len(record.seq), startTeloLength, endTeloLength)
+
+def contigBedData(bed_data, chrName, chrLength, startTeloLength, endTeloLength):
     pEndIndex = startTeloLength
     bed_data.append([chrName, pEndIndex-6, pEndIndex, chrName])
     
-    qEndIndex = len(record.seq)-endTeloLength
+    qEndIndex = chrLength-endTeloLength
     bed_data.append([chrName, qEndIndex, qEndIndex+6, chrName])
 
-def write_bed_file(file_path, bed_data):
-    with open(file_path, 'w') as bed_file:
-        for entry in bed_data:
-            bed_file.write('\t'.join(str(e) for e in entry) + '\n')
-
 
 def validate_parameters(seq, isGStrand, composition, teloWindow=100, windowStep=6, plateauDetectionThreshold=-15, changeThreshold=-5, targetPatternIndex=-1, nucleotideGraphAreaWindowSize=500, showGraphs=False):
     
     validate_seq_teloWindow(seq, teloWindow)
+    validate_settings(isGStrand, composition, windowStep, targetPatternIndex, nucleotideGraphAreaWindowSize, showGraphs)
+
+def validate_settings(isGStrand, composition, windowStep=6, targetPatternIndex=-1, nucleotideGraphAreaWindowSize=500, showGraphs=False):
+    # Validates the parameters that don't depend on the sequence, so they can be checked once for a batch of reads
 
     if not isinstance(isGStrand, bool) and not isinstance(isGStrand, np.bool_):
         raise ValueError("isGStrand should be a boolean, or numpy boolean")
@@ -167,10 +240,13 @@ def validate_parameters(seq, isGStrand, composition, teloWindow=100, windowStep=
     if not isinstance(showGraphs, bool):
         raise ValueError("showGraphs should be a boolean")
 
-def validate_seq_teloWindow(seq, teloWindow):
+def validate_teloWindow(teloWindow):
     if not isinstance(teloWindow, int) or teloWindow < 6:
         raise ValueError(
             "teloWindow should be an int greater than or equal to 6")
 
+def validate_seq_teloWindow(seq, teloWindow):
+    validate_teloWindow(teloWindow)
+
     if len(seq) < teloWindow:
         raise Warning("sequence length is less than teloWindow")
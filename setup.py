@@ -11,7 +11,12 @@ setup(
         'numpy>=1.26.0',
         'pandas>=2.2.0',
         'pyparsing>=3.1.1',
-        'zipp>=3.16.2',
-        'pandarallel>=1.6.5'
+        'zipp>=3.16.2'
     ],
+    extras_require={
+        # Parquet and Arrow read tables (teloBPCmd.py --readTable)
+        'tables': ['pyarrow>=14.0.0'],
+        # Faster BAM reading, and CRAM files (TeloBP.alignmentReader)
+        'alignments': ['pysam>=0.21.0'],
+    },
 )
@@ -0,0 +1,203 @@
+# Checks of the BAM reader (TeloBP.alignmentReader) on small BAM files written by the test: the chromosome end
+# reads, their sequences in the sequenced orientation and their strands, for forward and reverse alignments with soft
+# clips at either end (inside hard clips), cigars of more than 65535 operations stored in the CG tag, IUPAC and "="
+# bases, and the records that are skipped. The pure Python decoder must give the reads expected from the records, and
+# the same reads as pysam when it's installed.
+#
+# Run with: python -m pytest tests
+
+import struct
+
+import numpy as np
+import pytest
+from Bio import bgzf
+
+from TeloBP import getTeloBoundary
+from TeloBP.alignmentReader import chromosomeEndArm, readChromosomeEndReads, reverseComplement, _readBamEnds, _softClips
+
+references = [("chr1", 100000), ("chr2", 60000)]
+endDistance = 2000
+_cigarOps = "MIDNSHP=X"
+_seqCodes = "=ACMGRSVTWYHKDBN"
+_complement = dict(zip("ACGTMRWSYKVHDBN=", "TGCAKYWSRMBDHVN="))
+
+
+def _parseCigar(cigar):
+    ops = []
+    number = ""
+    for char in cigar:
+        if char.isdigit():
+            number += char
+        else:
+            ops.append((_cigarOps.index(char), int(number)))
+            number = ""
+    return ops
+
+
+def _packSeq(seq):
+    codes = [_seqCodes.index(base) for base in seq] + [0]
+    return bytes((codes[i] << 4) | codes[i + 1] for i in range(0, len(seq), 2))
+
+
+def _record(qname, refID, pos, cigarOps, seq, flag=0, tags=b""):
+    # A BAM record. Cigars of more than 65535 operations are stored in the CG tag, with a kSmN placeholder cigar.
+    if len(cigarOps) > 65535:
+        referenceLength = sum(length for op, length in cigarOps if op in (0, 2, 3, 7, 8))
+        tags += b"CGBI" + struct.pack("<i", len(cigarOps)) + struct.pack(f"<{len(cigarOps)}I", *(length << 4 | op for op, length in cigarOps))
+        cigarOps = [(4, len(seq)), (3, referenceLength)]
+    name = qname.encode() + b"\0"
+    body = struct.pack("<iiBBHHHIiii", refID, pos, len(name), 60, 4680, len(cigarOps), flag, len(seq), -1, -1, 0)
+    body += name + struct.pack(f"<{len(cigarOps)}I", *(length << 4 | op for op, length in cigarOps))
+    body += _packSeq(seq) + b"\xff" * len(seq) + tags
+    return struct.pack("<i", len(body)) + body
+
+
+def _writeBam(filename, records):
+    text = b"@HD\tVN:1.6\tSO:unsorted\n" + b"".join(b"@SQ\tSN:%s\tLN:%d\n" % (name.encode(), length) for name, length in references)
+    header = b"BAM\1" + struct.pack("<i", len(text)) + text + struct.pack("<i", len(references))
+    for name, length in references:
+        header += struct.pack("<i", len(name) + 1) + name.encode() + b"\0" + struct.pack("<i", length)
+    with bgzf.BgzfWriter(filename, "wb") as handle:
+        handle.write(header + b"".join(records))
+
+
+def _randomSeq(rng, length, alphabet="ACGT"):
+    return "".join(rng.choice(list(alphabet), length))
+
+
+def _reverseComplement(seq):
+    return "".join(_complement[base] for base in reversed(seq))
+
+
+def _reads():
+    # Returns the records of the test BAM, and the (qname, sequence, isGStrand) expected from the reader. Forward reads
+    # of the p arm and reverse reads of the q arm start with the C strand telomere (isGStrand False), the others end
+    # with the G strand telomere.
+    rng = np.random.default_rng(0)
+    records = []
+    expected = []
+
+    def add(qname, refID, pos, cigar, isGStrand, flag=0, seq=None, tags=b""):
+        # isGStrand is None for the records that are skipped
+        cigarOps = _parseCigar(cigar) if isinstance(cigar, str) else cigar
+        length = sum(length for op, length in cigarOps if op in (0, 1, 4, 7, 8))
+        seq = _randomSeq(rng, length) if seq is None else seq
+        records.append(_record(qname, refID, pos, cigarOps, seq, flag, tags))
+        if isGStrand is not None:
+            expected.append((qname, (_reverseComplement(seq) if flag & 0x10 else seq).encode(), isGStrand))
+
+    chr1Length, chr2Length = references[0][1], references[1][1]
+    # Forward and reverse reads at both ends, with soft clipped telomeres
+    add("pForwardLeadingClip", 0, 300, "700S1500M", False)
+    add("pReverseTrailingClip", 0, 1500, "1500M30S", True, flag=0x10)
+    add("pForwardBothClips", 1, 2200, "400S1000M250S", False)
+    add("qForwardTrailingClip", 0, chr1Length - 1700, "1500M900S", True)
+    add("qReverseLeadingClip", 1, chr2Length - 3300, "1600S1500M", False, flag=0x10)
+    add("qReverseBothClips", 1, chr2Length - 2500, "20S1200M400S", False, flag=0x10)
+    # Soft clips are inside hard clips, which don't extend the alignment
+    add("pHardAndSoftClips", 0, 2100, "3000H150S1000M40S12H", False)
+    add("pHardClipOnly", 0, 2100, "3000H1000M", None)
+    # Deletions and skips span the reference, insertions don't
+    add("qDeletionsAndInsertions", 0, chr1Length - 4000, "500M1000D300M700I500N100M", True)
+    # Alignments away from the ends, reads with other flags, and unmapped reads are skipped
+    add("middle", 0, 50000, "100S1000M100S", None)
+    for flag in (0x4, 0x100, 0x800, 0x100 | 0x10):
+        add(f"flag{flag}", 0, 100, "1000M", None, flag=flag)
+    add("unplaced", -1, -1, "1000M", None)
+    # IUPAC codes, "=" and an odd length, on a reverse read
+    add("iupacReverse", 0, 500, "1001M", True, flag=0x10, seq=_randomSeq(rng, 1001, _seqCodes))
+    # Cigars of more than 65535 operations, with soft clips in the CG tag, and other tags before it. The kSmN
+    # placeholder would put the read near the p end.
+    longCigar = [(4, 200)] + [(0, 1), (1, 1)] * 40000 + [(4, 300)]
+    add("qLongCigar", 0, chr1Length - 40000 - 1500, longCigar, True, tags=b"NMi\x05\0\0\0RGZgroup1\0XBBc\x03\0\0\0\x01\x02\x03")
+    add("middleLongCigar", 0, 30000, longCigar, None)
+    return records, expected
+
+
+@pytest.fixture
+def bamFile(tmp_path):
+    records, expected = _reads()
+    filename = str(tmp_path / "reads.bam")
+    _writeBam(filename, records)
+    return filename, expected
+
+
+def test_pythonDecoder(bamFile):
+    filename, expected = bamFile
+    assert list(_readBamEnds(filename, endDistance)) == expected
+    assert list(readChromosomeEndReads(filename, endDistance, backend="python")) == expected
+
+
+def test_pysamMatchesPythonDecoder(bamFile):
+    pytest.importorskip("pysam")
+    filename, expected = bamFile
+    assert list(readChromosomeEndReads(filename, endDistance, backend="pysam")) == expected
+
+
+def test_endDistance(bamFile):
+    filename, expected = bamFile
+    # With a larger endDistance, the reads away from the ends are read too
+    assert {qname for qname, _, _ in _readBamEnds(filename, 100000)} == {qname for qname, _, _ in expected} | {"pHardClipOnly", "middle", "middleLongCigar"}
+    # With an endDistance of 0, only the reads whose soft clips reach past a chromosome end are read
+    assert {qname for qname, _, _ in _readBamEnds(filename, 0)} == {"pForwardLeadingClip", "qForwardTrailingClip"}
+
+
+def test_telomericReads(tmp_path):
+    # The sequences and strands of reads with real telomeres agree with the strand found from the sequence
+    rng = np.random.default_rng(1)
+    records = []
+    body = _randomSeq(rng, 4000)
+    cTelomere, gTelomere = "CCCTAA" * 300, "TTAGGG" * 300
+    # p arm: the reference starts with the C strand telomere, q arm: it ends with the G strand telomere
+    records.append(_record("pForward", 0, 0, _parseCigar("1800S4000M"), cTelomere + body))
+    records.append(_record("pReverse", 0, 0, _parseCigar("1800S4000M"), cTelomere + body, flag=0x10))
+    records.append(_record("qForward", 0, references[0][1] - 4000, _parseCigar("4000M1800S"), body + gTelomere))
+    records.append(_record("qReverse", 0, references[0][1] - 4000, _parseCigar("4000M1800S"), body + gTelomere, flag=0x10))
+    filename = str(tmp_path / "telomeres.bam")
+    _writeBam(filename, records)
+    reads = list(_readBamEnds(filename, endDistance))
+    assert [qname for qname, _, _ in reads] == ["pForward", "pReverse", "qForward", "qReverse"]
+    for qname, seq, isGStrand in reads:
+        assert getTeloBoundary(seq)[1] == isGStrand
+        assert abs(getTeloBoundary(seq, isGStrand)[0] - 1800) < 200
+
+
+def test_chromosomeEndArm():
+    assert chromosomeEndArm(100000, 0, 5000, 2000) == "p"
+    assert chromosomeEndArm(100000, -300, 5000, 2000) == "p"
+    assert chromosomeEndArm(100000, 1999, 5000, 2000) == "p"
+    assert chromosomeEndArm(100000, 2000, 5000, 2000) is None
+    assert chromosomeEndArm(100000, 50000, 98001, 2000) == "q"
+    assert chromosomeEndArm(100000, 50000, 98000, 2000) is None
+    assert chromosomeEndArm(100000, 50000, 100400, 2000) == "q"
+    # A read near both ends gets the closer one
+    assert chromosomeEndArm(3000, 300, 2900, 2000) == "q"
+    assert chromosomeEndArm(3000, 100, 2800, 2000) == "p"
+    assert chromosomeEndArm(3000, 100, 2900, 2000) == "p"
+
+
+def test_softClips():
+    def clips(cigar):
+        ops, lengths = zip(*_parseCigar(cigar))
+        return _softClips(ops, lengths)
+
+    assert clips("100M") == (0, 0)
+    assert clips("10S100M") == (10, 0)
+    assert clips("100M20S") == (0, 20)
+    assert clips("10S100M20S") == (10, 20)
+    assert clips("5H10S100M20S7H") == (10, 20)
+    assert clips("5H100M7H") == (0, 0)
+    assert clips("5H10S100M") == (10, 0)
+    assert clips("100S") == (100, 0)
+    assert clips("5H100S") == (100, 0)
+
+
+def test_reverseComplement():
+    assert reverseComplement(b"=ACMGRSVTWYHKDBN") == b"NVHMDRWABSYCKGT="
+    assert reverseComplement(b"acgtn") == b"nacgt"
+    for seq in (_randomSeq(np.random.default_rng(2), 500, _seqCodes), "ACGT" * 10):
+        assert reverseComplement(reverseComplement(seq.encode())) == seq.encode()
+        assert reverseComplement(seq.encode()) == _reverseComplement(seq).encode()
+    for seq in (b"ACGT*", b"AC.GT", b"ACXT"):
+        with pytest.raises(ValueError):
+            reverseComplement(seq)
@@ -0,0 +1,81 @@
+# Checks that the batch API (getTeloBoundaryBatch, getTeloNPBoundaryBatch) gives, for every read, the result of
+# getTeloBoundary / getTeloNPBoundary on that read alone: telomere lengths, strands and error returns, with the
+# strand inferred, given for the whole batch, or given per read (None, True or False mixed within the batch).
+#
+# Run with: python -m pytest tests
+
+import random
+
+import numpy as np
+import pytest
+
+from TeloBP import getTeloBoundary, getTeloNPBoundary, getTeloBoundaryBatch, getTeloNPBoundaryBatch
+from TeloBP.constants import errorReturns
+from TeloBP.syntheticReads import syntheticReads, syntheticTelomericRead
+
+functionPairs = [(getTeloBoundary, getTeloBoundaryBatch), (getTeloNPBoundary, getTeloNPBoundaryBatch)]
+
+
+def _randomSeq(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def _reads():
+    rng = random.Random(0)
+    reads = [seq for _, seq, _, _ in syntheticReads(16, 12000, 200, 8000, 0.5, 0.03, 0.01, 0.01, 300, 0)]
+    reads += [
+        # Shorter than teloWindow
+        "TTAGGG" * 10,
+        "",
+        # No telomere repeats, so no strand
+        _randomSeq(rng, 5000),
+        # Telomere repeats of both strands
+        "CCCTAA" * 400 + _randomSeq(rng, 3000) + "TTAGGG" * 400,
+        # All telomere, so no boundary
+        "TTAGGG" * 1000,
+        # Lower case and bytes
+        syntheticTelomericRead(8000, 3000, False, 0.02, rng=np.random.default_rng(1))[0].lower(),
+        syntheticTelomericRead(8000, 3000, True, 0.02, rng=np.random.default_rng(2))[0].encode(),
+    ]
+    return reads
+
+
+def _assertBatchMatches(function, batchFunction, reads, isGStrand, **kwargs):
+    lengths, strands, errorCodes = batchFunction(reads, isGStrand, **kwargs)
+    readStrands = isGStrand if isinstance(isGStrand, list) else [isGStrand] * len(reads)
+    for i, (seq, readIsGStrand) in enumerate(zip(reads, readStrands)):
+        expectedLength, expectedIsGStrand = function(seq, readIsGStrand, **kwargs)
+        assert lengths[i] == expectedLength, i
+        if expectedIsGStrand is None:
+            assert strands[i] == -1 and errorCodes[i] == expectedLength, i
+        else:
+            assert strands[i] == expectedIsGStrand and errorCodes[i] == 0, i
+
+
+@pytest.mark.parametrize("function, batchFunction", functionPairs)
+@pytest.mark.parametrize("isGStrand", [None, True, False])
+def test_batchMatchesPerRead(function, batchFunction, isGStrand):
+    _assertBatchMatches(function, batchFunction, _reads(), isGStrand)
+
+
+@pytest.mark.parametrize("function, batchFunction", functionPairs)
+def test_batchMixedStrands(function, batchFunction):
+    reads = _reads()
+    rng = random.Random(1)
+    _assertBatchMatches(function, batchFunction, reads, [rng.choice([None, True, False]) for _ in reads])
+
+
+@pytest.mark.parametrize("function, batchFunction", functionPairs)
+def test_batchWithPrefilter(function, batchFunction):
+    _assertBatchMatches(function, batchFunction, _reads(), None, prefilter=True)
+
+
+def test_batchErrorReturns():
+    # The batch covers every error the reads above can give
+    errorCodes = set(getTeloBoundaryBatch(_reads(), prefilter=True)[2].tolist()) | set(getTeloBoundaryBatch(_reads())[2].tolist())
+    assert {0, errorReturns["init"], errorReturns["fusedRead"], errorReturns["strandType"], errorReturns["noTelomere"]} <= errorCodes
+
+
+def test_batchStrandLength():
+    with pytest.raises(ValueError):
+        getTeloBoundaryBatch(_reads(), [True])
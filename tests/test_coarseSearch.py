@@ -0,0 +1,67 @@
+# Checks of the coarse to fine boundary search (the coarseWindowStep parameter of getTeloBoundary) against the full
+# resolution search, on synthetic 50 kb reads:
+#
+# - With up to 4% substitutions (and 2.7% insertions and deletions each), the boundaries must be identical (within
+#   0 bases), or neither search finds one, for TeloBP with returnLastDiscontinuity or earlyTermination off, and TeloNP.
+# - With 8% substitutions, where the noisy full resolution area curve dips inside the telomere and the coarse windows
+#   step over the dip, the reads must agree on whether there is a boundary, and where they differ, the coarse boundary
+#   must be the closer one to the true boundary.
+#
+# Run with: python -m pytest tests
+
+import pytest
+
+import TeloBP.TeloBP as teloBP
+from TeloBP import getTeloBoundary, getTeloNPBoundary
+from TeloBP.constants import defaultCoarseWindowStep, coarseMinScanLength
+from TeloBP.syntheticReads import syntheticReads
+
+searches = [
+    (getTeloBoundary, {"returnLastDiscontinuity": True}),
+    (getTeloBoundary, {"earlyTermination": False}),
+    (getTeloNPBoundary, {}),
+]
+
+
+def _reads(numReads, substitutionRate, seed, readLength=50000):
+    indelRate = substitutionRate * 2 / 3
+    return list(syntheticReads(numReads, readLength, 500, 20000, 0.5, substitutionRate, indelRate, indelRate, 300, seed))
+
+
+@pytest.mark.parametrize("function, kwargs", searches)
+@pytest.mark.parametrize("substitutionRate", [0.0, 0.02, 0.04])
+def test_coarseMatchesFull(function, kwargs, substitutionRate):
+    for _, seq, _, _ in _reads(40, substitutionRate, int(substitutionRate * 100) + 7):
+        assert function(seq, coarseWindowStep=defaultCoarseWindowStep, **kwargs) == function(seq, **kwargs)
+
+
+@pytest.mark.parametrize("function, kwargs", searches)
+def test_coarseDifferencesOnNoisyReads(function, kwargs):
+    numDiffering = 0
+    for _, seq, _, telomereLength in _reads(60, 0.08, 15):
+        full = function(seq, **kwargs)
+        coarse = function(seq, coarseWindowStep=defaultCoarseWindowStep, **kwargs)
+        assert (full[1] is None) == (coarse[1] is None)
+        if coarse != full:
+            numDiffering += 1
+            assert coarse[1] == full[1]
+            assert abs(coarse[0] - telomereLength) < abs(full[0] - telomereLength)
+    if function is getTeloBoundary:
+        # TeloBP's area curve is noisier on these reads, so some of its boundaries differ
+        assert numDiffering > 0
+
+
+def test_coarseSearchOnlyOnFullScansOfLongReads(monkeypatch):
+    def noCoarseSearch(*args, **kwargs):
+        raise AssertionError("the coarse search was run")
+
+    monkeypatch.setattr(teloBP, "_coarseWindowRange", noCoarseSearch)
+    longRead = _reads(1, 0.02, 3)[0][1]
+    shortRead = _reads(1, 0.02, 3, readLength=coarseMinScanLength - 1000)[0][1]
+    # The early terminating scan doesn't score the whole read, and short reads aren't worth the extra pass
+    getTeloBoundary(longRead, coarseWindowStep=defaultCoarseWindowStep)
+    getTeloNPBoundary(shortRead, coarseWindowStep=defaultCoarseWindowStep)
+    # Nor is a coarse step that isn't larger than windowStep
+    getTeloNPBoundary(longRead, coarseWindowStep=6)
+    with pytest.raises(AssertionError):
+        getTeloNPBoundary(longRead, coarseWindowStep=defaultCoarseWindowStep)
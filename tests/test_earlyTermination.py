@@ -0,0 +1,78 @@
+# Checks that the early terminating scan of getTeloBoundary (earlyTermination=True, the default) gives the same
+# result as scoring the whole read, for TeloBP and TeloNP with every combination of returnLastDiscontinuity and
+# secondarySearch, including boundaries at the edge of a scanChunkSize chunk, and the maxScanLength cutoff.
+#
+# Run with: python -m pytest tests
+
+import itertools
+
+import numpy as np
+import pytest
+
+from TeloBP import getTeloBoundary, getTeloNPBoundary
+from TeloBP.constants import scanChunkSize, expectedTeloCompositionQ
+from TeloBP.offsetScoring import getNtOffsets, scanGraphAreaUntilBoundary
+from TeloBP.syntheticReads import syntheticReads, syntheticTelomericRead
+from TeloBP.teloBoundaryHelpers import getGraphArea, findThresholdIndex, findPlateauIndex, asUpperSeqBytes
+
+windowStep = 6
+# The first chunk of the scan ends after this many bases
+chunkEdge = (scanChunkSize // windowStep) * windowStep
+
+
+def _reads():
+    reads = []
+    for seed, noise in enumerate([0.0, 0.02, 0.06]):
+        reads += [seq for _, seq, _, _ in syntheticReads(12, 25000, 300, 14000, 0.5, noise, noise / 2, noise / 2, 300, seed)]
+    # Telomeres ending around the first chunk edge, one of them exactly on it
+    reads += [syntheticTelomericRead(30000, length, True, rng=np.random.default_rng(length))[0] for length in range(9900, 10100, 6)]
+    return reads
+
+
+@pytest.mark.parametrize("boundaryFunction", [getTeloBoundary, getTeloNPBoundary])
+@pytest.mark.parametrize("returnLastDiscontinuity, secondarySearch", list(itertools.product([False, True], repeat=2)))
+def test_earlyTerminationMatchesFullScan(boundaryFunction, returnLastDiscontinuity, secondarySearch):
+    for seq in _reads():
+        args = dict(returnLastDiscontinuity=returnLastDiscontinuity, secondarySearch=secondarySearch)
+        assert boundaryFunction(seq, earlyTermination=True, **args) == boundaryFunction(seq, earlyTermination=False, **args)
+
+
+def test_boundaryOnChunkEdge():
+    seq = syntheticTelomericRead(30000, 10014, True, rng=np.random.default_rng(10014))[0]
+    assert getTeloBoundary(seq, earlyTermination=True) == getTeloBoundary(seq, earlyTermination=False) == (chunkEdge, True)
+
+
+@pytest.mark.parametrize("offset", [-2, -1, 0, 1, 2])
+def test_scanWithChunkEdgeAtBoundary(offset):
+    # Chunks ending just before, on and just after the window of the boundary give the area list of the whole read
+    ntPatternEntry = expectedTeloCompositionQ[0]
+    graphAreaWindowSize = int(500 / windowStep)
+    for seq in _reads()[:12]:
+        seq = asUpperSeqBytes(seq)
+        numWindows = len(range(0, len(seq) - 100, windowStep))
+        fullAreas = getGraphArea(getNtOffsets(seq, [ntPatternEntry], True, 100, windowStep), 0, graphAreaWindowSize)
+        thresholdIndex = findThresholdIndex(fullAreas, -50)
+        if thresholdIndex == -1:
+            continue
+        plateauIndex = findPlateauIndex(np.diff(fullAreas), thresholdIndex)
+        # The plateau search needs the areas up to plateauIndex + 2, and each area the offsets of the following windows
+        edgeWindow = max(plateauIndex + 2 + graphAreaWindowSize + offset, 1)
+        areas = scanGraphAreaUntilBoundary(seq, ntPatternEntry, True, 100, windowStep, numWindows, graphAreaWindowSize, -50, chunkSize=edgeWindow * windowStep)
+        np.testing.assert_array_equal(areas, fullAreas[:len(areas)])
+        assert findThresholdIndex(areas, -50) == thresholdIndex
+        assert findPlateauIndex(np.diff(areas), thresholdIndex) == plateauIndex
+
+
+@pytest.mark.parametrize("isGStrand", [False, True])
+def test_maxScanLength(isGStrand):
+    # Only the first maxScanLength bases from the telomeric end are scored, so the result is that of the read cut to them
+    for telomereLength in (2000, 8000, 15000):
+        seq = syntheticTelomericRead(40000, telomereLength, isGStrand, 0.02, 0.01, 0.01, rng=np.random.default_rng(telomereLength))[0]
+        for maxScanLength in (5000, 12000, 30000):
+            cut = seq[-maxScanLength:] if isGStrand else seq[:maxScanLength]
+            expected = getTeloBoundary(cut, isGStrand=isGStrand, earlyTermination=False)
+            for earlyTermination in (True, False):
+                assert getTeloBoundary(seq, isGStrand=isGStrand, earlyTermination=earlyTermination, maxScanLength=maxScanLength) == expected
+            if telomereLength > maxScanLength:
+                # The telomere runs past the cutoff, so no plateau is found within it
+                assert expected[0] < 0 or expected[0] >= maxScanLength - 100 - 500 - 2 * windowStep
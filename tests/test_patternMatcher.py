@@ -0,0 +1,210 @@
+# Equivalence checks of the NumPy pattern matchers (TeloBP.patternMatcher) and the vectorized window scoring
+# (TeloBP.offsetScoring) against the re module.
+#
+# - Every alternative of randomly generated fixed width patterns (literals, classes, negated classes, wildcards,
+#   nested alternations, fixed repeats and lookaheads), and of the default and TeloNP compositions, must match at
+#   exactly the positions where re matches it.
+# - getNtOffsets must give exactly the offsets of getNtOffsetsReference, for compiled patterns and for the patterns
+#   that fall back to regex finders.
+# - repeatMatchSpans must give the spans of re.finditer on the repeated pattern, and getIsGStrandFromSeq the same
+#   strand with the hit vectors as with the regex.
+#
+# The sequences are random, telomere rich (repeat runs touching the read ends, separated by single base mismatches)
+# and synthetic ONT-like reads with substitutions, insertions and deletions (TeloBP.syntheticReads).
+#
+# Run with: python -m pytest tests
+
+import random
+import re
+
+import numpy as np
+import pytest
+
+import TeloBP.TeloBP as teloBP
+from TeloBP.constants import expectedTeloCompositionQ, expectedTeloCompositionP, teloNPTeloCompositionGStrand, teloNPTeloCompositionCStrand
+from TeloBP.offsetScoring import getNtOffsets, getNtOffsetsReference, _patternMatchers, _splitTopLevelAlternation
+from TeloBP.patternMatcher import compilePatternMatcher, matcherHits, repeatMatchSpans
+from TeloBP.syntheticReads import syntheticReads
+
+defaultCompositions = [expectedTeloCompositionQ, expectedTeloCompositionP]
+teloNPCompositions = [teloNPTeloCompositionGStrand, teloNPTeloCompositionCStrand]
+# Patterns that aren't fixed width, or look outside of the bases they match, are scored with regex finders
+fallbackCompositions = [
+    [["(GGG)+", 3/6, 3]],
+    [["(?<=T)AGGG", 4/6, 4]],
+    [["CC+T|AA", 3/6, 3], ["CCC", 3/6]],
+    [["GGG(?=TTA)", 3/6, 3]],
+]
+telomereRepeats = ["TTAGGG", "CCCTAA", "TTGGGG", "TGAGGG", "CTTCTT", "CCTGG"]
+
+
+def _randomSeq(rng, length, alphabet="ACGT"):
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+
+def _telomericSeq(rng, length):
+    # Runs of telomere repeats separated by random stretches and single base mismatches, starting and ending with a run
+    parts = []
+    total = 0
+    while total < length:
+        repeat = rng.choice(telomereRepeats)
+        run = list(repeat * rng.randint(1, 12))
+        for _ in range(rng.randint(0, 2)):
+            run[rng.randrange(len(run))] = rng.choice("ACGTN")
+        parts.append("".join(run))
+        if rng.random() < 0.5:
+            parts.append(_randomSeq(rng, rng.choice([1, 1, 2, 5, 7, 30])))
+        total += len(parts[-1]) + len(run)
+    seq = "".join(parts)[:length]
+    return seq[:length - 12] + rng.choice(telomereRepeats) * 2
+
+
+def _testSeqs(seed, count=6, length=3000):
+    rng = random.Random(seed)
+    seqs = [_randomSeq(rng, length), _randomSeq(rng, length, "ACGTN")]
+    seqs += [_telomericSeq(rng, length) for _ in range(count)]
+    seqs += [seq for _, seq, _, _ in syntheticReads(2, length, 500, 2000, 0.5, 0.05, 0.02, 0.02, 300, seed)]
+    return [seq.encode() for seq in seqs]
+
+
+def _randomUnit(rng):
+    # A single base unit of a pattern
+    kind = rng.randrange(5)
+    if kind == 0:
+        return rng.choice("ACGT")
+    if kind == 1:
+        return "[" + "".join(rng.sample("ACGT", rng.randint(1, 3))) + "]"
+    if kind == 2:
+        return "[^" + "".join(rng.sample("ACGT", rng.randint(1, 2))) + "]"
+    if kind == 3:
+        return "."
+    return "[A-C]"
+
+
+def _randomFixedWidth(rng, width, depth=0):
+    # A pattern matching exactly width bases, made of units, nested alternations and fixed repeats
+    parts = []
+    remaining = width
+    while remaining > 0:
+        kind = rng.randrange(4) if depth < 2 else 0
+        if kind == 1 and remaining >= 2:
+            groupWidth = rng.randint(1, remaining)
+            alternatives = [_randomFixedWidth(rng, groupWidth, depth + 1) for _ in range(rng.randint(2, 3))]
+            parts.append("(" + "|".join(alternatives) + ")")
+            remaining -= groupWidth
+        elif kind == 2 and remaining >= 2:
+            count = rng.randint(2, remaining)
+            parts.append("(?:" + _randomUnit(rng) + "){" + str(count) + "}")
+            remaining -= count
+        else:
+            parts.append(_randomUnit(rng))
+            remaining -= 1
+    return "".join(parts)
+
+
+def _randomBranch(rng):
+    # A fixed width alternative, optionally starting with a lookahead that stays within the bases it matches
+    width = rng.randint(1, 7)
+    branch = _randomFixedWidth(rng, width)
+    if rng.random() < 0.4:
+        lookahead = _randomFixedWidth(rng, rng.randint(1, width), depth=1)
+        branch = ("(?!" if rng.random() < 0.7 else "(?=") + lookahead + ")" + branch
+    return branch
+
+
+def _randomPattern(rng):
+    return "|".join(_randomBranch(rng) for _ in range(rng.randint(1, 3)))
+
+
+def _regexHits(branch, seq):
+    # The start of every (overlapping) match of a branch
+    return np.array([match.start() for match in re.finditer(("(?=(?:" + branch + "))").encode(), seq)], dtype=np.int64)
+
+
+def _compositionPatterns():
+    return [entry[0] for composition in defaultCompositions + teloNPCompositions for entry in composition]
+
+
+def _assertMatcherHits(pattern, seqs):
+    branches = tuple(_splitTopLevelAlternation(pattern))
+    matchers = compilePatternMatcher(branches)
+    assert matchers is not None, pattern
+    for seq in seqs:
+        for branch, hits in zip(branches, matcherHits(matchers, seq)):
+            np.testing.assert_array_equal(hits, _regexHits(branch, seq), err_msg=f"{branch} in {seq[:60]!r}")
+
+
+@pytest.mark.parametrize("pattern", _compositionPatterns())
+def test_compositionPatternHits(pattern):
+    _assertMatcherHits(pattern, _testSeqs(1))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_randomPatternHits(seed):
+    rng = random.Random(seed)
+    seqs = _testSeqs(100 + seed, count=2, length=1500)
+    for _ in range(25):
+        _assertMatcherHits(_randomPattern(rng), seqs)
+
+
+def test_fallbackPatternsNotCompiled():
+    for composition in fallbackCompositions:
+        assert _patternMatchers(composition[0][0]) is None
+
+
+def _assertOffsets(seqs, composition, teloWindow, windowStep):
+    for seq in seqs:
+        for isGStrand in (False, True):
+            reference = np.array(getNtOffsetsReference(seq, composition, isGStrand, teloWindow, windowStep), dtype=float)
+            offsets = getNtOffsets(seq, composition, isGStrand, teloWindow, windowStep)
+            np.testing.assert_array_equal(np.asarray(offsets).reshape(reference.shape), reference)
+
+
+@pytest.mark.parametrize("composition", defaultCompositions + teloNPCompositions + fallbackCompositions)
+@pytest.mark.parametrize("teloWindow, windowStep", [(100, 6), (90, 6), (37, 5)])
+def test_ntOffsets(composition, teloWindow, windowStep):
+    _assertOffsets(_testSeqs(2, count=2, length=2000), composition, teloWindow, windowStep)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_randomPatternOffsets(seed):
+    rng = random.Random(seed)
+    seqs = _testSeqs(200 + seed, count=2, length=1200)
+    for _ in range(5):
+        pattern = _randomPattern(rng)
+        _assertOffsets(seqs, [[pattern, 3/6, 3]], 100, 6)
+
+
+def _repeatRegex(pattern, repeats, maxGap):
+    gap = ".{0," + str(maxGap) + "}"
+    return re.compile(((("(" + pattern + ")" + gap) * repeats)[:-len(gap)]).encode())
+
+
+@pytest.mark.parametrize("repeats, maxGap", [(4, 6), (1, 6), (2, 0), (3, 1), (5, 12)])
+def test_repeatMatchSpans(repeats, maxGap):
+    rng = random.Random(repeats * 100 + maxGap)
+    patterns = _compositionPatterns() + [_randomPattern(rng) for _ in range(10)]
+    # Repeat runs touching both read ends, and runs separated by one base mismatches
+    seqs = _testSeqs(3) + [b"TTAGGG" * 8 + b"C" + b"TTAGGG" * 8, b"CCCTAA" * 5 + b"A" + b"CCCTAA" * 3 + b"TTAGGGT" * 6]
+    for pattern in patterns:
+        matchers = _patternMatchers(pattern)
+        if matchers is None:
+            continue
+        regex = _repeatRegex(pattern, repeats, maxGap)
+        for seq in seqs:
+            expected = [match.span() for match in regex.finditer(seq)]
+            assert repeatMatchSpans(matchers, seq, repeats, maxGap) == expected, (pattern, seq[:60])
+
+
+@pytest.mark.parametrize("compositions", [(expectedTeloCompositionQ, expectedTeloCompositionP), (teloNPTeloCompositionGStrand, teloNPTeloCompositionCStrand)])
+def test_strandFromHitsMatchesRegex(compositions, monkeypatch):
+    gStrandPattern, cStrandPattern = compositions[0][-1], compositions[1][-1]
+    seqs = _testSeqs(4, count=8, length=6000)
+    seqs += [seq.encode() for _, seq, _, _ in syntheticReads(6, 8000, 200, 4000, 0.5, 0.08, 0.03, 0.03, 500, 4)]
+    seqs += [b"TTAGGG" * 500, b"CCCTAA" * 400 + b"A" + b"CCCTAA" * 400]
+    for seq in seqs:
+        monkeypatch.setattr(teloBP, "strandRepeatRegexMaxLength", 0)
+        fromHits = teloBP.getIsGStrandFromSeq(seq, gStrandPattern, cStrandPattern)
+        monkeypatch.setattr(teloBP, "strandRepeatRegexMaxLength", len(seq) + 1)
+        fromRegex = teloBP.getIsGStrandFromSeq(seq, gStrandPattern, cStrandPattern)
+        assert fromHits == fromRegex
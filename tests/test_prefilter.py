@@ -0,0 +1,101 @@
+# Checks of the telomere end prefilter: hasTeloEnd with repeats at one end of the read only, at the edge of the
+# prefilterEndLength bases checked at each end, too spread out, or missing, and the errorReturns["noTelomere"] return
+# of getTeloBoundary and getTeloNPBoundary when the prefilter is on.
+#
+# Run with: python -m pytest tests
+
+import random
+
+import numpy as np
+import pytest
+
+from TeloBP import getTeloBoundary, getTeloNPBoundary, hasTeloEnd
+from TeloBP.constants import errorReturns, prefilterEndLength, prefilterBlockSize, prefilterMinRepeats
+from TeloBP.syntheticReads import syntheticTelomericRead
+
+readLength = 40000
+gBlock = "TTAGGG" * prefilterMinRepeats
+cBlock = "CCCTAA" * prefilterMinRepeats
+
+
+def _background(length, seed=0):
+    # Neither TTAGGG nor CCCTAA can occur without a T
+    rng = random.Random(seed)
+    return "".join(rng.choice("ACG") for _ in range(length))
+
+
+def _withBlock(block, start, length=readLength):
+    seq = _background(length)
+    return seq[:start] + block + seq[start + len(block):]
+
+
+def test_noRepeats():
+    seq = _background(readLength)
+    for isGStrand in (None, True, False):
+        assert not hasTeloEnd(seq, isGStrand)
+
+
+@pytest.mark.parametrize("isGStrand", [True, False])
+def test_repeatsAtOneEnd(isGStrand):
+    # G strand telomeres are at the end of the read, C strand telomeres at the start
+    seq = _withBlock(gBlock, readLength - len(gBlock)) if isGStrand else _withBlock(cBlock, 0)
+    assert hasTeloEnd(seq)
+    assert hasTeloEnd(seq, isGStrand)
+    assert not hasTeloEnd(seq, not isGStrand)
+    # The repeats of a strand only count at that strand's end
+    wrongEnd = _withBlock(gBlock, 0) if isGStrand else _withBlock(cBlock, readLength - len(cBlock))
+    assert not hasTeloEnd(wrongEnd)
+
+
+def test_repeatsAtEndLengthEdge():
+    # The repeats pass while they all lie within the last (G strand) or first (C strand) prefilterEndLength bases
+    assert hasTeloEnd(_withBlock(gBlock, readLength - prefilterEndLength), True)
+    assert not hasTeloEnd(_withBlock(gBlock, readLength - prefilterEndLength - 1), True)
+    assert hasTeloEnd(_withBlock(cBlock, prefilterEndLength - len(cBlock)), False)
+    assert not hasTeloEnd(_withBlock(cBlock, prefilterEndLength - len(cBlock) + 1), False)
+    for endLength in (100, 1000):
+        assert hasTeloEnd(_withBlock(gBlock, readLength - endLength), True, endLength=endLength)
+        assert not hasTeloEnd(_withBlock(gBlock, readLength - endLength - 1), True, endLength=endLength)
+
+
+def test_endLengthLongerThanRead():
+    seq = _withBlock(gBlock, 0, 200)
+    assert not hasTeloEnd(seq, True, endLength=0)
+    assert hasTeloEnd(seq, True, endLength=200)
+    assert hasTeloEnd(seq, True, endLength=prefilterEndLength)
+
+
+def test_repeatsSpreadOut():
+    # minRepeats repeats must fall within blockSize bases
+    span = prefilterBlockSize - len("TTAGGG")
+    seq = _background(readLength)
+    for gap in (span // (prefilterMinRepeats - 1), span // (prefilterMinRepeats - 1) + 1):
+        spread = seq
+        for i in range(prefilterMinRepeats):
+            start = readLength - 1000 + i * gap
+            spread = spread[:start] + "TTAGGG" + spread[start + 6:]
+        assert hasTeloEnd(spread, True) == (gap * (prefilterMinRepeats - 1) <= span)
+
+
+def test_caseAndTypes():
+    seq = _withBlock(gBlock, readLength - len(gBlock))
+    for value in (seq.lower(), seq.encode(), np.frombuffer(seq.encode(), dtype=np.uint8)):
+        assert hasTeloEnd(value, True)
+
+
+@pytest.mark.parametrize("function", [getTeloBoundary, getTeloNPBoundary])
+def test_prefilterErrorReturn(function):
+    assert function(_background(readLength), prefilter=True) == (errorReturns["noTelomere"], None)
+    # Reads that pass the prefilter get the result of the boundary search without it
+    for isGStrand in (True, False):
+        seq = syntheticTelomericRead(12000, 3000, isGStrand, 0.02, rng=np.random.default_rng(int(isGStrand)))[0]
+        assert function(seq, prefilter=True) == function(seq) == function(seq, isGStrand, prefilter=True)
+        # Given the other strand, the read has no repeats at the end that is checked
+        assert function(seq, not isGStrand, prefilter=True) == (errorReturns["noTelomere"], None)
+
+
+def test_teloNPPrefilterKmers():
+    # getTeloNPBoundary also counts the TTAAAA repeats Guppy calls in G strand telomeres
+    seq = _withBlock("TTAAAA" * 40, readLength - 240)
+    assert getTeloBoundary(seq, prefilter=True) == (errorReturns["noTelomere"], None)
+    assert getTeloNPBoundary(seq, True, prefilter=True)[0] != errorReturns["noTelomere"]
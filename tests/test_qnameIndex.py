@@ -0,0 +1,171 @@
+# Checks of the targeted fastq reader (TeloBP.qnameIndex): readTargetFastq with and without a qname index, the
+# continuation of partial scans (scannedTo / complete), seeking into bgzip files with _OffsetReader, and qname hash
+# collisions.
+#
+# Run with: python -m pytest tests
+
+import gzip
+import os
+import random
+
+import numpy as np
+import pytest
+from Bio import bgzf
+
+import TeloBP.qnameIndex as qnameIndex
+from TeloBP.qnameIndex import readTargetFastq, loadQnameIndex, qnameIndexPrefix, qnameIndexExtension, _OffsetReader
+
+
+def _records(numReads=300, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for i in range(numReads):
+        seq = "".join(rng.choice("ACGT") for _ in range(rng.randint(50, 400)))
+        records.append((f"read{i}", seq, f"@read{i} runid=0 ch={i % 7}\n{seq}\n+\n{'I' * len(seq)}\n"))
+    return records
+
+
+def _writeFastq(filename, records, compression=None):
+    text = "".join(record for _, _, record in records).encode()
+    if compression == "bgzip":
+        # Small blocks, so that records span block boundaries
+        with bgzf.BgzfWriter(filename, "wb") as handle:
+            for start in range(0, len(text), 1000):
+                handle.write(text[start:start + 1000])
+                handle.flush()
+    elif compression == "gzip":
+        with gzip.open(filename, "wb") as handle:
+            handle.write(text)
+    else:
+        with open(filename, "wb") as handle:
+            handle.write(text)
+    return filename
+
+
+def _read(filename, qnames, indexDir=None):
+    return list(readTargetFastq(filename, set(qnames), indexDir))
+
+
+def _expected(records, qnames):
+    return [(qname, seq.encode()) for qname, seq, _ in records if qname in qnames]
+
+
+def _indexFilename(filename, indexDir):
+    return qnameIndexPrefix(filename, indexDir) + qnameIndexExtension
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "bgzip"])
+def test_targetsWithAndWithoutIndex(tmp_path, compression):
+    records = _records()
+    filename = _writeFastq(str(tmp_path / "reads.fastq"), records, compression)
+    indexDir = str(tmp_path / "indexes")
+    targets = {"read5", "read77", "read299", "read150", "missing"}
+    for _ in range(2):
+        assert _read(filename, targets) == _expected(records, targets)
+        assert _read(filename, targets, indexDir) == _expected(records, targets)
+    # The indexes are only written in indexDir, and not for plain gzip files
+    assert set(os.listdir(tmp_path)) <= {"reads.fastq", "indexes"}
+    assert os.path.exists(_indexFilename(filename, indexDir)) == (compression != "gzip")
+    assert os.path.exists(qnameIndexPrefix(filename, indexDir) + ".gzi") == (compression == "bgzip")
+
+
+def test_targetsRemovedWhenFound(tmp_path):
+    records = _records()
+    filename = _writeFastq(str(tmp_path / "reads.fastq"), records)
+    targets = {"read3", "read4", "missing"}
+    list(readTargetFastq(filename, targets, str(tmp_path / "indexes")))
+    assert targets == {"missing"}
+
+
+@pytest.mark.parametrize("compression", [None, "bgzip"])
+def test_partialScanContinuation(tmp_path, compression, monkeypatch):
+    records = _records()
+    filename = _writeFastq(str(tmp_path / "reads.fastq"), records, compression)
+    indexDir = str(tmp_path / "indexes")
+    recordOffsets = np.cumsum([0] + [len(record) for _, _, record in records])
+
+    # The scan stops after the last target, so the index covers the records up to it
+    assert _read(filename, ["read10", "read40"], indexDir) == _expected(records, {"read10", "read40"})
+    index = loadQnameIndex(filename, _indexFilename(filename, indexDir))
+    assert not index.complete
+    assert index.scannedTo == recordOffsets[41]
+    assert sorted(index.offsets.tolist()) == recordOffsets[:41].tolist()
+
+    # Targets covered by the index are read from their offsets, the others continue the scan from scannedTo
+    assert _read(filename, ["read20", "read120"], indexDir) == _expected(records, {"read20", "read120"})
+    index = loadQnameIndex(filename, _indexFilename(filename, indexDir))
+    assert not index.complete
+    assert index.scannedTo == recordOffsets[121]
+    assert sorted(index.offsets.tolist()) == recordOffsets[:121].tolist()
+
+    # A target that isn't in the file makes the scan reach the end
+    assert _read(filename, ["missing", "read200"], indexDir) == _expected(records, {"read200"})
+    index = loadQnameIndex(filename, _indexFilename(filename, indexDir))
+    assert index.complete
+    assert index.scannedTo == recordOffsets[-1]
+    assert sorted(index.offsets.tolist()) == recordOffsets[:-1].tolist()
+
+    # Once complete, the file isn't scanned again
+    def noScan(*args, **kwargs):
+        raise AssertionError("the file was scanned")
+        yield
+
+    qnames = {f"read{i}" for i in range(0, 300, 13)} | {"missing"}
+    monkeypatch.setattr(qnameIndex, "_scanFastq", noScan)
+    assert _read(filename, qnames, indexDir) == _expected(records, qnames)
+
+
+def test_staleIndexRebuilt(tmp_path):
+    filename = _writeFastq(str(tmp_path / "reads.fastq"), _records(seed=0))
+    indexDir = str(tmp_path / "indexes")
+    _read(filename, ["missing"], indexDir)
+    # A fastq newer than its index is scanned again
+    records = _records(seed=1)
+    _writeFastq(filename, records)
+    os.utime(filename, (os.path.getmtime(filename) + 10,) * 2)
+    assert not loadQnameIndex(filename, _indexFilename(filename, indexDir)).complete
+    assert _read(filename, ["read7", "read250"], indexDir) == _expected(records, {"read7", "read250"})
+
+
+def test_sameNameInOtherDirectories(tmp_path):
+    indexDir = str(tmp_path / "indexes")
+    os.makedirs(tmp_path / "a")
+    os.makedirs(tmp_path / "b")
+    recordsA, recordsB = _records(seed=2), _records(seed=3)
+    filenameA = _writeFastq(str(tmp_path / "a" / "reads.fastq"), recordsA)
+    filenameB = _writeFastq(str(tmp_path / "b" / "reads.fastq"), recordsB)
+    for _ in range(2):
+        assert _read(filenameA, ["read8", "missing"], indexDir) == _expected(recordsA, {"read8"})
+        assert _read(filenameB, ["read8", "missing"], indexDir) == _expected(recordsB, {"read8"})
+
+
+def test_bgzipOffsetReader(tmp_path):
+    records = _records()
+    filename = _writeFastq(str(tmp_path / "reads.fastq.gz"), records, "bgzip")
+    gziFilename = str(tmp_path / "reads.gzi")
+    reader = _OffsetReader(filename, gziFilename)
+    assert len(reader.blocks) > 10
+    assert os.path.exists(gziFilename)
+    text = "".join(record for _, _, record in records).encode()
+    # Every record start, and offsets at and around the block starts
+    offsets = np.cumsum([0] + [len(record) for _, _, record in records[:-1]]).tolist()
+    offsets += [offset + delta for offset in reader.blockStarts.tolist() for delta in (-1, 0, 1) if 0 <= offset + delta < len(text)]
+    for offset in offsets:
+        with reader.open(offset) as handle:
+            assert handle.read(120) == text[offset:offset + 120]
+    # The saved block index is used by later readers
+    assert _OffsetReader(filename, gziFilename).blocks == reader.blocks
+
+
+def test_hashCollisions(tmp_path, monkeypatch):
+    # With only 3 distinct hashes, most index lookups give records of other qnames, which must be skipped
+    monkeypatch.setattr(qnameIndex, "qnameHash", lambda qname: len(qname) % 3)
+    records = _records()
+    filename = _writeFastq(str(tmp_path / "reads.fastq"), records)
+    indexDir = str(tmp_path / "indexes")
+    _read(filename, ["missing"], indexDir)
+    index = loadQnameIndex(filename, _indexFilename(filename, indexDir))
+    assert index.complete and len(np.unique(index.hashes)) == 3
+    qnames = {"read1", "read42", "read199", "read7", "missing", "read2999"}
+    assert len(index.lookup([qname.encode() for qname in qnames])) > len(qnames)
+    assert _read(filename, qnames, indexDir) == _expected(records, qnames)
@@ -0,0 +1,131 @@
+# Checks of the per-read tables (TeloBP.readTable): the rows written, the row groups of the final files, and resuming
+# the partial rows of an interrupted writer from a checkpoint.
+#
+# Run with: python -m pytest tests
+
+import os
+
+import numpy as np
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.ipc
+import pyarrow.parquet
+
+from TeloBP.constants import errorReturns
+from TeloBP.readTable import ReadTableWriter, readTableExtensions
+
+rowGroupSize = 100
+
+
+def _batches(numBatches=25, batchSize=37, seed=0):
+    # (qnames, readLengths, telomereLengths, isGStrand) of batches of reads, some of them failed
+    rng = np.random.default_rng(seed)
+    batches = []
+    for batchIndex in range(numBatches):
+        size = batchSize + batchIndex % 3
+        telomereLengths = rng.integers(100, 20000, size)
+        isGStrand = rng.integers(0, 2, size)
+        failed = rng.random(size) < 0.2
+        telomereLengths[failed] = rng.choice(list(errorReturns.values()), failed.sum())
+        isGStrand[failed] = -1
+        qnames = [f"read{batchIndex}_{i}" for i in range(size)]
+        batches.append((qnames, rng.integers(1000, 100000, size), telomereLengths, isGStrand))
+    return batches
+
+
+def _readTable(path, tableFormat):
+    if tableFormat == "parquet":
+        return pa.parquet.read_table(path)
+    with pa.ipc.open_file(path) as reader:
+        return reader.read_all()
+
+
+def _rowGroupSizes(path, tableFormat):
+    if tableFormat == "parquet":
+        metadata = pa.parquet.ParquetFile(path).metadata
+        return [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    with pa.ipc.open_file(path) as reader:
+        return [reader.get_batch(i).num_rows for i in range(reader.num_record_batches)]
+
+
+def _assertRows(table, batches, sampleKey="sample"):
+    qnames, readLengths, telomereLengths, isGStrand = (np.concatenate([batch[i] for batch in batches]) for i in range(4))
+    assert table.column("qname").to_pylist() == qnames.tolist()
+    assert table.column("sampleKey").to_pylist() == [sampleKey] * len(qnames)
+    np.testing.assert_array_equal(table.column("readLength").to_numpy(), readLengths)
+    np.testing.assert_array_equal(table.column("telomereLength").to_numpy(), telomereLengths)
+    np.testing.assert_array_equal(table.column("isGStrand").to_numpy(), isGStrand)
+    np.testing.assert_array_equal(table.column("errorCode").to_numpy(), np.where(isGStrand < 0, telomereLengths, 0))
+
+
+@pytest.mark.parametrize("tableFormat", ["parquet", "arrow"])
+def test_rowGroups(tmp_path, tableFormat):
+    batches = _batches()
+    path = str(tmp_path / ("sample" + readTableExtensions[tableFormat]))
+    writer = ReadTableWriter(path, tableFormat, rowGroupSize=rowGroupSize)
+    for qnames, readLengths, telomereLengths, isGStrand in batches:
+        writer.write(qnames, "sample", readLengths, telomereLengths, isGStrand)
+    writer.write([], "sample", [], [], [])
+    assert not os.path.exists(path)
+    writer.close()
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+    numRows = sum(len(batch[0]) for batch in batches)
+    sizes = _rowGroupSizes(path, tableFormat)
+    # Every row group but the last has rowGroupSize rows, even though the batches straddle them
+    assert sizes == [rowGroupSize] * (numRows // rowGroupSize) + ([numRows % rowGroupSize] if numRows % rowGroupSize else [])
+    _assertRows(_readTable(path, tableFormat), batches)
+
+
+@pytest.mark.parametrize("tableFormat", ["parquet", "arrow"])
+@pytest.mark.parametrize("checkpointBatch", [0, 1, 12, 25])
+def test_resume(tmp_path, tableFormat, checkpointBatch):
+    # The writer is interrupted after writing more rows than its last checkpoint. The resumed writer keeps the rows up
+    # to the checkpoint, and the rows written after it are written again.
+    batches = _batches()
+    path = str(tmp_path / ("sample" + readTableExtensions[tableFormat]))
+    writer = ReadTableWriter(path, tableFormat, rowGroupSize=rowGroupSize)
+    for batch in batches[:checkpointBatch]:
+        writer.write(batch[0], "sample", *batch[1:])
+    resumeBytes = writer.checkpoint()
+    for batch in batches[checkpointBatch:checkpointBatch + 3]:
+        writer.write(batch[0], "sample", *batch[1:])
+    writer.abort()
+    assert not os.path.exists(path)
+
+    writer = ReadTableWriter(path, tableFormat, resumeBytes, rowGroupSize=rowGroupSize)
+    for batch in batches[checkpointBatch:]:
+        writer.write(batch[0], "sample", *batch[1:])
+    writer.close()
+    _assertRows(_readTable(path, tableFormat), batches)
+    assert not os.path.exists(path + ".partial")
+
+
+def test_partialRowsDiscarded(tmp_path):
+    # Without resumeBytes, the rows of a previous writer are discarded
+    batches = _batches()
+    path = str(tmp_path / "sample.parquet")
+    writer = ReadTableWriter(path, rowGroupSize=rowGroupSize)
+    for batch in batches[:5]:
+        writer.write(batch[0], "sample", *batch[1:])
+    writer.checkpoint()
+    writer.abort()
+    writer = ReadTableWriter(path, rowGroupSize=rowGroupSize)
+    for batch in batches[5:]:
+        writer.write(batch[0], "sample", *batch[1:])
+    writer.close()
+    _assertRows(_readTable(path, "parquet"), batches[5:])
+
+
+def test_errorCodesGiven(tmp_path):
+    path = str(tmp_path / "sample.arrow")
+    writer = ReadTableWriter(path, "arrow")
+    writer.write(["a", "b"], "sample", [500, 600], [-1, 300], [-1, 1], errorCodes=[-1000, 0])
+    writer.close()
+    assert _readTable(path, "arrow").column("errorCode").to_pylist() == [-1000, 0]
+
+
+def test_unknownFormat(tmp_path):
+    with pytest.raises(ValueError):
+        ReadTableWriter(str(tmp_path / "sample.csv"), "csv")
@@ -0,0 +1,128 @@
+# Checks of the on-disk result cache (TeloBP.resultCache): the cache keys change with every parameter that affects
+# the result, cached batches give the results of uncached ones, and the least recently used results are evicted
+# once the cache holds more than maxEntries reads.
+#
+# Run with: python -m pytest tests
+
+import inspect
+
+import numpy as np
+import pytest
+
+from TeloBP import getTeloBoundary, getTeloNPBoundary, getTeloBoundaryBatch, getTeloNPBoundaryBatch
+from TeloBP.resultCache import ResultCache, parameterDigest, functionParameters, sequenceKey, _unkeyedParameters
+from TeloBP.syntheticReads import syntheticReads
+
+# Other values of the parameters that aren't numbers, booleans or None
+otherCollectionValues = {
+    "compositionGStrand": [["TTAGGG", 3/6, 6]],
+    "compositionCStrand": [["CCCTAA", 3/6, 6]],
+    "compositionGStrandIn": [["TTAGGG", 3/6, 6]],
+    "compositionCStrandIn": [["CCCTAA", 3/6, 6]],
+    "prefilterKmersGStrand": ("TTAGGG", "TTGGGG"),
+    "prefilterKmersCStrand": ("CCCTAA", "CCCCAA"),
+}
+
+
+def _otherValue(name, value):
+    if name in otherCollectionValues:
+        assert otherCollectionValues[name] != value
+        return otherCollectionValues[name]
+    if value is None:
+        return True if name == "isGStrand" else 3000
+    if isinstance(value, bool):
+        return not value
+    if isinstance(value, (int, float)):
+        return value + 1
+    raise AssertionError(f"No other value for {name}={value!r}, add one to otherCollectionValues")
+
+
+@pytest.mark.parametrize("function", [getTeloBoundary, getTeloNPBoundary, getTeloBoundaryBatch, getTeloNPBoundaryBatch])
+def test_digestChangesWithEveryParameter(function):
+    params = functionParameters(function)
+    keyedNames = [name for name in inspect.signature(function).parameters if name not in _unkeyedParameters]
+    assert keyedNames
+    digest = parameterDigest(function.__name__, params)
+    digests = {digest}
+    for name in keyedNames:
+        otherDigest = parameterDigest(function.__name__, dict(params, **{name: _otherValue(name, params[name])}))
+        assert otherDigest not in digests, name
+        digests.add(otherDigest)
+    # The parameters that don't change the result give the same digest
+    for name in set(_unkeyedParameters) & set(params):
+        assert parameterDigest(function.__name__, dict(params, **{name: object()})) == digest
+    # Other functions with the same parameters give other digests
+    assert parameterDigest(function.__name__ + "Other", params) != digest
+
+
+def test_digestCanonical():
+    params = functionParameters(getTeloBoundary, teloWindow=100, maxScanLength=5000)
+    digest = parameterDigest("getTeloBoundary", params)
+    assert parameterDigest("getTeloBoundary", dict(params, teloWindow=np.int64(100), maxScanLength=np.int32(5000))) == digest
+    assert parameterDigest("getTeloBoundary", dict(reversed(list(params.items())))) == digest
+    assert parameterDigest("getTeloBoundary", dict(params, teloWindow=100.5)) != digest
+
+
+def test_sequenceKeys():
+    digest = parameterDigest("getTeloBoundary", functionParameters(getTeloBoundary))
+    otherDigest = parameterDigest("getTeloBoundary", functionParameters(getTeloBoundary, windowStep=5))
+    seq = "TTAGGG" * 50 + "ACGT" * 20
+    assert sequenceKey(seq, digest) == sequenceKey(seq.encode(), digest)
+    assert sequenceKey(seq, digest) != sequenceKey(seq, otherDigest)
+    assert sequenceKey(seq, digest) != sequenceKey(seq[:-1], digest)
+
+
+def _reads(numReads=40, seed=0):
+    return [seq for _, seq, _, _ in syntheticReads(numReads, 6000, 200, 4000, 0.5, 0.02, 0.01, 0.01, 0, seed)]
+
+
+def test_cachedBatchMatchesUncached(tmp_path):
+    reads = _reads()
+    strands = [None, True, False, None] * (len(reads) // 4)
+    expected = getTeloBoundaryBatch(reads, strands)
+    with ResultCache(str(tmp_path)) as cache:
+        for expectedHits in (0, len(reads)):
+            results = getTeloBoundaryBatch(reads, strands, cache=cache)
+            for result, expectedResult in zip(results, expected):
+                np.testing.assert_array_equal(result, expectedResult)
+            assert cache.hits == expectedHits
+        # Other parameters, or other strands, aren't taken from the cached results
+        getTeloBoundaryBatch(reads, strands, plateauDetectionThreshold=-55, cache=cache)
+        getTeloBoundaryBatch(reads, [None if strand is None else not strand for strand in strands], cache=cache)
+        assert cache.hits == len(reads) + len(reads) // 2
+        assert getTeloBoundary(reads[0], cache=cache) == getTeloBoundary(reads[0])
+    # The results are kept on disk
+    with ResultCache(str(tmp_path)) as cache:
+        getTeloBoundaryBatch(reads, strands, cache=cache)
+        assert cache.hits == len(reads)
+
+
+def _keys(start, end):
+    return [i.to_bytes(16, "little") for i in range(start, end)]
+
+
+def test_eviction(tmp_path):
+    with ResultCache(str(tmp_path), maxEntries=100) as cache:
+        cache.put(_keys(0, 100), range(100), [1] * 100)
+        assert cache.numEntries == 100
+        assert None not in cache.get(_keys(0, 100))
+        # The first keys are used again, so the next ones are the least recently used
+        cache.get(_keys(0, 20))
+        cache.put(_keys(100, 101), [100], [0])
+        # Evicted down to 90% of maxEntries
+        assert cache.numEntries == 90
+        results = cache.get(_keys(0, 101))
+        evicted = [i for i, result in enumerate(results) if result is None]
+        assert evicted == list(range(20, 31))
+        assert results[100] == (100, 0)
+        # Keys already in the cache aren't counted again
+        cache.put(_keys(0, 20), range(20), [1] * 20)
+        assert cache.numEntries == 90
+        cache.get(_keys(0, 20) + _keys(100, 101))
+
+    # A cache opened with a smaller maxEntries is evicted on opening, keeping the most recently used results
+    with ResultCache(str(tmp_path), maxEntries=50) as cache:
+        assert cache.numEntries == 45
+        results = cache.get(_keys(0, 101))
+        assert sum(result is not None for result in results) == 45
+        assert results[100] is not None and all(result is not None for result in results[:20])
@@ -0,0 +1,142 @@
+# End to end checks of Scripts/teloBPCmd.py on small synthetic fastq files, run as a script or through run_analysis.
+#
+# Run with: python -m pytest tests
+
+import importlib.util
+import os
+import random
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from TeloBP import getTeloNPBoundary
+from TeloBP.constants import errorReturns
+from TeloBP.syntheticReads import syntheticTelomericRead
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(repoDir, "Scripts", "teloBPCmd.py")
+
+
+def runTeloBPCmd(*args, cwd=None):
+    env = dict(os.environ, PYTHONPATH=repoDir)
+    result = subprocess.run([sys.executable, script, *map(str, args), "--workers", "1"], cwd=cwd, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def loadTeloBPCmd():
+    # A fresh copy of the script module, as run_analysis keeps its settings in module globals. It's registered in
+    # sys.modules so that its worker function can be pickled for the pool.
+    spec = importlib.util.spec_from_file_location("teloBPCmd", script)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["teloBPCmd"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def writeFastq(filename, reads):
+    with open(filename, "w") as fastq:
+        for qname, seq in reads:
+            fastq.write(f"@{qname}\n{seq}\n+\n{'I' * len(seq)}\n")
+
+
+def _reads():
+    rng = random.Random(0)
+    reads = [("short", "CCCTAA" * 20), ("noTelomere", "".join(rng.choice("ACG") for _ in range(3000)))]
+    reads += [(f"read{i}", syntheticTelomericRead(6000, 2000, i % 2 == 0, 0.02, rng=np.random.default_rng(i))[0]) for i in range(4)]
+    return reads
+
+
+def test_prefilterOptIn(tmp_path):
+    # By default every read goes through the boundary search, as getTeloNPBoundary does it
+    reads = _reads()
+    writeFastq(tmp_path / "reads.fastq", reads)
+    stdout = runTeloBPCmd(tmp_path / "reads.fastq", tmp_path / "out", "--fileMode", "--teloNP")
+    assert "no telomere: 0" in stdout
+    output = pd.read_csv(tmp_path / "out" / "reads.csv")
+    expected = {qname: getTeloNPBoundary(seq) for qname, seq in reads}
+    assert {qname: (length, isGStrand) for qname, length, isGStrand in output.itertuples(index=False)} == \
+        {qname: result for qname, result in expected.items() if result[1] is not None}
+
+    # With --prefilter, the read without telomere repeats is counted as a noTelomere error
+    stdout = runTeloBPCmd(tmp_path / "reads.fastq", tmp_path / "prefiltered", "--fileMode", "--teloNP", "--prefilter")
+    assert "no telomere: 1" in stdout
+    assert getTeloNPBoundary(reads[1][1], prefilter=True)[0] == errorReturns["noTelomere"]
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "prefiltered" / "reads.csv"), output)
+
+
+def _writeSamples(dataDir, numFiles=2, numReads=60):
+    os.makedirs(dataDir)
+    for fileIndex in range(numFiles):
+        rng = np.random.default_rng(fileIndex)
+        reads = [(f"file{fileIndex}_read{i}", syntheticTelomericRead(3000, int(rng.integers(300, 2000)), bool(rng.integers(2)), 0.02, rng=rng)[0])
+                 for i in range(numReads)]
+        writeFastq(os.path.join(dataDir, f"sample{fileIndex}.fastq"), reads)
+
+
+def _outputCsvs(outputDir):
+    return {filename: pd.read_csv(os.path.join(outputDir, filename)) for filename in sorted(os.listdir(outputDir)) if filename.endswith(".csv")}
+
+
+def test_noCheckpointByDefault(tmp_path):
+    _writeSamples(tmp_path / "data")
+    loadTeloBPCmd().run_analysis(str(tmp_path / "data"), False, False, str(tmp_path / "out"), chunkSize=8, workers=1)
+    assert sorted(os.listdir(tmp_path / "out")) == ["sample0.csv", "sample1.csv"]
+
+
+@pytest.mark.parametrize("interruptAt", [1, 4, 8, 15])
+def test_interruptAndResume(tmp_path, interruptAt):
+    # The run is interrupted while writing the results of its interruptAt-th batch, with a checkpoint after every batch.
+    # The resumed run must give the csvs of an uninterrupted run, without duplicate or missing rows.
+    _writeSamples(tmp_path / "data")
+    dataDir = str(tmp_path / "data")
+    loadTeloBPCmd().run_analysis(dataDir, False, False, str(tmp_path / "expected"), chunkSize=8, workers=1)
+    expected = _outputCsvs(tmp_path / "expected")
+
+    outputDir = str(tmp_path / "out")
+    teloBPCmd = loadTeloBPCmd()
+    writeResultRows = teloBPCmd.writeResultRows
+    calls = []
+
+    def interruptedWriteResultRows(*args):
+        calls.append(None)
+        if len(calls) == interruptAt:
+            raise KeyboardInterrupt
+        writeResultRows(*args)
+
+    teloBPCmd.writeResultRows = interruptedWriteResultRows
+    with pytest.raises(KeyboardInterrupt):
+        teloBPCmd.run_analysis(dataDir, False, False, outputDir, chunkSize=8, workers=1, checkpointing=True, checkpointInterval=0)
+    # Interrupted in its first batch, the run has no checkpoint yet, and the resumed run starts over
+    assert os.path.exists(os.path.join(outputDir, "teloBPCheckpoint.json")) == (interruptAt > 1)
+    assert any(filename.endswith(".csv.partial") for filename in os.listdir(outputDir))
+
+    loadTeloBPCmd().run_analysis(dataDir, False, False, outputDir, chunkSize=8, workers=1, resume=True, checkpointInterval=0)
+    resumed = _outputCsvs(outputDir)
+    assert resumed.keys() == expected.keys()
+    for filename, output in resumed.items():
+        assert not output["qname"].duplicated().any()
+        pd.testing.assert_frame_equal(output, expected[filename])
+    assert not any(filename.endswith(".partial") for filename in os.listdir(outputDir))
+
+
+def test_targetedRunIndexes(tmp_path):
+    # Targeted runs only keep qname indexes in the cache directory, never next to the fastqs
+    _writeSamples(tmp_path / "data")
+    pd.DataFrame({"qname": ["file0_read3", "file0_read40", "file1_read7"]}).to_csv(tmp_path / "targets.csv", header=False, index=False)
+    dataDir = str(tmp_path / "data")
+    outputs = []
+    for outputDir, cacheDir in (("plain", None), ("cached", tmp_path / "cache"), ("indexed", tmp_path / "cache")):
+        loadTeloBPCmd().run_analysis(dataDir, False, False, str(tmp_path / outputDir), targetQnamesCSV=str(tmp_path / "targets.csv"),
+                                     workers=1, cacheDir=None if cacheDir is None else str(cacheDir))
+        assert sorted(os.listdir(tmp_path / "data")) == ["sample0.fastq", "sample1.fastq"]
+        outputs.append(_outputCsvs(tmp_path / outputDir))
+    assert len(os.listdir(tmp_path / "cache" / "qnameIndexes")) == 2
+    for output in outputs[1:]:
+        assert output.keys() == outputs[0].keys()
+        for filename in output:
+            pd.testing.assert_frame_equal(output[filename], outputs[0][filename])
+    assert sorted(outputs[0]["sample0.csv"]["qname"]) == ["file0_read3", "file0_read40"]
@@ -0,0 +1,46 @@
+# Regression checks of getGraphArea (TeloBP.teloBoundaryHelpers) against the per window loop it replaced, which
+# appended row[i:i + windowSize].sum() / windowSize for every i in range(len(row) - windowSize). The areas must be
+# bitwise equal, as the plateau search compares neighbouring areas.
+#
+# Run with: python -m pytest tests
+
+import numpy as np
+import pytest
+
+from TeloBP.offsetScoring import getNtOffsets
+from TeloBP.constants import expectedTeloCompositionQ
+from TeloBP.syntheticReads import syntheticTelomericRead
+from TeloBP.teloBoundaryHelpers import getGraphArea
+
+
+def _loopGraphArea(offsets, targetColumn, windowSize):
+    row = np.array(offsets).T[targetColumn, :]
+    return [row[i:i + windowSize].sum() / windowSize for i in range(0, len(row) - windowSize, 1)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("windowSize", [1, 2, 7, 8, 9, 83, 128, 129, 300])
+def test_randomOffsets(seed, windowSize):
+    rng = np.random.default_rng(seed)
+    # Offsets as getNtOffsets gives them: rounded scores, and raw floats whose sums depend on the order of addition
+    for offsets in (np.round(rng.normal(0, 30, (2000, 3)), 2), rng.normal(0, 1e3, (2000, 3)) * rng.random((2000, 1))):
+        for targetColumn in range(offsets.shape[1]):
+            areas = getGraphArea(offsets.tolist(), targetColumn, windowSize)
+            np.testing.assert_array_equal(areas, _loopGraphArea(offsets, targetColumn, windowSize))
+
+
+@pytest.mark.parametrize("windowSize", [1, 83])
+def test_readOffsets(windowSize):
+    seq = syntheticTelomericRead(20000, 6000, True, 0.05, 0.02, 0.02, rng=np.random.default_rng(3))[0].encode()
+    offsets = getNtOffsets(seq, expectedTeloCompositionQ, True, 100, 6)
+    for targetColumn in range(len(expectedTeloCompositionQ)):
+        np.testing.assert_array_equal(getGraphArea(offsets, targetColumn, windowSize), _loopGraphArea(offsets, targetColumn, windowSize))
+
+
+@pytest.mark.parametrize("length, windowSize", [(10, 10), (10, 11), (10, 500), (1, 83), (0, 83)])
+def test_windowNotShorterThanOffsets(length, windowSize):
+    # No area is computed when the window covers all of the offsets, as with the loop. A length of 0 is what
+    # getNtOffsets gives for reads shorter than teloWindow
+    offsets = np.ones((length, 2))
+    assert len(getGraphArea(offsets, 0, windowSize)) == 0
+    assert _loopGraphArea(offsets, 0, windowSize) == []